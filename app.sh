@@ -25,14 +25,17 @@ if [ -e $ROOT/conf.sh ]; then
     source $ROOT/conf.sh
 fi
 
+# Giraffe splits ImageMagick's memory and thread limits between the workers
+export GIRAFFE_WORKERS=${GIRAFFE_WORKERS:-4}
+
 # Option 1: Gunicorn with Uvicorn workers (Recommended for production)
 # poetry run newrelic-admin run-program gunicorn -k uvicorn.workers.UvicornWorker -c etc/gunicorn.conf.py giraffe:app --log-level=DEBUG
 
 # Option 2: Direct Uvicorn (Simple, but less process management)
-poetry run newrelic-admin run-program uvicorn giraffe:app --host 0.0.0.0 --port 8080 --workers 4 --log-level debug
+poetry run newrelic-admin run-program uvicorn giraffe:app --host 0.0.0.0 --port 8080 --workers $GIRAFFE_WORKERS --log-level debug
 
 # Option 3: Hypercorn (For HTTP/3 support)
-# poetry run newrelic-admin run-program hypercorn giraffe:app --bind 0.0.0.0:8080 --workers 4 --log-level debug
+# poetry run newrelic-admin run-program hypercorn giraffe:app --bind 0.0.0.0:8080 --workers $GIRAFFE_WORKERS --log-level debug
 
 # Option 4: Granian (Maximum performance)
-# poetry run newrelic-admin run-program granian --interface asgi giraffe:app --host 0.0.0.0 --port 8080 --workers 4 
\ No newline at end of file
+# poetry run newrelic-admin run-program granian --interface asgi giraffe:app --host 0.0.0.0 --port 8080 --workers $GIRAFFE_WORKERS 
\ No newline at end of file
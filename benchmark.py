@@ -0,0 +1,77 @@
+"""
+Allocations and peak memory per generated variant.
+
+Generates variants of a synthetic original through the app, with S3 mocked
+out, and reports what tracemalloc saw each request allocate: the peak over
+what was allocated before it, and that peak in copies of the encoded
+variant (so a path that copies the encoded blob around shows up as more
+copies).  Only Python allocations are traced, ImageMagick's own pixel
+memory isn't.
+
+    python benchmark.py [--size 2000x1500] [--requests 20] [--query w=800]
+
+"""
+from __future__ import print_function
+
+import argparse
+import statistics
+import time
+import tracemalloc
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from wand.color import Color
+from wand.image import Image
+
+import giraffe
+
+
+def make_original(width, height):
+    with Color('red') as bg:
+        with Image(width=width, height=height, background=bg) as img:
+            return img.make_blob('jpg')
+
+
+def run(size, requests, query):
+    width, height = map(int, size.split('x'))
+    original = mock.Mock(content=make_original(width, height), headers={'content-type': 'image/jpeg'})
+    url = f"/benchmark/original.jpg?{query}&force=true"
+
+    peaks, sizes, times = [], [], []
+    with mock.patch('giraffe.s3') as s3, TestClient(giraffe.app) as client:
+        s3.get.return_value = original
+        # warm up caches and imports so they don't count against the first request
+        client.get(url)
+
+        tracemalloc.start()
+        for _ in range(requests):
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            started = time.perf_counter()
+            r = client.get(url)
+            times.append(time.perf_counter() - started)
+            _, peak = tracemalloc.get_traced_memory()
+            r.raise_for_status()
+            peaks.append(peak - baseline)
+            sizes.append(len(r.content))
+            del r
+        tracemalloc.stop()
+
+    encoded = statistics.mean(sizes)
+    print(f"original: {size} ({len(original.content)} bytes), variant: {query} ({encoded:.0f} bytes)")
+    print(f"requests: {requests}, mean time: {statistics.mean(times) * 1000:.1f}ms")
+    print(f"peak allocated per request: mean {statistics.mean(peaks):.0f} bytes, max {max(peaks)} bytes")
+    print(f"peak in copies of the variant: {statistics.mean(peaks) / encoded:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', default='2000x1500', help="Original size, WIDTHxHEIGHT")
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--query', default='w=800', help="Variant query string")
+    args = parser.parse_args()
+    run(args.size, args.requests, args.query)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,9 @@ bind = "0.0.0.0:8080"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
+workers = int(os.environ.get("GIRAFFE_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# Giraffe splits ImageMagick's memory and thread limits between the workers
+raw_env = ["GIRAFFE_WORKERS=%d" % workers]
 worker_class = "uvicorn.workers.UvicornWorker"
 worker_connections = 1000
 # Restart workers after this many requests, with up to 50 random jitter
@@ -14,23 +14,45 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from collections import defaultdict
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from collections import OrderedDict
 from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
 from io import BytesIO
+import asyncio
+import contextvars
+import ctypes
+import fcntl
+import functools
 import gzip
 import hashlib
+import heapq
 import hmac
+import itertools
+import json
+import math
 import os
 import re
-from typing import Optional
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Literal, Optional, Union
 from urllib import parse
+from xml.sax.saxutils import escape, quoteattr
+import zipfile
 
 # FastAPI imports
 from fastapi import FastAPI, Request, HTTPException, Query, Path
-from fastapi.responses import Response, HTMLResponse
+from fastapi.responses import Response, HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel
 
 # Keep existing imports
 from PIL import Image as PillowImage
@@ -38,10 +60,17 @@ from requests.exceptions import HTTPError, ConnectionError
 import requests
 import tinys3
 import wand
+import wand.resource
+from wand.api import library
 from wand.color import Color
 from wand.font import Font
 from wand.image import Image
 
+try:
+    from pymemcache.client.hash import HashClient
+except ImportError:
+    HashClient = None
+
 FORMAT_MAP = {
     'png': {
         'extension': 'png',
@@ -59,12 +88,27 @@ FORMAT_MAP = {
 
 FORMAT_MAP['jpeg'] = FORMAT_MAP['jpg']
 
+# Animations can also be written as animated GIF / WebP, or transcoded to
+# video with ffmpeg (see ``encode_video``)
+for _fmt in ('gif', 'webp', 'mp4', 'webm'):
+    FORMAT_MAP[_fmt] = {'extension': _fmt, 'format': {'format': _fmt}}
+
+# Formats we hand to ffmpeg rather than ImageMagick, with their content types
+# and encoder arguments
+VIDEO_FORMATS = {
+    'mp4': ('video/mp4', ['-c:v', 'libx264', '-crf', '28', '-preset', 'fast', '-movflags', '+faststart']),
+    'webm': ('video/webm', ['-c:v', 'libvpx-vp9', '-crf', '40', '-b:v', '0']),
+}
+
 # Application lifespan events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handle application lifespan events"""
     # Startup
     connect_s3()
+    connect_memcached()
+    load_fonts()
+    apply_magick_limits(magick_limits())
     yield
     # Shutdown
     pass
@@ -80,6 +124,23 @@ app = FastAPI(
 # Template configuration
 templates = Jinja2Templates(directory="templates")
 
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def parse_bucket_settings(value, cast):
+    """Parse a "bucket=value,bucket=value" setting into a dict"""
+    settings = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            bucket, _, setting = item.partition("=")
+            settings[bucket.strip()] = cast(setting)
+    return settings
+
+
 # Environment configuration
 ENV = os.environ.get("ENV", "development").lower()
 DEBUG = ENV not in ("production", "staging")
@@ -88,6 +149,7 @@ CACHE_URLS = os.environ.get("MEMCACHED").split(";") if os.environ.get("MEMCACHED
 SECRET = os.environ.get("GIRAFFE_SECRET", "0x24FEEDFACEDEADBEEFCAFE")
 
 s3 = None
+memcached = None
 CACHE_DIR = os.environ.get("GIRAFFE_CACHE_DIR", 'giraffe')
 CACHE_CONTROL = "max-age=2592000"
 DEFAULT_QUALITY = 75
@@ -95,6 +157,159 @@ MAX_WIDTH = 7680
 MAX_HEIGHT = 4320
 MAX_PIXELS = MAX_WIDTH * MAX_HEIGHT # 8K resolution is pretty damn big
 MAX_EXTENSION_LENGTH = 10  # Maximum allowed extension length
+# How variant cache keys are built:
+#  - legacy: giraffe/<dirname>/<base>_w100_h100.jpg
+#  - hashed: giraffe/<shard>/<shard>/<digest>.jpg
+#  - migrate: hashed, but fall back to (and copy forward) legacy keys
+CACHE_KEY_SCHEMES = ('legacy', 'hashed', 'migrate')
+CACHE_KEY_SCHEME = os.environ.get("GIRAFFE_CACHE_KEY_SCHEME", "legacy").lower()
+if CACHE_KEY_SCHEME not in CACHE_KEY_SCHEMES:
+    raise ValueError(f"GIRAFFE_CACHE_KEY_SCHEME must be one of {CACHE_KEY_SCHEMES}, not '{CACHE_KEY_SCHEME}'")
+CACHE_KEY_DIGEST_LENGTH = 32
+# 301 requests with non-canonical query strings to their canonical URL
+CANONICAL_REDIRECT = env_flag("GIRAFFE_CANONICAL_REDIRECT")
+# Fold the original's ETag into variant keys so overwriting an original
+# invalidates its variants, and serve ``?v=<version>`` URLs as immutable
+VERSIONED_CACHE_KEYS = env_flag("GIRAFFE_VERSIONED_CACHE_KEYS")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+VERSION_LENGTH = 16
+# Objects served straight from S3 are streamed in ranged reads of this many bytes
+STREAM_CHUNK_SIZE = int(os.environ.get("GIRAFFE_STREAM_CHUNK_SIZE", 1024 * 1024))
+# Limits for fetching third party images through /proxy
+PROXY_CONNECT_TIMEOUT = float(os.environ.get("GIRAFFE_PROXY_CONNECT_TIMEOUT", 3.05))
+PROXY_READ_TIMEOUT = float(os.environ.get("GIRAFFE_PROXY_READ_TIMEOUT", 10))
+PROXY_MAX_BYTES = int(os.environ.get("GIRAFFE_PROXY_MAX_BYTES", 20 * 1024 * 1024))
+PROXY_POOL_SIZE = int(os.environ.get("GIRAFFE_PROXY_POOL_SIZE", 20))
+PROXY_CHUNK_SIZE = 64 * 1024
+# Proxied images are cached in memory (small ones) and, if a bucket is
+# configured, in S3 under CACHE_DIR/proxy/
+PROXY_CACHE_BUCKET = os.environ.get("GIRAFFE_PROXY_CACHE_BUCKET")
+PROXY_MEMORY_CACHE_SIZE = int(os.environ.get("GIRAFFE_PROXY_MEMORY_CACHE_SIZE", 256))
+PROXY_MEMORY_MAX_ITEM_BYTES = 512 * 1024
+# How long to keep proxied images the upstream didn't give a lifetime for
+PROXY_DEFAULT_TTL = int(os.environ.get("GIRAFFE_PROXY_DEFAULT_TTL", 24 * 60 * 60))
+# Used when we serve a stale copy because the upstream is down, so the CDN asks again soon
+PROXY_STALE_CACHE_CONTROL = "max-age=60"
+# How long (in seconds) to trust a HEAD of an original before asking S3 again
+METADATA_TTL = int(os.environ.get("GIRAFFE_METADATA_TTL", 60))
+METADATA_CACHE_SIZE = int(os.environ.get("GIRAFFE_METADATA_CACHE_SIZE", 10000))
+# How long to remember that an original doesn't exist, for up to
+# NEGATIVE_CACHE_SIZE originals in process (and in memcached if MEMCACHED is
+# set and pymemcache is installed)
+NEGATIVE_CACHE_TTL = int(os.environ.get("GIRAFFE_NEGATIVE_CACHE_TTL", 30))
+NEGATIVE_CACHE_SIZE = int(os.environ.get("GIRAFFE_NEGATIVE_CACHE_SIZE", 10000))
+# Let CDNs hold on to 404s for missing originals for as long as we do
+NOT_FOUND_CACHE_CONTROL = os.environ.get("GIRAFFE_NOT_FOUND_CACHE_CONTROL", f"public, max-age={NEGATIVE_CACHE_TTL}")
+# The most overlays one POST /mockups request can ask for
+MOCKUP_MAX_OVERLAYS = int(os.environ.get("GIRAFFE_MOCKUP_MAX_OVERLAYS", 50))
+# The most images one sprite sheet can be made of
+SPRITE_MAX_IMAGES = int(os.environ.get("GIRAFFE_SPRITE_MAX_IMAGES", 100))
+# How many of a sprite's originals are downloaded (and held) at once, they're decoded one at a time
+SPRITE_FETCH_CONCURRENCY = int(os.environ.get("GIRAFFE_SPRITE_FETCH_CONCURRENCY", 8))
+# Sheets with images missing aren't stored, and only briefly cached, so they fill in once the images turn up
+SPRITE_INCOMPLETE_CACHE_CONTROL = os.environ.get("GIRAFFE_SPRITE_INCOMPLETE_CACHE_CONTROL", "max-age=60")
+# POST /bulk limits: how many items per request, and how many are worked on at once
+BULK_MAX_ITEMS = int(os.environ.get("GIRAFFE_BULK_MAX_ITEMS", 1000))
+BULK_CONCURRENCY = int(os.environ.get("GIRAFFE_BULK_CONCURRENCY", 8))
+# Placeholders are entirely determined by their arguments, so we keep the
+# most recently rendered ones around, up to this many bytes of them
+PLACEHOLDER_CACHE_SIZE = int(os.environ.get("GIRAFFE_PLACEHOLDER_CACHE_SIZE", 256))
+PLACEHOLDER_CACHE_BYTES = int(os.environ.get("GIRAFFE_PLACEHOLDER_CACHE_BYTES", 32 * 1024 * 1024))
+PLACEHOLDER_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'fonts', 'Inconsolata-dz-Powerline.otf')
+
+# Decoded overlays (and the backgrounds they're composited onto) are kept in
+# memory, up to this many bytes of pixels
+OVERLAY_CACHE_SIZE = int(os.environ.get("GIRAFFE_OVERLAY_CACHE_SIZE", 64))
+OVERLAY_CACHE_BYTES = int(os.environ.get("GIRAFFE_OVERLAY_CACHE_BYTES", 256 * 1024 * 1024))
+# ImageMagick's default Q16 build keeps 4 16-bit channels per pixel
+PIXEL_BYTES = 8
+
+# Animations are flattened once and thinned out to at most this many frames
+ANIMATION_MAX_FRAMES = int(os.environ.get("GIRAFFE_ANIMATION_MAX_FRAMES", 100))
+# mp4 / webm output needs ffmpeg
+FFMPEG = os.environ.get("GIRAFFE_FFMPEG") or shutil.which("ffmpeg")
+FFMPEG_TIMEOUT = int(os.environ.get("GIRAFFE_FFMPEG_TIMEOUT", 30))
+
+# Seam carving (fit=liquid) is slow: it runs on a working copy scaled down to
+# fill the target, at most LIQUID_CONCURRENCY at a time (and LIQUID_BACKLOG
+# started or waiting), and falls back to a plain crop when it'd cost more than
+# LIQUID_MAX_COST (pixels x seams), there are too many carves already or it
+# takes longer than LIQUID_TIMEOUT seconds
+LIQUID_CONCURRENCY = int(os.environ.get("GIRAFFE_LIQUID_CONCURRENCY", 2))
+LIQUID_BACKLOG = int(os.environ.get("GIRAFFE_LIQUID_BACKLOG", 2 * LIQUID_CONCURRENCY))
+LIQUID_MAX_COST = int(os.environ.get("GIRAFFE_LIQUID_MAX_COST", 512 * 1024 * 1024))
+LIQUID_TIMEOUT = float(os.environ.get("GIRAFFE_LIQUID_TIMEOUT", 10))
+# Used for the crop we serve while a slow seam carve finishes
+LIQUID_FALLBACK_CACHE_CONTROL = "max-age=60"
+
+# Admission control for generating variants (cache hits don't need it):
+# at most GENERATION_CONCURRENCY per worker, and GENERATION_HOST_SLOTS per
+# host if set, with up to GENERATION_QUEUE_SIZE requests waiting at most
+# GENERATION_QUEUE_TIMEOUT seconds.  Everything else gets a 503.
+GENERATION_CONCURRENCY = int(os.environ.get("GIRAFFE_GENERATION_CONCURRENCY", 4))
+GENERATION_QUEUE_SIZE = int(os.environ.get("GIRAFFE_GENERATION_QUEUE_SIZE", 32))
+GENERATION_QUEUE_TIMEOUT = float(os.environ.get("GIRAFFE_GENERATION_QUEUE_TIMEOUT", 5))
+GENERATION_RETRY_AFTER = int(os.environ.get("GIRAFFE_GENERATION_RETRY_AFTER", 2))
+GENERATION_HOST_SLOTS = int(os.environ.get("GIRAFFE_GENERATION_HOST_SLOTS", 0))
+GENERATION_HOST_SLOT_DIR = os.environ.get("GIRAFFE_GENERATION_HOST_SLOT_DIR",
+                                          os.path.join(tempfile.gettempdir(), "giraffe-slots"))
+
+# Most seconds each stage of generating a variant can take before we give up on it
+# with a 504: fetching the original, decoding it, transforming it, encoding the
+# result and uploading it.  0 for no limit.
+STAGE_TIMEOUTS = {
+    stage: float(os.environ.get(f"GIRAFFE_{stage.upper()}_TIMEOUT", 0))
+    for stage in ('fetch', 'decode', 'transform', 'encode', 'upload')
+}
+# How often to check whether the client's still there while generating
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("GIRAFFE_DISCONNECT_POLL_INTERVAL", 0.1))
+
+# ImageMagick resource limits, applied at startup.  By default they're worked out
+# from the host's RAM and CPUs, shared between WORKERS worker processes each
+# generating up to GENERATION_CONCURRENCY variants: MAGICK_MEMORY_FRACTION of RAM
+# for pixel caches, twice that memory mapped and four times that on disk, and the
+# CPUs split so ImageMagick's threads don't oversubscribe them.  Any of them can be
+# set outright, in bytes (pixels for area).
+WORKERS = int(os.environ.get("GIRAFFE_WORKERS", os.environ.get("WEB_CONCURRENCY", 1)))
+MAGICK_MEMORY_FRACTION = float(os.environ.get("GIRAFFE_MAGICK_MEMORY_FRACTION", 0.5))
+MAGICK_LIMITS = {
+    resource: int(os.environ[f"GIRAFFE_MAGICK_{resource.upper()}_LIMIT"])
+    for resource in ('memory', 'map', 'disk', 'area', 'thread')
+    if os.environ.get(f"GIRAFFE_MAGICK_{resource.upper()}_LIMIT")
+}
+
+# Track every image a request opens, and report any it doesn't close as leaks
+TRACK_IMAGES = env_flag("GIRAFFE_TRACK_IMAGES")
+
+# Per bucket generation settings, as "bucket=value,bucket=value":
+#  - weights: share of the generation slots when buckets are competing (default 1)
+#  - concurrency: most generations a bucket can have going at once
+#  - rates: most generations a second a bucket can start, after that it gets 429s
+BUCKET_WEIGHTS = parse_bucket_settings(os.environ.get("GIRAFFE_BUCKET_WEIGHTS"), float)
+BUCKET_CONCURRENCY = parse_bucket_settings(os.environ.get("GIRAFFE_BUCKET_CONCURRENCY"), int)
+BUCKET_RATES = parse_bucket_settings(os.environ.get("GIRAFFE_BUCKET_RATES"), float)
+# Buckets come from URLs, so past this many the ones we haven't configured share their stats
+BUCKET_STATS_MAX = int(os.environ.get("GIRAFFE_BUCKET_STATS_MAX", 100))
+
+# What to serve instead of a 503 when there's no room to generate a variant, tried
+# in order: "nearest" (the closest already cached size in OVERLOAD_SIZES), "preview"
+# (a quick low quality resize of originals up to PREVIEW_MAX_PIXELS, at most
+# PREVIEW_CONCURRENCY at a time) and "placeholder".  The exact variant is then
+# generated in the background.
+OVERLOAD_FALLBACKS = [f.strip() for f in os.environ.get("GIRAFFE_OVERLOAD_FALLBACKS", "").split(",") if f.strip()]
+OVERLOAD_SIZES = [int(size) for size in os.environ.get("GIRAFFE_OVERLOAD_SIZES", "160,320,640,1280,1920").split(",")]
+OVERLOAD_CACHE_CONTROL = os.environ.get("GIRAFFE_OVERLOAD_CACHE_CONTROL", "max-age=10")
+OVERLOAD_BACKGROUND_ATTEMPTS = int(os.environ.get("GIRAFFE_OVERLOAD_BACKGROUND_ATTEMPTS", 3))
+PREVIEW_QUALITY = int(os.environ.get("GIRAFFE_PREVIEW_QUALITY", 30))
+PREVIEW_MAX_PIXELS = int(os.environ.get("GIRAFFE_PREVIEW_MAX_PIXELS", 4000 * 4000))
+PREVIEW_CONCURRENCY = int(os.environ.get("GIRAFFE_PREVIEW_CONCURRENCY", 1))
+
+# The order image arguments are serialized in for cache keys and canonical URLs
+CANONICAL_ARGS = ('rect', 'w', 'h', 'fit', 'flip', 'rot', 'fm', 'q', 'fps', 'bg', 'overlay', 'ox', 'oy', 'ow', 'oh')
+# Arguments that only mean something when compositing an overlay
+OVERLAY_ARGS = ('bg', 'ox', 'oy', 'ow', 'oh')
+FIT_MODES = ('crop', 'liquid')
 
 
 def get_image_size(bytes):
@@ -115,7 +330,144 @@ def connect_s3():
 connect_s3()
 
 
+def connect_memcached():
+    global memcached
+    if memcached is None and CACHE_URLS and HashClient is not None:
+        servers = [url.rsplit(":", 1) if ":" in url else (url, 11211) for url in CACHE_URLS]
+        memcached = HashClient([(host, int(port)) for host, port in servers],
+                               connect_timeout=0.1, timeout=0.1, ignore_exc=True)
+    return memcached
+
+
 ImageOp = namedtuple("ImageOp", 'function params')
+ObjectMeta = namedtuple("ObjectMeta", 'etag last_modified content_type size')
+
+# every in-process cache, so they can all be dropped at once
+CACHES = []
+
+
+class TTLCache(object):
+    """
+    A small thread-safe LRU cache whose entries expire ``ttl`` seconds after
+    they're set.
+
+    If ``maxweight`` is given entries are also evicted until the sum of
+    ``weigh(value)`` over the cache fits in it (e.g. to bound it in bytes).
+    Values the cache lets go of (evicted, expired, replaced or cleared, but
+    not popped) are passed to ``dispose``, e.g. to free them.
+
+    """
+
+    def __init__(self, maxsize, ttl=None, maxweight=None, weigh=None, dispose=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.dispose = dispose
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        CACHES.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value, weight = self._data[key]
+            except KeyError:
+                return default
+            if expires is None or expires >= time.monotonic():
+                self._data.move_to_end(key)
+                return value
+            self._remove(key)
+        self._dispose([value])
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        weight = self.weigh(value) if self.weigh else 0
+        with self._lock:
+            replaced = self._remove(key)
+            released = [] if replaced is value else [replaced]
+            if self.maxweight is not None and weight > self.maxweight:
+                # would push everything else out, and then itself
+                released.append(value)
+            else:
+                self._data[key] = (expires, value, weight)
+                self.weight += weight
+                while len(self._data) > self.maxsize or (
+                        self.maxweight is not None and self.weight > self.maxweight):
+                    released.append(self._remove(next(iter(self._data))))
+        self._dispose(released)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            released = [value for expires, value, weight in self._data.values()]
+            self._data.clear()
+            self.weight = 0
+        self._dispose(released)
+
+    def _dispose(self, values):
+        if self.dispose is not None:
+            for value in values:
+                if value is not None:
+                    self.dispose(value)
+
+    def _remove(self, key, default=None):
+        expires, value, weight = self._data.pop(key, (None, default, 0))
+        self.weight -= weight
+        return value
+
+    def __len__(self):
+        return len(self._data)
+
+
+def clear_caches():
+    for cache in CACHES:
+        cache.clear()
+
+
+# HEADs of originals, keyed by (bucket, path)
+ORIGINAL_METADATA = TTLCache(METADATA_CACHE_SIZE, ttl=METADATA_TTL)
+
+
+MISSING_ORIGINALS = TTLCache(NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL)
+
+
+def missing_key(bucket, path):
+    return "giraffe-missing:" + hashlib.sha1(f"{bucket}/{path}".encode()).hexdigest()
+
+
+def known_missing(bucket, path):
+    """Have we (or, with memcached, another worker) recently found this original missing?"""
+    if MISSING_ORIGINALS.get((bucket, path)):
+        return True
+    if memcached is not None and memcached.get(missing_key(bucket, path)):
+        MISSING_ORIGINALS.set((bucket, path), True)
+        return True
+    return False
+
+
+def remember_missing(bucket, path):
+    MISSING_ORIGINALS.set((bucket, path), True)
+    if memcached is not None:
+        memcached.set(missing_key(bucket, path), b"1", expire=NEGATIVE_CACHE_TTL, noreply=True)
+
+
+def forget_missing(bucket, path):
+    """An original we thought was missing turned up"""
+    MISSING_ORIGINALS.pop((bucket, path))
+    if memcached is not None:
+        memcached.delete(missing_key(bucket, path), noreply=True)
+
+
+def original_not_found(path):
+    return HTTPException(status_code=404, detail=f"404: original file '{path}' doesn't exist",
+                         headers={"Cache-Control": NOT_FOUND_CACHE_CONTROL})
 
 
 # Lookup table for JPEG extensions (more secure than regex)
@@ -184,17 +536,171 @@ def path_to_format(path):
     return extension_to_format(ext)
 
 
+def content_etag(content):
+    """
+    A strong ETag for some bytes, computed the same way S3 computes them for
+    objects uploaded in a single part, so a variant has the same ETag whether
+    we just generated it or served it from the cache.
+
+    """
+    return '"{}"'.format(hashlib.md5(content).hexdigest())
+
+
+def conditional_headers(request):
+    """The validators a client sent us, ready to be forwarded to S3 or an upstream"""
+    headers = {}
+    if request is None:
+        return headers
+    for name in ('If-None-Match', 'If-Modified-Since'):
+        value = request.headers.get(name)
+        if value:
+            headers[name] = value
+    return headers
+
+
+def validator_headers(etag=None, last_modified=None, cache_control=None):
+    headers = {"Cache-Control": cache_control or CACHE_CONTROL}
+    if etag:
+        headers["ETag"] = etag
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    Does the client already have this representation?  ``If-None-Match``
+    takes precedence over ``If-Modified-Since`` (RFC 7232, section 6).
+
+    """
+    if request is None:
+        return False
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if not etag:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified(etag=None, last_modified=None, cache_control=None):
+    return Response(status_code=304, headers=validator_headers(etag, last_modified, cache_control))
+
+
+def parse_range(header):
+    """
+    Parse a single ``Range: bytes=...`` into ``(start, end)``:
+
+      bytes=0-499 -> (0, 499)
+      bytes=500-  -> (500, None)
+      bytes=-500  -> (-500, None)
+
+    Anything else (multiple ranges, other units, garbage) returns None and
+    gets the whole object, which RFC 7233 allows.
+
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+    start, sep, end = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if not start:
+            suffix = int(end)
+            return (-suffix, None) if suffix > 0 else None
+        start = int(start)
+        end = int(end) if end else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        return None
+    return start, end
+
+
+def content_range_length(header):
+    """bytes 0-1048575/5242880 -> 5242880"""
+    if not header:
+        return None
+    length = header.rpartition("/")[2]
+    return int(length) if length.isdigit() else None
+
+
+def if_range_matches(request, etag=None, last_modified=None):
+    if_range = request.headers.get('if-range') if request is not None else None
+    if not if_range:
+        return True
+    return if_range in (etag, last_modified)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Main index page"""
     return templates.TemplateResponse(request, "index.html")
 
 
+PLACEHOLDERS = TTLCache(PLACEHOLDER_CACHE_SIZE, maxweight=PLACEHOLDER_CACHE_BYTES, weigh=len)
+
+PLACEHOLDER_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+    'viewBox="0 0 {width} {height}">'
+    '<rect width="100%" height="100%" fill={bg}/>'
+    '<text x="50%" y="50%" font-family="Inconsolata, monospace" font-size="{size:.1f}" '
+    'text-anchor="middle" dominant-baseline="central">{text}</text>'
+    '</svg>'
+)
+
+
+def load_fonts():
+    """
+    Make sure the placeholder font is there and have ImageMagick load it, so
+    the first placeholder we're asked for doesn't pay for it.
+
+    """
+    if not os.path.exists(PLACEHOLDER_FONT_PATH):
+        raise RuntimeError(f"Placeholder font '{PLACEHOLDER_FONT_PATH}' is missing")
+    render_placeholder(16, 16, 'png', '#fff', 'x')
+
+
+def render_placeholder(width, height, fmt, bg, text):
+    """Draw a placeholder, returns its encoded bytes"""
+    if fmt == 'svg':
+        # monospace glyphs are ~0.6em wide, keep the text inside the image
+        size = min(height / 2.0, width / (len(text) * 0.6))
+        return PLACEHOLDER_SVG.format(
+            width=width, height=height, bg=quoteattr(bg), size=size, text=escape(text),
+        ).encode()
+
+    min_font_ratio = width / (len(text) * 12.0)
+    size = max(16 * (height / 100), 16 * min_font_ratio)
+
+    font = Font(path=PLACEHOLDER_FONT_PATH, size=size)
+    c = Color(bg) if fmt == "jpg" else None
+
+    with Image(width=width, height=height, background=c) as image:
+        image.caption(text, left=0, top=0, font=font, gravity="center")
+        return encode_image(image, fmt)
+
+
 @app.get("/placeholders/{filename}")
 async def placeholder_it(
     filename: str,
     bg: str = Query(default="fff", description="Background color (hex without #)"),
-    message: Optional[str] = Query(default=None, description="Custom message text")
+    message: Optional[str] = Query(default=None, description="Custom message text"),
+    request: Request = None,
 ):
     """Generate placeholder images"""
     try:
@@ -209,32 +715,40 @@ async def placeholder_it(
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid filename format. Use WIDTHxHEIGHT.ext")
         
-        content_type = f'image/{normalize_mimetype(ext)}'
+        if ext == 'svg':
+            content_type = 'image/svg+xml'
+        else:
+            content_type = f'image/{normalize_mimetype(ext)}'
 
         if ext in ('jpg', 'jpeg'):
             fmt = 'jpg'
-        elif ext == 'png':
-            fmt = 'png'
+        elif ext in ('png', 'svg'):
+            fmt = ext
         else:
             raise HTTPException(status_code=404, detail=f"I don't know how to handle format .{ext} files")
 
         text = message if message else f'{width}x{height}'
-        min_font_ratio = width / (len(text) * 12.0)
-        size = max(16 * (height / 100), 16 * min_font_ratio)
 
-        font = Font(path='fonts/Inconsolata-dz-Powerline.otf', size=size)
-        c = Color(bg) if fmt == "jpg" else None
-        
-        with Image(width=width, height=height, background=c) as image:
-            image.caption(text, left=0, top=0, font=font, gravity="center")
-            buff = image_to_buffer(image, fmt=ext, compress=False)
-            buff.seek(0)
-            
-            return Response(
-                content=buff.read(),
-                media_type=content_type,
-                headers={"Cache-Control": CACHE_CONTROL}
-            )
+        # placeholders are entirely determined by their arguments, so we can
+        # answer a revalidation without drawing anything
+        etag = content_etag(f"{width}x{height}.{ext}|{bg}|{text}".encode())
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+
+        key = (width, height, fmt, bg, text)
+        content = PLACEHOLDERS.get(key)
+        if content is None:
+            if fmt == 'svg':
+                content = render_placeholder(*key)
+            else:
+                content = await run_in_threadpool(render_placeholder, *key)
+            PLACEHOLDERS.set(key, content)
+
+        return Response(
+            content=content,
+            media_type=content_type,
+            headers=validator_headers(etag)
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -243,10 +757,285 @@ def generate_hmac(url):
     return hmac.new(SECRET.encode(), url.encode(), hashlib.sha1).hexdigest()
 
 
+# Magic numbers for the image formats we're willing to proxy
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+)
+
+
+def sniff_image_type(head):
+    """
+    Work out what kind of image some bytes are from their first few bytes,
+    rather than trusting whatever content-type a third party server sent.
+    Returns None for anything that isn't an image we know about.
+
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+def make_proxy_session():
+    """A shared session so /proxy reuses keep-alive connections to popular hosts"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=PROXY_POOL_SIZE, pool_maxsize=PROXY_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+proxy_session = make_proxy_session()
+
+
+UpstreamImage = namedtuple("UpstreamImage", 'response head content_type chunks')
+
+
+def open_upstream(url, headers=None):
+    """
+    Start fetching a third party image: connect, read the headers and the
+    first chunk of the body, and check that it really is an image.  The rest
+    of the body is left in ``chunks`` for the caller to stream.
+
+    Returns None if the upstream says our copy is still good (a 304).
+
+    """
+    resp = proxy_session.get(url, headers=headers, stream=True,
+                             timeout=(PROXY_CONNECT_TIMEOUT, PROXY_READ_TIMEOUT))
+    try:
+        resp.raise_for_status()
+        if resp.status_code == 304:
+            resp.close()
+            return UpstreamImage(resp, b"", None, iter(()))
+
+        length = positive_int_or_none(resp.headers.get('content-length'))
+        if length is not None and length > PROXY_MAX_BYTES:
+            raise ValueError(f"{url} is bigger than {PROXY_MAX_BYTES} bytes")
+
+        chunks = resp.iter_content(PROXY_CHUNK_SIZE)
+        head = next(chunks, b"")
+        content_type = sniff_image_type(head)
+        if content_type is None:
+            raise ValueError(f"{url} doesn't look like an image")
+    except Exception:
+        resp.close()
+        raise
+    return UpstreamImage(resp, head, content_type, chunks)
+
+
+def iter_upstream(upstream, limit=None):
+    """Yield an upstream image's body, giving up if it grows past ``limit`` bytes"""
+    limit = PROXY_MAX_BYTES if limit is None else limit
+    try:
+        total = len(upstream.head)
+        yield upstream.head
+        for chunk in upstream.chunks:
+            total += len(chunk)
+            if total > limit:
+                # bailing out mid-response means the client (and CloudFront) see a
+                # broken transfer rather than caching a truncated image
+                raise ValueError(f"{upstream.response.url} is bigger than {limit} bytes")
+            yield chunk
+    finally:
+        upstream.response.close()
+
+
+# upstream_etag is only set when we've transformed the image, and so have an ETag of our own
+ProxyEntry = namedtuple("ProxyEntry", 'content content_type etag last_modified expires upstream_etag',
+                        defaults=(None,))
+
+
+# proxied images, keyed by HMAC; entries know when they go stale so they're
+# never evicted for age, we may still want them if the upstream goes down
+PROXY_CACHE = TTLCache(PROXY_MEMORY_CACHE_SIZE)
+
+
+def upstream_ttl(headers):
+    """
+    How long (in seconds) the upstream says we can reuse its image for, or
+    None if we shouldn't keep it at all.
+
+    """
+    directives = {}
+    for directive in headers.get('cache-control', '').lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name] = value.strip('"')
+
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        age = positive_int_or_none(directives.get(name))
+        if age is not None:
+            return age
+
+    expires = headers.get('expires')
+    if expires:
+        try:
+            return max(parsedate_to_datetime(expires).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return 0
+    return PROXY_DEFAULT_TTL
+
+
+def proxy_cache_key(image_hmac):
+    return os.path.join(CACHE_DIR, "proxy", image_hmac[:2], image_hmac)
+
+
+def proxy_cache_metadata(entry):
+    metadata = {
+        'Content-Type': entry.content_type,
+        'x-amz-meta-giraffe-expires': str(int(entry.expires)),
+        'x-amz-meta-giraffe-etag': entry.etag,
+    }
+    if entry.last_modified:
+        metadata['x-amz-meta-giraffe-last-modified'] = entry.last_modified
+    if entry.upstream_etag:
+        metadata['x-amz-meta-giraffe-upstream-etag'] = entry.upstream_etag
+    return metadata
+
+
+def get_proxied(image_hmac):
+    """Find our copy of a proxied image, fresh or not"""
+    entry = PROXY_CACHE.get(image_hmac)
+    if entry is None and PROXY_CACHE_BUCKET:
+        obj = get_object_or_none(PROXY_CACHE_BUCKET, proxy_cache_key(image_hmac))
+        if obj:
+            entry = ProxyEntry(
+                content=obj.content,
+                content_type=obj.headers.get('content-type', 'image/jpeg'),
+                etag=obj.headers.get('x-amz-meta-giraffe-etag') or content_etag(obj.content),
+                last_modified=obj.headers.get('x-amz-meta-giraffe-last-modified'),
+                expires=float(obj.headers.get('x-amz-meta-giraffe-expires', 0)),
+                upstream_etag=obj.headers.get('x-amz-meta-giraffe-upstream-etag'),
+            )
+            if len(entry.content) <= PROXY_MEMORY_MAX_ITEM_BYTES:
+                PROXY_CACHE.set(image_hmac, entry)
+    return entry
+
+
+def store_proxied(image_hmac, entry):
+    if len(entry.content) <= PROXY_MEMORY_MAX_ITEM_BYTES:
+        PROXY_CACHE.set(image_hmac, entry)
+    if PROXY_CACHE_BUCKET:
+        s3.upload(proxy_cache_key(image_hmac), BytesIO(entry.content), bucket=PROXY_CACHE_BUCKET,
+                  content_type=entry.content_type, public=False, headers=proxy_cache_metadata(entry))
+
+
+def refresh_proxied(image_hmac, entry):
+    """The upstream told us our copy is still good, remember that for a while longer"""
+    if len(entry.content) <= PROXY_MEMORY_MAX_ITEM_BYTES:
+        PROXY_CACHE.set(image_hmac, entry)
+    if PROXY_CACHE_BUCKET:
+        s3.update_metadata(proxy_cache_key(image_hmac), proxy_cache_metadata(entry),
+                           bucket=PROXY_CACHE_BUCKET, public=False)
+
+
+def iter_and_keep(chunks, kept, limit=None):
+    """
+    Pass chunks through, keeping a copy; a trailing None marks that we got
+    them all.  Past ``limit`` bytes we stop keeping them and let go of what
+    we had.
+
+    """
+    size = 0
+    keeping = True
+    for chunk in chunks:
+        if keeping:
+            size += len(chunk)
+            if limit is not None and size > limit:
+                keeping = False
+                kept.clear()
+            else:
+                kept.append(chunk)
+        yield chunk
+    if keeping:
+        kept.append(None)
+
+
+def store_streamed_proxy(image_hmac, kept, content_type, etag, last_modified, ttl):
+    if not kept or kept[-1] is not None:
+        # the transfer didn't finish, don't keep half an image
+        return
+    content = b"".join(kept[:-1])
+    store_proxied(image_hmac, ProxyEntry(
+        content=content,
+        content_type=content_type,
+        etag=etag or content_etag(content),
+        last_modified=last_modified,
+        expires=time.time() + ttl,
+    ))
+
+
+def proxy_hmac_message(url, args=None):
+    """
+    What /proxy's HMAC signs: the URL, plus the canonical image arguments if
+    there are any, so nobody can ask us for sizes we didn't hand out.
+
+    """
+    if not args:
+        return url
+    return url + "\n" + canonical_query(args)
+
+
+def transform_proxied(content, args):
+    """Resize / reformat a proxied image, returns the new content and its content type"""
+    width, height = get_image_size(content)
+    if (width * height) > MAX_PIXELS:
+        raise ValueError(f"{width}x{height} is too big to resize")
+
+    img = stubbornly_load_image(content, None, None)
+    desired_format = args.get('fm') or extension_to_format(img.format)
+    content = render_image(img, build_pipeline(args), args, desired_format)
+    return content, format_content_type(desired_format)
+
+
+async def fetch_and_transform(image_hmac, upstream, args, ttl):
+    """Download a proxied image, then resize / reformat it once there's a generation slot for it"""
+    content = await run_in_threadpool(b"".join, iter_upstream(upstream))
+    resp = upstream.response
+    async with GENERATION_GATE.slot(generation_priority(args)):
+        transformed, content_type = await run_in_generation_pool(transform_proxied, content, args)
+    entry = ProxyEntry(
+        content=transformed,
+        content_type=content_type,
+        etag=content_etag(transformed),
+        last_modified=resp.headers.get('last-modified'),
+        expires=time.time() + (ttl or 0),
+        upstream_etag=resp.headers.get('etag'),
+    )
+    if ttl is not None:
+        await run_in_threadpool(store_proxied, image_hmac, entry)
+    return entry
+
+
+def proxied_response(request, entry, cache_control=None):
+    if is_not_modified(request, entry.etag, entry.last_modified):
+        return not_modified(entry.etag, entry.last_modified, cache_control)
+    return Response(
+        content=entry.content,
+        media_type=entry.content_type,
+        headers=validator_headers(entry.etag, entry.last_modified, cache_control),
+    )
+
+
 @app.get("/proxy/{image_hmac}")
 async def proxy_that_stuff(
+    request: Request,
     image_hmac: str,
-    url: str = Query(..., description="URL of the image to proxy")
+    url: str = Query(..., description="URL of the image to proxy"),
+    w: Optional[int] = Query(None, description="Width"),
+    h: Optional[int] = Query(None, description="Height"),
+    fm: Optional[str] = Query(None, description="Format: jpg, png, eps"),
+    q: Optional[int] = Query(None, description="Quality (1-100)"),
 ):
     """
     Proxy external images with HMAC validation
@@ -258,48 +1047,517 @@ async def proxy_that_stuff(
         <img src="https://<giraffe>.cloudfront.net/proxy/<HMAC>?url=http://example.com/image.jpg">
     
     HMAC is a hash of a shared secret and the URL using SHA1.
+
+    Proxied images can also be resized and reformatted with ``w``, ``h``,
+    ``fm`` and ``q``, in which case the HMAC covers those too (see
+    ``proxy_hmac_message``).
     """
     if not url:
         raise HTTPException(status_code=404, detail="Oh noes, you didn't give me a url")
-    
+
+    args = canonicalize_args(get_image_args({'w': w, 'h': h, 'fm': fm, 'q': q}))
+
     # Verify HMAC
-    expected_hmac = generate_hmac(url)
+    expected_hmac = generate_hmac(proxy_hmac_message(url, args))
     if expected_hmac != image_hmac:
         raise HTTPException(status_code=404, detail="Oh noes, your key doesn't match!")
 
+    if args.get('w', 1) * args.get('h', 1) > MAX_PIXELS:
+        raise HTTPException(status_code=400, detail="Requested size is too big")
+
+    entry = await run_in_threadpool(get_proxied, image_hmac)
+    if entry is not None and entry.expires > time.time():
+        return proxied_response(request, entry)
+
+    if entry is not None:
+        # revalidate our stale copy
+        upstream_headers = {'If-None-Match': entry.upstream_etag or entry.etag}
+        if entry.last_modified:
+            upstream_headers['If-Modified-Since'] = entry.last_modified
+    else:
+        # pass the client's validators along, if the upstream says nothing
+        # changed we don't need to download the image at all (unless we're
+        # transforming it, then the client's validators are for our copy)
+        upstream_headers = {} if args else conditional_headers(request)
+
     try:
-        resp = requests.get(url)
-        resp.raise_for_status()
-    except requests.RequestException as e:
+        upstream = await run_in_threadpool(open_upstream, url, upstream_headers)
+    except (requests.RequestException, ValueError) as e:
+        if entry is not None:
+            # better an old image than a broken one
+            return proxied_response(request, entry, cache_control=PROXY_STALE_CACHE_CONTROL)
         raise HTTPException(status_code=400, detail=f"Error fetching image: {str(e)}")
-    
-    content_type = resp.headers.get('content-type', 'image/jpeg')
-    return Response(
-        content=resp.content,
-        media_type=content_type,
-        headers={"Cache-Control": CACHE_CONTROL}
+
+    resp = upstream.response
+    etag = resp.headers.get('etag')
+    last_modified = resp.headers.get('last-modified')
+    ttl = upstream_ttl(resp.headers)
+    if resp.status_code == 304:
+        if entry is None:
+            return not_modified(etag, last_modified)
+        entry = entry._replace(expires=time.time() + (ttl or 0))
+        await run_in_threadpool(refresh_proxied, image_hmac, entry)
+        return proxied_response(request, entry)
+
+    if args:
+        try:
+            entry = await fetch_and_transform(image_hmac, upstream, args, ttl)
+        except (ValueError, OSError) as e:
+            raise HTTPException(status_code=400, detail=f"Error resizing image: {str(e)}")
+        return proxied_response(request, entry)
+
+    headers = validator_headers(etag, last_modified)
+    if resp.headers.get('content-length'):
+        headers["Content-Length"] = resp.headers['content-length']
+
+    body = iter_upstream(upstream)
+    background = None
+    # without a bucket, only images small enough for the memory cache are worth keeping
+    limit = None if PROXY_CACHE_BUCKET else PROXY_MEMORY_MAX_ITEM_BYTES
+    length = positive_int_or_none(resp.headers.get('content-length'))
+    if ttl is not None and (limit is None or length is None or length <= limit):
+        kept = []
+        body = iter_and_keep(body, kept, limit)
+        background = BackgroundTask(store_streamed_proxy, image_hmac, kept, upstream.content_type,
+                                    etag, last_modified, ttl)
+    return StreamingResponse(
+        body,
+        media_type=upstream.content_type,
+        headers=headers,
+        background=background,
     )
 
 
+class MockupOverlay(BaseModel):
+    overlay: str
+    bg: Optional[str] = None
+    ox: Optional[int] = None
+    oy: Optional[int] = None
+    ow: Optional[int] = None
+    oh: Optional[int] = None
+
+
+class MockupBatch(BaseModel):
+    overlays: List[MockupOverlay]
+    fm: Optional[str] = None
+    q: Optional[int] = None
+
+
+@app.post("/mockups/{bucket}/{path:path}")
+async def mockups_route(bucket: str, path: str, batch: MockupBatch):
+    """
+    Composite one design onto many overlays at once.
+
+    Each mockup is exactly what ``/<bucket>/<path>?overlay=...`` would
+    return and is written to the same cache key, but the design is only
+    downloaded and decoded once, and only resized once per print area.
+    Returns a manifest of the mockups' URLs and keys.
+
+    """
+    if len(batch.overlays) > MOCKUP_MAX_OVERLAYS:
+        raise HTTPException(status_code=400, detail=f"At most {MOCKUP_MAX_OVERLAYS} overlays per batch")
+
+    dirname = os.path.dirname(path)
+    try:
+        base, ext = os.path.basename(path).split(".")
+    except ValueError:
+        raise HTTPException(status_code=404, detail="no extension specified")
+
+    meta = await run_in_threadpool(get_object_metadata, bucket, path)
+    if not meta:
+        raise original_not_found(path)
+
+    mockups = []
+    for spec in batch.overlays:
+        args = get_image_args({**spec.model_dump(), 'fm': batch.fm, 'q': batch.q})
+        args = canonicalize_args(args, ext)
+        query_args = args
+        names = calculate_cache_keys(dirname, base, ext, args)
+        if VERSIONED_CACHE_KEYS:
+            version = object_version(meta.etag)
+            names = versioned_cache_keys(names, version)
+            query_args = OrderedDict(args, v=version)
+        mockups.append({
+            'overlay': spec.overlay,
+            'url': f"/{bucket}/{path}?{canonical_query(query_args)}",
+            'key': names[0],
+            'args': args,
+            'names': names,
+        })
+
+    found = await asyncio.gather(*(
+        run_in_threadpool(find_variant, bucket, mockup['names']) for mockup in mockups
+    ))
+    misses = []
+    for mockup, hit in zip(mockups, found):
+        mockup['status'] = 'cached' if hit else 'generated'
+        if not hit:
+            misses.append(mockup)
+
+    if misses:
+        async with GENERATION_GATE.slot(generation_priority({}, len(misses)), bucket):
+            original = await run_in_threadpool(get_object_or_none, bucket, path)
+            if not original:
+                ORIGINAL_METADATA.pop((bucket, path))
+                remember_missing(bucket, path)
+                raise original_not_found(path)
+            width, height = await run_in_threadpool(get_image_size, original.content)
+            if (width * height) > MAX_PIXELS:
+                raise HTTPException(status_code=400, detail=f"'{path}' is too big to mock up")
+            # every mockup with the same print area can share one resized design
+            for mockup in misses:
+                mockup['pipeline'] = build_pipeline(mockup['args'])
+                params = mockup['pipeline'][0].params
+                mockup['size'] = overlay_placement(params['w'], params['h'], params['x'], params['y'])[:2]
+            sizes = list({mockup['size'] for mockup in misses})
+
+            # we hold one slot, so that's one resize or render at a time
+            rendering = asyncio.Semaphore(1)
+
+            async def in_turn(func, *args):
+                async with rendering:
+                    return await run_in_generation_pool(func, *args)
+
+            designs = {}
+            try:
+                with await run_in_generation_pool(stubbornly_load_image, original.content, original.headers,
+                                                  path) as design:
+                    for w, h in sizes:
+                        designs[w, h] = track_image(design.clone())
+                await asyncio.gather(*(in_turn(resize_design, designs[size], *size) for size in sizes))
+
+                default_format = path_to_format(path)
+                results = await asyncio.gather(*(
+                    in_turn(render_mockup, bucket, designs[mockup['size']], mockup, default_format)
+                    for mockup in misses
+                ), return_exceptions=True)
+            finally:
+                for resized in designs.values():
+                    close_image(resized)
+            for mockup, result in zip(misses, results):
+                if isinstance(result, Exception):
+                    mockup['status'] = 'error'
+                    mockup['error'] = str(result)
+
+    return {
+        'original': f"/{bucket}/{path}",
+        'mockups': [
+            {k: mockup[k] for k in ('overlay', 'url', 'key', 'status', 'error') if k in mockup}
+            for mockup in mockups
+        ],
+    }
+
+
+def sprite_cache_key(bucket, paths, w, h, cols):
+    """Sprites are cached under a digest of everything that goes into them"""
+    source = "\n".join([bucket, f"{w}x{h}", str(cols), *paths])
+    digest = hashlib.sha256(source.encode()).hexdigest()[:CACHE_KEY_DIGEST_LENGTH]
+    return os.path.join(CACHE_DIR, "sprites", digest[:2], digest)
+
+
+def sprite_thumbnail(obj, path, w, h):
+    """Crop a downloaded original to fill a ``w`` x ``h`` cell, None if we can't"""
+    width, height = get_image_size(obj.content)
+    if (width * height) > MAX_PIXELS:
+        return None
+    img = stubbornly_load_image(obj.content, obj.headers, path)
+    return process_image(img, build_pipeline({'w': w, 'h': h, 'fit': 'crop'}))
+
+
+def build_sprite(paths, w, h, cols, thumbnails, fmt):
+    """
+    Pack thumbnails into a grid ``cols`` wide, returns the encoded sprite and
+    a map of where each path ended up (None for the ones we couldn't load).
+
+    """
+    rows = -(-len(paths) // cols)
+    background = Color('white') if fmt == 'jpg' else Color('transparent')
+    coordinates = OrderedDict()
+    with Image(width=w * cols, height=h * rows, background=background) as sprite:
+        for i, (path, thumbnail) in enumerate(zip(paths, thumbnails)):
+            if thumbnail is None:
+                coordinates[path] = None
+                continue
+            x, y = (i % cols) * w, (i // cols) * h
+            sprite.composite(thumbnail, x, y)
+            coordinates[path] = {'x': x, 'y': y, 'w': w, 'h': h}
+        content = encode_image(sprite, fmt)
+    sprite_map = {
+        'width': w * cols,
+        'height': h * rows,
+        'images': coordinates,
+    }
+    return content, sprite_map
+
+
+@app.get("/sprites/{bucket}.{ext}")
+async def sprite_route(
+    request: Request,
+    bucket: str,
+    ext: str,
+    paths: List[str] = Query(..., description="Paths of the images to include, in order"),
+    w: int = Query(64, description="Cell width"),
+    h: int = Query(64, description="Cell height"),
+    cols: Optional[int] = Query(None, description="Cells per row, defaults to a square-ish grid"),
+    force: Optional[bool] = Query(False, description="Force regeneration"),
+):
+    """
+    Pack many images into one sprite sheet, each cropped to fill a ``w`` x
+    ``h`` cell.  ``/sprites/<bucket>.png`` (or ``.jpg``) is the image and
+    ``/sprites/<bucket>.json`` the map of where each path is in it.
+
+    Both are cached in the bucket under a digest of the request.
+
+    """
+    if ext not in ('png', 'jpg', 'json'):
+        raise HTTPException(status_code=404, detail=f"I don't know how to make .{ext} sprites")
+    if not paths or len(paths) > SPRITE_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Sprites need 1 to {SPRITE_MAX_IMAGES} paths")
+    if w <= 0 or h <= 0:
+        raise HTTPException(status_code=400, detail="Cells need a width and a height")
+    if cols is not None and cols < 1:
+        raise HTTPException(status_code=400, detail="Sprites need at least one column")
+    cols = min(cols or math.ceil(math.sqrt(len(paths))), len(paths))
+    rows = -(-len(paths) // cols)
+    if (w * cols) * (h * rows) > MAX_PIXELS:
+        raise HTTPException(status_code=400, detail="Requested sprite is too big")
+
+    key = sprite_cache_key(bucket, paths, w, h, cols)
+    if not force:
+        response = await run_in_threadpool(serve_object, bucket, f"{key}.{ext}", request)
+        if response is not None:
+            return response
+
+    async with GENERATION_GATE.slot(generation_priority({'w': w, 'h': h}, len(paths)), bucket):
+        fetching = asyncio.Semaphore(SPRITE_FETCH_CONCURRENCY)
+        # we hold one slot, so that's one image's worth of decoding at a time
+        decoding = asyncio.Semaphore(1)
+
+        async def thumbnail(path):
+            async with fetching:
+                obj = await run_in_threadpool(get_object_or_none, bucket, path)
+                if obj is None:
+                    return None
+                async with decoding:
+                    return await run_in_generation_pool(sprite_thumbnail, obj, path, w, h)
+
+        # one image we can't load just leaves a blank cell, and the others can still be closed
+        thumbnails = await asyncio.gather(*(thumbnail(path) for path in paths), return_exceptions=True)
+        for i, thumbnail in enumerate(thumbnails):
+            if isinstance(thumbnail, BaseException):
+                print(f"couldn't add {paths[i]} to a sprite: {thumbnail!r}")
+                thumbnails[i] = None
+        fmt = 'png' if ext == 'json' else ext
+        try:
+            content, sprite_map = await run_in_generation_pool(build_sprite, paths, w, h, cols, thumbnails, fmt)
+        finally:
+            for thumbnail in thumbnails:
+                close_image(thumbnail)
+        sprite_json = json.dumps(sprite_map).encode()
+        complete = None not in thumbnails
+
+        def upload():
+            s3.upload(f"{key}.{fmt}", BytesIO(content), bucket=bucket,
+                      content_type=f"image/{normalize_mimetype(fmt)}", public=True)
+            s3.upload(f"{key}.json", BytesIO(sprite_json), bucket=bucket,
+                      content_type="application/json", public=True)
+        if complete:
+            await run_in_threadpool(upload)
+
+    if ext == 'json':
+        content, content_type = sprite_json, "application/json"
+    else:
+        content_type = f"image/{normalize_mimetype(fmt)}"
+    etag = content_etag(content)
+    headers = validator_headers(etag, cache_control=None if complete else SPRITE_INCOMPLETE_CACHE_CONTROL)
+    return Response(content=content, media_type=content_type, headers=headers)
+
+
+class BulkItem(BaseModel):
+    bucket: str
+    path: str
+    params: Dict[str, Union[int, str]] = {}
+
+
+class BulkRequest(BaseModel):
+    items: List[BulkItem]
+    format: Literal['multipart', 'zip'] = 'multipart'
+
+
+BulkResult = namedtuple("BulkResult", 'index url name status content_type content')
+
+
+async def response_body(response):
+    """Read a whole response's body, streamed or not"""
+    if hasattr(response, 'body_iterator'):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    if response.background is not None:
+        # e.g. storing a slow seam carve, which we'd otherwise never do
+        await response.background()
+    return response.body
+
+
+async def resolve_bulk_item(index, item):
+    """Get (or generate) one variant for /bulk, errors included"""
+    dirname = os.path.dirname(item.path)
+    name = os.path.basename(item.path)
+    url = f"/{item.bucket}/{item.path}"
+    filename = f"{item.bucket}/{item.path}"
+    try:
+        try:
+            base, ext = name.split(".")
+        except ValueError:
+            raise HTTPException(status_code=404, detail="no extension specified")
+
+        args = canonicalize_args(get_image_args(item.params), ext)
+        if any(args.values()):
+            url += "?" + canonical_query(args)
+            param_name, *fallback_names = calculate_cache_keys(dirname, base, ext, args)
+            filename = f"{item.bucket}/{os.path.relpath(calculate_new_path(dirname, base, ext, args), CACHE_DIR)}"
+            # a stand in would look just like the real thing in the results, so don't make one
+            response = await get_file_with_params_or_404(item.bucket, item.path, param_name, args, False,
+                                                         fallback_names=fallback_names, degrade=False)
+        else:
+            response = await get_file_or_404(item.bucket, item.path)
+        content = await response_body(response)
+    except HTTPException as e:
+        return BulkResult(index, url, filename, e.status_code, "text/plain", str(e.detail).encode())
+    except Exception as e:
+        print(e)
+        return BulkResult(index, url, filename, 500, "text/plain", str(e).encode())
+    return BulkResult(index, url, filename, 200, response.media_type, content)
+
+
+async def bulk_results(items):
+    """Resolve ``items``, at most ``BULK_CONCURRENCY`` at once, yielding them as they finish"""
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def resolve(index, item):
+        async with semaphore:
+            return await resolve_bulk_item(index, item)
+
+    tasks = [asyncio.ensure_future(resolve(index, item)) for index, item in enumerate(items)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # the client went away, don't keep generating images for nobody
+        for task in tasks:
+            task.cancel()
+
+
+async def bulk_multipart(results, boundary):
+    async for result in results:
+        headers = [
+            f"--{boundary}",
+            f"Content-Type: {result.content_type}",
+            f"Content-Location: {result.url}",
+            f"Content-Length: {len(result.content)}",
+            f"X-Giraffe-Index: {result.index}",
+            f"X-Giraffe-Status: {result.status}",
+        ]
+        yield ("\r\n".join(headers) + "\r\n\r\n").encode() + result.content + b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+class ZipStream(object):
+    """Just enough of a file for ``zipfile`` to write an archive we can send as it grows"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+async def bulk_zip(results):
+    stream = ZipStream()
+    manifest = []
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        async for result in results:
+            entry = {'index': result.index, 'url': result.url, 'status': result.status}
+            if result.status == 200:
+                entry['name'] = result.name
+                archive.writestr(result.name, result.content)
+            else:
+                entry['error'] = result.content.decode()
+            manifest.append(entry)
+            yield stream.drain()
+        archive.writestr("manifest.json", json.dumps(sorted(manifest, key=lambda e: e['index'])))
+    yield stream.drain()
+
+
+@app.post("/bulk")
+async def bulk_route(bulk: BulkRequest):
+    """
+    Fetch lots of variants in one request.  Cache hits and misses are
+    resolved (and generated) concurrently and streamed back as they're
+    ready, either as ``multipart/mixed`` parts or as entries in a ZIP.
+
+    """
+    if len(bulk.items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} items per request")
+
+    results = bulk_results(bulk.items)
+    if bulk.format == 'zip':
+        return StreamingResponse(bulk_zip(results), media_type="application/zip",
+                                 headers={"Content-Disposition": 'attachment; filename="giraffe.zip"'})
+    boundary = hashlib.md5(os.urandom(16)).hexdigest()
+    return StreamingResponse(bulk_multipart(results, boundary),
+                             media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def metrics_hmac():
+    return generate_hmac("/_giraffe/metrics")
+
+
+@app.get("/_giraffe/metrics/{key}")
+async def metrics_route(key: str):
+    """
+    Generation slots in use and waiting, what each bucket has been up to,
+    ImageMagick's resource limits and usage, and (with ``TRACK_IMAGES``) the
+    images requests have opened and leaked.
+
+    Bucket names and load aren't for everyone, so ``key`` has to be
+    ``metrics_hmac()``.
+
+    """
+    if not hmac.compare_digest(key, metrics_hmac()):
+        raise HTTPException(status_code=404, detail="Oh noes, your key doesn't match!")
+    return dict(GENERATION_GATE.metrics(), magick=magick_metrics(), images=IMAGE_STATS)
+
+
 @app.get("/{bucket}/{path:path}")
 async def image_route(
+    request: Request,
     bucket: str,
     path: str,
     # Query parameters for image processing
     w: Optional[int] = Query(None, description="Width"),
     h: Optional[int] = Query(None, description="Height"),
+    rect: Optional[str] = Query(None, description="Region of the original to use: x,y,w,h"),
     fit: Optional[str] = Query(None, description="Fit mode: crop, liquid"),
     flip: Optional[str] = Query(None, description="Flip: h, v, hv"),
     rot: Optional[int] = Query(None, description="Rotation in degrees"),
     fm: Optional[str] = Query(None, description="Format: jpg, png, eps"),
     q: Optional[int] = Query(None, description="Quality (1-100)"),
+    fps: Optional[int] = Query(None, description="Maximum frame rate of animations"),
     bg: Optional[str] = Query(None, description="Background color"),
     overlay: Optional[str] = Query(None, description="Overlay path"),
     ox: Optional[int] = Query(None, description="Overlay X offset"),
     oy: Optional[int] = Query(None, description="Overlay Y offset"),
     ow: Optional[int] = Query(None, description="Overlay width"),
     oh: Optional[int] = Query(None, description="Overlay height"),
-    force: Optional[bool] = Query(False, description="Force regeneration")
+    force: Optional[bool] = Query(False, description="Force regeneration"),
+    v: Optional[str] = Query(None, description="Version of the original, makes the response immutable")
 ):
     """Main image processing route"""
     dirname = os.path.dirname(path)
@@ -312,16 +1570,25 @@ async def image_route(
 
     # Build image processing arguments
     args = get_image_args({
-        'w': w, 'h': h, 'fit': fit, 'flip': flip, 'rot': rot,
-        'fm': fm, 'q': q, 'bg': bg, 'overlay': overlay,
+        'rect': rect, 'w': w, 'h': h, 'fit': fit, 'flip': flip, 'rot': rot,
+        'fm': fm, 'q': q, 'fps': fps, 'bg': bg, 'overlay': overlay,
         'ox': ox, 'oy': oy, 'ow': ow, 'oh': oh
     })
-    
+    args = canonicalize_args(args, ext)
+
+    if CANONICAL_REDIRECT and not force:
+        query = canonical_query(OrderedDict(args, v=v) if v else args)
+        if query != request.url.query:
+            url = request.url.path + ("?" + query if query else "")
+            return RedirectResponse(url, status_code=301, headers={"Cache-Control": CACHE_CONTROL})
+
     if any(args.values()):
-        param_name = calculate_new_path(dirname, base, ext, args)
-        return await get_file_with_params_or_404(bucket, path, param_name, args, force)
+        param_name, *fallback_names = calculate_cache_keys(dirname, base, ext, args)
+        return await get_file_with_params_or_404(bucket, path, param_name, args, force,
+                                                 fallback_names=fallback_names, version=v,
+                                                 request=request)
     else:
-        return await get_file_or_404(bucket, path)
+        return await get_file_or_404(bucket, path, request=request, force=force)
 
 
 def calculate_new_path(dirname, base, ext, args):
@@ -345,15 +1612,60 @@ def calculate_new_path(dirname, base, ext, args):
     return param_name
 
 
-def positive_int_or_none(value):
-    try:
-        value = int(value)
-        if value >= 0:
-            return value
-        else:
-            return None
-    except ValueError:
-        return None
+def calculate_hashed_path(dirname, base, ext, args):
+    """
+    Build a compact, fixed-length cache key from a digest of the original's
+    path and its canonical arguments.  The first characters of the digest
+    are used as prefixes so variants are spread evenly across S3 partitions
+    instead of piling up under one directory:
+
+      giraffe/3f/a2/3fa2...c1.jpg
+
+    """
+    source = "{}/{}.{}?{}".format(dirname, base, ext, canonical_query(args))
+    digest = hashlib.sha256(source.encode()).hexdigest()[:CACHE_KEY_DIGEST_LENGTH]
+
+    fmt = args.get('fm')
+    if fmt:
+        ext = FORMAT_MAP[fmt]['extension']
+
+    return os.path.join(CACHE_DIR, digest[:2], digest[2:4], digest + "." + ext)
+
+
+def calculate_cache_keys(dirname, base, ext, args):
+    """
+    Returns the keys to look for a cached variant under, in order.  The
+    first key is where newly generated variants are written.
+
+    """
+    if CACHE_KEY_SCHEME == 'hashed':
+        return [calculate_hashed_path(dirname, base, ext, args)]
+    elif CACHE_KEY_SCHEME == 'migrate':
+        return [calculate_hashed_path(dirname, base, ext, args),
+                calculate_new_path(dirname, base, ext, args)]
+    return [calculate_new_path(dirname, base, ext, args)]
+
+
+def parse_rect(value):
+    """Parse a ``rect=x,y,w,h`` region, raising a 400 if it isn't one"""
+    try:
+        x, y, w, h = (int(n) for n in value.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'"{value}" is not a valid rect, use x,y,w,h')
+    if x < 0 or y < 0 or w <= 0 or h <= 0:
+        raise HTTPException(status_code=400, detail=f'"{value}" is not a valid rect, use x,y,w,h')
+    return x, y, w, h
+
+
+def positive_int_or_none(value):
+    try:
+        value = int(value)
+        if value >= 0:
+            return value
+        else:
+            return None
+    except ValueError:
+        return None
     except TypeError:
         return None
 
@@ -367,20 +1679,103 @@ def get_image_args(request_args):
         if value is None:
             continue
             
-        if key in ['w', 'h', 'rot', 'q', 'ox', 'oy', 'ow', 'oh']:
+        if key in ['w', 'h', 'rot', 'q', 'fps', 'ox', 'oy', 'ow', 'oh']:
             processed_value = positive_int_or_none(value)
             if processed_value is not None:
                 image_args[key] = processed_value
-        elif key in ['fit', 'flip', 'fm', 'bg', 'overlay']:
+        elif key in ['rect', 'fit', 'flip', 'fm', 'bg', 'overlay']:
             if value:
                 image_args[key] = value
     
     return image_args
 
 
-def get_object_or_none(bucket, path):
+def canonicalize_args(args, ext=None):
+    """
+    Reduce image arguments to a single canonical form so that equivalent
+    requests share one cache key (and one CloudFront object):
+
+      fm=jpeg -> fm=jpg
+      flip=vh -> flip=hv
+      rot=0   -> (dropped)
+      q=75    -> (dropped, it's the default)
+
+    Arguments that don't change the output (``fit`` without both ``w`` and
+    ``h``, ``bg`` and overlay offsets without an ``overlay``) are dropped and
+    the rest are ordered by ``CANONICAL_ARGS``.
+
+    Defaults are only dropped when something else is being asked for, as
+    ``?q=75`` or ``?fm=jpg`` on their own still mean "re-encode the original".
+
+    """
+    try:
+        default_format = extension_to_format(ext)
+    except ValueError:
+        default_format = None
+
+    canonical = OrderedDict()
+    defaults = OrderedDict()
+    for key in CANONICAL_ARGS:
+        value = args.get(key)
+        if value is None:
+            continue
+        if key in OVERLAY_ARGS and not args.get('overlay'):
+            continue
+
+        if key == 'fit':
+            if value not in FIT_MODES or 'w' not in args or 'h' not in args:
+                continue
+        elif key == 'flip':
+            value = "".join(c for c in "hv" if c in value)
+            if not value:
+                continue
+        elif key in ('rot', 'fps'):
+            if not value:
+                continue
+        elif key == 'rect':
+            value = ",".join(str(n) for n in parse_rect(value))
+        elif key == 'fm':
+            value = value.lower()
+            if value not in FORMAT_MAP:
+                raise HTTPException(status_code=400, detail=f'"{value}" is not a supported format')
+            if value in VIDEO_FORMATS and not FFMPEG:
+                raise HTTPException(status_code=400, detail=f'"{value}" output isn\'t available here')
+            value = FORMAT_MAP[value]['extension']
+            if value == default_format:
+                defaults[key] = value
+                continue
+        elif key == 'q':
+            if value == DEFAULT_QUALITY:
+                defaults[key] = value
+                continue
+        elif key == 'bg':
+            value = value.lower().lstrip("#")
+
+        canonical[key] = value
+
+    if not canonical:
+        return defaults
+    return canonical
+
+
+def canonical_query(args):
+    return parse.urlencode(args, safe="/:")
+
+
+def get_object_or_none(bucket, path, headers=None):
+    try:
+        obj = s3.get(path, bucket=bucket, headers=headers)
+    except HTTPError as error:
+        if error.response.status_code == 404:
+            return None
+        else:
+            raise
+    return obj
+
+
+def head_object_or_none(bucket, path):
     try:
-        obj = s3.get(path, bucket=bucket)
+        obj = s3.head_object(path, bucket=bucket)
     except HTTPError as error:
         if error.response.status_code == 404:
             return None
@@ -389,100 +1784,560 @@ def get_object_or_none(bucket, path):
     return obj
 
 
-async def get_file_or_404(bucket, path):
-    """Get file from S3 or raise 404"""
-    key = get_object_or_none(bucket, path)
-    if key:
-        content_type = key.headers.get('content-type', 'image/jpeg')
-        return Response(
-            content=key.content,
-            media_type=content_type,
-            headers={"Cache-Control": CACHE_CONTROL}
-        )
+def object_metadata(headers):
+    return ObjectMeta(
+        etag=headers.get('etag'),
+        last_modified=headers.get('last-modified'),
+        content_type=headers.get('content-type'),
+        size=positive_int_or_none(headers.get('content-length')),
+    )
+
+
+def get_object_metadata(bucket, path, refresh=False):
+    """
+    HEAD an object, remembering the answer for ``METADATA_TTL`` seconds so
+    that looking up a variant doesn't cost a round trip to S3 for its
+    original every time.
+
+    """
+    if not refresh:
+        meta = ORIGINAL_METADATA.get((bucket, path))
+        if meta is not None:
+            return meta
+        if known_missing(bucket, path):
+            return None
+
+    obj = head_object_or_none(bucket, path)
+    if obj is None:
+        ORIGINAL_METADATA.pop((bucket, path))
+        remember_missing(bucket, path)
+        return None
+    if refresh:
+        forget_missing(bucket, path)
+    meta = object_metadata(obj.headers)
+    ORIGINAL_METADATA.set((bucket, path), meta)
+    return meta
+
+
+def object_version(etag):
+    """
+    Turn an S3 ETag (e.g. ``"9b2cf535f27731c974343645a3985328"``) into
+    a short version string that's safe to put in keys and URLs.
+
+    """
+    if not etag:
+        return None
+    return re.sub(r'[^0-9a-zA-Z]', '', etag)[:VERSION_LENGTH] or None
+
+
+def versioned_cache_key(name, version):
+    """
+    giraffe/foo/bar_w100.jpg -> giraffe/foo/bar_w100_v9b2cf535f27731c9.jpg
+    """
+    if not version:
+        return name
+    root, ext = os.path.splitext(name)
+    return f"{root}_v{version}{ext}"
+
+
+def versioned_cache_keys(names, version):
+    """
+    Version the keys from ``calculate_cache_keys``.  When migrating, the
+    variant may also have been cached before keys were versioned, so the
+    unversioned legacy keys are looked under last.
+
+    """
+    keys = [versioned_cache_key(name, version) for name in names]
+    if CACHE_KEY_SCHEME == 'migrate':
+        keys += names[1:]
+    return keys
+
+
+def iter_object_range(bucket, path, first_chunk, start, end, etag=None):
+    """
+    Yield bytes ``start`` to ``end`` (inclusive) of an object, one ranged GET
+    of ``STREAM_CHUNK_SIZE`` at a time, starting with the chunk we already
+    have in hand.
+
+    """
+    yield first_chunk
+    position = start + len(first_chunk)
+    while position <= end:
+        headers = {'Range': f"bytes={position}-{min(position + STREAM_CHUNK_SIZE - 1, end)}"}
+        if etag:
+            # don't stitch together two different versions of the object
+            headers['If-Match'] = etag
+        chunk = get_object_or_none(bucket, path, headers=headers)
+        if chunk is None or not chunk.content:
+            return
+        yield chunk.content
+        position += len(chunk.content)
+
+
+def object_size(bucket, path):
+    """How many bytes are in an object (0 if S3 didn't say), None if it doesn't exist"""
+    obj = head_object_or_none(bucket, path)
+    if obj is None:
+        return None
+    return object_metadata(obj.headers).size or 0
+
+
+def serve_object(bucket, path, request=None, cache_control=None, ranges=True):
+    """
+    Respond with an object straight out of S3, reading it in ranged chunks so
+    we never hold more than ``STREAM_CHUNK_SIZE`` of it in memory.  The
+    client's validators are checked by S3 and single byte ranges are
+    answered with a ``206``.
+
+    Returns None if the object doesn't exist.
+
+    """
+    byte_range = parse_range(request.headers.get('range')) if (request is not None and ranges) else None
+    if byte_range and byte_range[0] < 0:
+        # suffix ranges need to know how big the object is.  This may well be a variant
+        # that isn't there yet, so not get_object_metadata, which would take a 404 to
+        # mean the original's missing
+        size = object_size(bucket, path)
+        if size is None:
+            return None
+        byte_range = (max(size + byte_range[0], 0), None) if size else None
+
+    start, end = byte_range or (0, None)
+    chunk_end = start + STREAM_CHUNK_SIZE - 1
+    if end is not None:
+        chunk_end = min(chunk_end, end)
+
+    headers = conditional_headers(request)
+    headers['Range'] = f"bytes={start}-{chunk_end}"
+    try:
+        key = get_object_or_none(bucket, path, headers=headers)
+    except HTTPError as error:
+        if error.response.status_code == 416:
+            size = content_range_length(error.response.headers.get('content-range')) or object_size(bucket, path)
+            headers = {"Accept-Ranges": "bytes"}
+            if size is not None:
+                headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        raise
+    if not key:
+        return None
+
+    etag = key.headers.get('etag')
+    last_modified = key.headers.get('last-modified')
+    if key.status_code == 304:
+        return not_modified(etag, last_modified, cache_control)
+    if byte_range and not if_range_matches(request, etag, last_modified):
+        return serve_object(bucket, path, request, cache_control, ranges=False)
+
+    content_type = key.headers.get('content-type', 'image/jpeg')
+    response_headers = validator_headers(etag, last_modified, cache_control)
+    response_headers["Accept-Ranges"] = "bytes"
+
+    total = content_range_length(key.headers.get('content-range')) if key.status_code == 206 else None
+    if total is None or (not byte_range and total <= len(key.content)):
+        # we got the whole thing in one go
+        return Response(content=key.content, media_type=content_type, headers=response_headers)
+
+    if byte_range:
+        status_code = 206
+        end = total - 1 if end is None else min(end, total - 1)
+        response_headers["Content-Range"] = f"bytes {start}-{end}/{total}"
     else:
-        raise HTTPException(status_code=404, detail=f"404: file '{path}' doesn't exist")
+        status_code = 200
+        end = total - 1
+    response_headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_object_range(bucket, path, key.content, start, end, etag),
+        status_code=status_code,
+        media_type=content_type,
+        headers=response_headers,
+    )
 
 
-def overlay_that(img, bucket=None, path=None, overlay=None, bg=None, w=None, h=None, x=None, y=None):
+def serve_original(bucket, path, request=None, force=False):
+    """
+    ``serve_object`` for originals, remembering which ones don't exist.
+    ``force`` asks S3 even if we think it's missing.
+
+    """
+    if not force and known_missing(bucket, path):
+        return None
+    response = serve_object(bucket, path, request)
+    if response is None:
+        remember_missing(bucket, path)
+    elif force:
+        forget_missing(bucket, path)
+    return response
+
+
+async def get_file_or_404(bucket, path, request=None, force=False):
+    """Get file from S3 or raise 404"""
+    response = await run_in_threadpool(serve_original, bucket, path, request, force)
+    if response is None:
+        raise HTTPException(status_code=404, detail=f"404: file '{path}' doesn't exist",
+                            headers={"Cache-Control": NOT_FOUND_CACHE_CONTROL})
+    return response
+
+
+def image_weight(img):
+    """Roughly how much memory an image's pixels take up"""
+    return img.width * img.height * PIXEL_BYTES
+
+
+# The images opened by the request we're serving, when TRACK_IMAGES is on
+IMAGE_TRACKER = contextvars.ContextVar("giraffe_image_tracker", default=None)
+IMAGE_STATS = {'requests': 0, 'opened': 0, 'leaked': 0, 'leaked_bytes': 0, 'max_request_bytes': 0}
+
+
+def track_image(img):
+    """Note an image the current request has opened, and hand it back"""
+    tracker = IMAGE_TRACKER.get()
+    if tracker is not None:
+        tracker.append((img, image_weight(img)))
+    return img
+
+
+def untrack_image(img):
+    """Stop tracking an image that's meant to outlive the request, like a cached overlay"""
+    tracker = IMAGE_TRACKER.get()
+    if tracker is not None:
+        tracker[:] = [(tracked, weight) for tracked, weight in tracker if tracked is not img]
+    return img
+
+
+def image_closed(img):
+    try:
+        img.wand
+    except wand.resource.DestroyedResourceError:
+        return True
+    return False
+
+
+def close_image(img):
+    """Free an image's pixels now, rather than whenever it's garbage collected"""
+    if img is not None and not image_closed(img):
+        img.close()
+
+
+def report_image_leaks(path, tracker):
+    """Count (and complain about) the images a request left open"""
+    leaked = [(img, weight) for img, weight in tracker if not image_closed(img)]
+    IMAGE_STATS['requests'] += 1
+    IMAGE_STATS['opened'] += len(tracker)
+    IMAGE_STATS['max_request_bytes'] = max(IMAGE_STATS['max_request_bytes'],
+                                           sum(weight for img, weight in tracker))
+    if leaked:
+        leaked_bytes = sum(weight for img, weight in leaked)
+        IMAGE_STATS['leaked'] += len(leaked)
+        IMAGE_STATS['leaked_bytes'] += leaked_bytes
+        print(f"{path} leaked {len(leaked)} images ({leaked_bytes} bytes of pixels)")
+    return leaked
+
+
+class ImageTracking(object):
+    """
+    Middleware that tracks the images each request opens when
+    ``TRACK_IMAGES`` is on, and reports the ones still open once it's done
+    (background tasks included).
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not TRACK_IMAGES:
+            return await self.app(scope, receive, send)
+        tracker = []
+        token = IMAGE_TRACKER.set(tracker)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            IMAGE_TRACKER.reset(token)
+            report_image_leaks(scope['path'], tracker)
+
+
+app.add_middleware(ImageTracking)
+
+
+class SharedImage(object):
+    """
+    An image kept for many requests at once.  MagickWands aren't safe to use
+    from more than one thread, even just to read, so each request gets its
+    own ``copy()``, and the original is closed when its cache lets go of it.
+
+    """
+
+    def __init__(self, img):
+        self.img = img
+        self.lock = threading.Lock()
+
+    def copy(self):
+        """A copy of the image for the caller to close, or None if it's been closed already"""
+        with self.lock:
+            if image_closed(self.img):
+                return None
+            return track_image(self.img.clone())
+
+    def close(self):
+        with self.lock:
+            close_image(self.img)
+
+    def weight(self):
+        return image_weight(self.img)
+
+
+PREPARED_OVERLAYS = TTLCache(OVERLAY_CACHE_SIZE, maxweight=OVERLAY_CACHE_BYTES, weigh=SharedImage.weight,
+                             dispose=SharedImage.close)
+
+
+def prepare_overlay(bucket=None, path=None, overlay=None, bg=None):
+    """
+    Get the decoded overlay and a blank ``bg`` background the size of it.
+
+    Both are cached (keyed on the overlay's ETag, so replacing an overlay in
+    S3 replaces it here too), and the caller gets its own copies to close.
+    Overlays from other sites don't have an ETag we can check cheaply, so
+    they're just refetched every ``METADATA_TTL``.
+
+    """
     if bucket:
-        key = get_object_or_none(bucket, path)
-        overlay_content = key.content
+        meta = get_object_metadata(bucket, path)
+        key, ttl = (overlay, meta and meta.etag), None
     else:
+        key, ttl = (overlay, None), METADATA_TTL
+
+    shared = PREPARED_OVERLAYS.get(key)
+    overlay_img = shared.copy() if shared is not None else None
+    if overlay_img is None:
+        if bucket:
+            obj = get_object_or_none(bucket, path)
+            overlay_content = obj.content if obj is not None else None
+        else:
+            try:
+                resp = requests.get(overlay)
+            except (ConnectionError) as e:
+                print(e)
+                raise
+            else:
+                overlay_content = resp.content
+
+        if not overlay_content:
+            raise Exception(f"Couldn't find an overlay file for bucket '{bucket}' and path '{path}' (overlay='{overlay}')")
+        decoded = untrack_image(stubbornly_load_image(overlay_content, None, None))
+        overlay_img = track_image(decoded.clone())
+        PREPARED_OVERLAYS.set(key, SharedImage(decoded), ttl=ttl)
+
+    canvas_key = key + (bg,)
+    shared = PREPARED_OVERLAYS.get(canvas_key)
+    canvas = shared.copy() if shared is not None else None
+    if canvas is None:
         try:
-            resp = requests.get(overlay)
-        except (ConnectionError) as e:
-            print(e)
+            blank = Image(width=overlay_img.width, height=overlay_img.height, background=Color('#' + bg))
+        except BaseException:
+            close_image(overlay_img)
             raise
-        else:
-            overlay_content = resp.content
+        canvas = track_image(blank.clone())
+        PREPARED_OVERLAYS.set(canvas_key, SharedImage(blank), ttl=ttl)
+    return overlay_img, canvas
+
+
+def overlay_placement(w=None, h=None, x=None, y=None):
+    """Where a design goes on its overlay, defaulting to our t-shirt template's print area"""
+    if w is not None and h is not None and x is not None and y is not None:
+        return w, h, x, y
+    return 294, 336, 489, 173
+
 
-    if overlay_content:
-        if w is not None and h is not None and x is not None and y is not None:
-            pass
+def resize_design(img, w, h):
+    size = f"{w}x{h}^"
+    img.transform(resize=size)
+    return img
+
+
+def composite_overlay(design, overlay_img, canvas, x, y):
+    """Put ``design`` on ``canvas`` under ``overlay_img``, both from ``prepare_overlay`` and both used up"""
+    try:
+        canvas.composite(design, x, y)
+        canvas.composite(overlay_img, 0, 0)
+    except BaseException:
+        close_image(canvas)
+        raise
+    finally:
+        close_image(overlay_img)
+    return canvas
+
+
+def overlay_that(img, bucket=None, path=None, overlay=None, bg=None, w=None, h=None, x=None, y=None):
+    w, h, x, y = overlay_placement(w, h, x, y)
+    design = resize_design(img, w, h)
+    return composite_overlay(design, *prepare_overlay(bucket, path, overlay, bg), x, y)
+
+
+def subsample_frames(delays, fps=None, max_frames=None):
+    """
+    Pick the frames of an animation to keep so it plays at no more than
+    ``fps`` frames per second, with no more than ``max_frames`` frames.
+
+    Delays are in 1/100ths of a second, and a dropped frame's delay is added
+    to the frame before it so the animation still runs at the same speed.
+    Returns a list of ``(index, delay)`` pairs.
+
+    """
+    interval = 100.0 / fps if fps else 0
+    kept = []
+    for index, delay in enumerate(delays):
+        if kept and kept[-1][1] < interval:
+            kept[-1][1] += delay
         else:
-            w, h, x, y = 294, 336, 489, 173
+            kept.append([index, delay])
+
+    if max_frames and len(kept) > max_frames:
+        step = math.ceil(len(kept) / max_frames)
+        thinned = []
+        for i, (index, delay) in enumerate(kept):
+            if i % step:
+                thinned[-1][1] += delay
+            else:
+                thinned.append([index, delay])
+        kept = thinned
+    return [tuple(frame) for frame in kept]
 
-        image_orientation = 'square'
-        overlay_orientation = 'square'
 
-        if img.width > img.height:
-            image_orientation = 'landscape'
-        elif img.width < img.height:
-            image_orientation = 'portrait'
+def coalesce_frames(img, kept):
+    """
+    Flatten just the frames in ``kept`` (``(index, delay)`` pairs, as from
+    ``subsample_frames``) into a new animation of full canvases.
 
-        overlay_img = stubbornly_load_image(overlay_content, None, None)
+    Frames are drawn onto a single running canvas, so only it (and, for
+    frames disposed to 'previous', the canvas to go back to) is held at full
+    size alongside the frames we keep.
 
-        if overlay_img.width > overlay_img.height:
-            overlay_orientation = 'landscape'
-        elif overlay_img.width < overlay_img.height:
-            overlay_orientation = 'portrait'
+    """
+    keep = dict(kept)
+    width = img.page_width or img.width
+    height = img.page_height or img.height
+    result = track_image(Image())
+    canvas = Image(width=width, height=height, background=Color('transparent'))
+    try:
+        for index in range(len(img.sequence)):
+            frame = img.sequence[index]
+            dispose = frame.dispose
+            previous = canvas.clone() if dispose == 'previous' else None
+            canvas.composite(frame, frame.page_x, frame.page_y)
+            if index in keep:
+                result.sequence.append(canvas)
+                result.sequence[-1].delay = keep[index]
+            if dispose == 'background':
+                with Image(width=frame.width, height=frame.height, background=Color('transparent')) as blank:
+                    canvas.composite(blank, frame.page_x, frame.page_y, operator='copy')
+            elif previous is not None:
+                canvas.close()
+                canvas = previous
+    except BaseException:
+        close_image(result)
+        raise
+    finally:
+        canvas.close()
+    result.format = img.format
+    result.loop = img.loop
+    return result
+
+
+def prepare_animation(img, fps=None):
+    """
+    Flatten an animation's frames into full canvases, once, so each one can
+    be resized on its own, and drop any frames we don't need.
 
-        overlay_width, overlay_height = overlay_img.width, overlay_img.height
-        width, height = w, h
-        size = f"{width}x{height}^"
-        img.transform(resize=size)
-        c = Color('#' + bg)
-        background = Image(width=overlay_width, height=overlay_height, background=c)
-        background.composite(img, x, y)
-        img = background
-        img.composite(overlay_img, 0, 0)
+    The frames to keep are picked from the delays first, so when some are
+    dropped we never hold every full canvas at once.  Returns the prepared
+    animation, which is a new image if any frames were dropped.
+
+    """
+    delays = [frame.delay for frame in img.sequence]
+    kept = subsample_frames(delays, fps, ANIMATION_MAX_FRAMES)
+    if len(kept) < len(delays):
+        return coalesce_frames(img, kept)
+    img.coalesce()
+    return img
+
+
+def resize_animation(img, width=None, height=None):
+    """
+    Resize each frame of a coalesced animation the way ``transform`` resizes
+    still images: keeping the aspect ratio, and filling then center cropping
+    when given both dimensions.
+
+    """
+    src_width, src_height = img.size
+    if width and height:
+        scale = max(width / src_width, height / src_height)
+    elif width:
+        scale = width / src_width
     else:
-        raise Exception(f"Couldn't find an overlay file for bucket '{bucket}' and path '{path}' (overlay='{overlay}')")
+        scale = height / src_height
+    new_width = max(1, round(src_width * scale))
+    new_height = max(1, round(src_height * scale))
+
+    for frame in img.sequence:
+        with frame:
+            frame.resize(new_width, new_height)
+            if width and height:
+                frame.crop(width=width, height=height, gravity='center')
+            frame.reset_coords()
+    img.reset_coords()
     return img
 
 
 def process_image(img, operations):
+    """
+    Run ``img`` through ``operations``, returning the result.  ``img`` is
+    closed if the result's a new image, or if anything goes wrong.
+
+    """
+    try:
+        return apply_operations(img, operations)
+    except (LiquidTimeout, LiquidCrop):
+        # still being carved (finish_liquid takes it from here), or cropped for the caller to finish
+        raise
+    except BaseException:
+        close_image(img)
+        raise
+
+
+def apply_operations(img, operations):
+    if img.animation:
+        fps = next((op.params['fps'] for op in operations if op.function == 'fps'), None)
+        prepared = prepare_animation(img, fps)
+        if prepared is not img:
+            close_image(img)
+        img = prepared
+
     for op in operations:
         if callable(op.function):
-            img = op.function(img, **op.params)
+            result = op.function(img, **op.params)
+            if result is not img:
+                close_image(img)
+            img = result
         elif op.function == 'resize':
-            if not op.params.get('width'):
-                if img.animation:
-                    width, height = img.size
-                    img.resize(width, op.params['height'])
-                else:
-                    size = f"x{op.params['height']}"
-                    img.transform(resize=size)
+            if img.animation:
+                resize_animation(img, op.params.get('width'), op.params.get('height'))
+            elif not op.params.get('width'):
+                size = f"x{op.params['height']}"
+                img.transform(resize=size)
             elif not op.params.get('height'):
-                if img.animation:
-                    width, height = img.size
-                    img.resize(op.params['width'], height)
-                else:
-                    size = f"{op.params['width']}"
-                    img.transform(resize=size)
+                size = f"{op.params['width']}"
+                img.transform(resize=size)
             else:
-                if img.animation:
-                    img.resize(op.params['width'], op.params['height'])
-                else:
-                    size = f"{op.params['width']}x{op.params['height']}^"
-                    crop_size = f"{op.params['width']}x{op.params['height']}!"
-                    img.transform(resize=size)
-                    w_offset = max((img.width - op.params['width']) / 2, 0)
-                    h_offset = max((img.height - op.params['height']) / 2, 0)
-                    geometry = f"{crop_size}+{w_offset}+{h_offset}"
-                    img.transform(crop=geometry)
+                size = f"{op.params['width']}x{op.params['height']}^"
+                crop_size = f"{op.params['width']}x{op.params['height']}!"
+                img.transform(resize=size)
+                w_offset = max((img.width - op.params['width']) / 2, 0)
+                h_offset = max((img.height - op.params['height']) / 2, 0)
+                geometry = f"{crop_size}+{w_offset}+{h_offset}"
+                img.transform(crop=geometry)
         elif op.function == 'liquid':
-            img.liquid_rescale(**op.params)
+            img = liquid_rescale(img, **op.params)
         elif op.function == 'flip':
             img.flip()
         elif op.function == 'flop':
@@ -495,6 +2350,134 @@ def process_image(img, operations):
     return img
 
 
+class LiquidTimeout(Exception):
+    """
+    Seam carving is taking too long.  It carries on in ``LIQUID_POOL`` and
+    ``img`` will hold the result once ``future`` is done.
+
+    """
+
+    def __init__(self, img, future):
+        super().__init__("liquid rescale timed out")
+        self.img = img
+        self.future = future
+
+
+class LiquidCrop(Exception):
+    """
+    We cropped ``img`` instead of carving it, because carving would cost too
+    much or there are too many carves going already.  Good enough to serve,
+    but not to store as the carve.
+
+    """
+
+    def __init__(self, img):
+        super().__init__("cropped instead of carving")
+        self.img = img
+
+
+LIQUID_POOL = ThreadPoolExecutor(max_workers=LIQUID_CONCURRENCY, thread_name_prefix="giraffe-liquid")
+LIQUID_SLOTS = threading.BoundedSemaphore(LIQUID_BACKLOG)
+# (bucket, cache key) -> Future of the stored carve's content (None if it wasn't
+# stored), so requests for a carve that's under way wait for it instead of repeating it
+LIQUID_CARVES = {}
+
+
+def liquid_rescale(img, width=None, height=None):
+    """
+    Seam carve ``img`` to ``width`` x ``height``, within our budget.
+
+    The image is first scaled down (keeping its aspect ratio) until it just
+    fills the target, so only the seams that change its shape are carved.
+    Raises ``LiquidTimeout`` if that takes more than ``LIQUID_TIMEOUT``, and
+    ``LiquidCrop`` if we crop instead.
+
+    """
+    src_width, src_height = img.size
+    scale = max(width / src_width, height / src_height)
+    if scale < 1:
+        img.resize(max(width, round(src_width * scale)), max(height, round(src_height * scale)))
+
+    seams = abs(img.width - width) + abs(img.height - height)
+    if img.width * img.height * seams > LIQUID_MAX_COST or not LIQUID_SLOTS.acquire(blocking=False):
+        raise LiquidCrop(apply_operations(img, [ImageOp('resize', {'width': width, 'height': height})]))
+
+    try:
+        future = LIQUID_POOL.submit(img.liquid_rescale, width, height)
+    except BaseException:
+        LIQUID_SLOTS.release()
+        raise
+    future.add_done_callback(lambda future: LIQUID_SLOTS.release())
+    try:
+        future.result(timeout=LIQUID_TIMEOUT)
+    except FutureTimeoutError:
+        raise LiquidTimeout(img, future)
+    return img
+
+
+def liquid_fallback_pipeline(pipeline):
+    """``pipeline`` with any seam carving swapped for a plain fill and crop"""
+    return [ImageOp('resize', op.params) if op.function == 'liquid' else op for op in pipeline]
+
+
+def after_liquid(pipeline):
+    """What's left of ``pipeline`` once the seam carving's done"""
+    return pipeline[[op.function for op in pipeline].index('liquid') + 1:]
+
+
+def settle_carve(bucket, param_name, carving, content=None):
+    """Tell whoever's waiting on ``carving`` what was stored (if anything)"""
+    if carving is None:
+        return
+    if LIQUID_CARVES.get((bucket, param_name)) is carving:
+        del LIQUID_CARVES[(bucket, param_name)]
+    carving.set_result(content)
+
+
+def finish_liquid(timeout, pipeline, args, desired_format, bucket, param_name, carving=None):
+    """Wait for a slow seam carve, finish its pipeline and store it where the crop would've gone"""
+    content = None
+    try:
+        try:
+            timeout.future.result()
+        except BaseException:
+            close_image(timeout.img)
+            raise
+        content = render_image(timeout.img, after_liquid(pipeline), args, desired_format)
+        s3.upload(param_name, BytesIO(content), bucket=bucket,
+                  content_type=format_content_type(desired_format), public=True)
+    except BaseException:
+        content = None
+        raise
+    finally:
+        settle_carve(bucket, param_name, carving, content)
+
+
+def liquid_crop_response(content, desired_format):
+    """A crop standing in for a seam carve: briefly cacheable, and never stored"""
+    return Response(
+        content=content,
+        media_type=format_content_type(desired_format),
+        headers=validator_headers(content_etag(content), cache_control=LIQUID_FALLBACK_CACHE_CONTROL),
+    )
+
+
+async def join_carve(carving, key, path, args, pipeline, desired_format, cache_control):
+    """Wait a while for someone else's carve of this variant, serving a crop if it doesn't turn up"""
+    try:
+        # shielded, so giving up on it doesn't cancel it for everyone else
+        content = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(carving)), LIQUID_TIMEOUT)
+    except asyncio.TimeoutError:
+        content = None
+    if content is not None:
+        return Response(content=content, media_type=format_content_type(desired_format),
+                        headers=validator_headers(content_etag(content), cache_control=cache_control))
+    img = await run_in_generation_pool(load_original, key.content, key.headers, path, args)
+    content = await run_in_generation_pool(render_image, img, liquid_fallback_pipeline(pipeline),
+                                           args, desired_format)
+    return liquid_crop_response(content, desired_format)
+
+
 def fit_crop(img, width=None, height=None, anchor=None):
     offset = ''
     if anchor == 'top':
@@ -559,8 +2542,13 @@ def build_pipeline(params):
             raise HTTPException(status_code=400, detail=f'"{rot}" is not a valid rotation value')
         pipeline.append(ImageOp('rotate', {'degrees': int(rot)}))
 
+    fps = params.get('fps')
+    if fps:
+        # applied by process_image when it prepares an animation
+        pipeline.append(ImageOp('fps', {'fps': fps}))
+
     fm = params.get('fm')
-    if fm:
+    if fm and fm not in VIDEO_FORMATS:
         pipeline.append(ImageOp('format', FORMAT_MAP[fm]['format']))
 
     overlay = params.get('overlay')
@@ -583,103 +2571,1049 @@ def build_pipeline(params):
     return pipeline
 
 
+def encode_video(img, fmt):
+    """Transcode an animation to ``fmt`` (one of ``VIDEO_FORMATS``) with ffmpeg"""
+    if not FFMPEG:
+        raise ValueError(f"{fmt} output needs ffmpeg")
+    content_type, codec = VIDEO_FORMATS[fmt]
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.gif")
+        output = os.path.join(tmp, f"output.{fmt}")
+        img.format = 'gif'
+        img.save(filename=source)
+        subprocess.run(
+            [FFMPEG, '-nostdin', '-loglevel', 'error', '-i', source, *codec,
+             # most encoders need even dimensions, and players need yuv420p
+             '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-pix_fmt', 'yuv420p', '-an', output],
+            check=True, timeout=FFMPEG_TIMEOUT,
+        )
+        with open(output, 'rb') as f:
+            return f.read()
+
+
+def format_content_type(fmt):
+    if fmt in VIDEO_FORMATS:
+        return VIDEO_FORMATS[fmt][0]
+    return f"image/{normalize_mimetype(fmt)}"
+
+
+def encode_image(img, fmt='JPEG'):
+    """
+    Encode ``img`` as ``fmt``, straight into the one ``bytes`` that's then
+    uploaded, hashed and served without being copied again.
+
+    """
+    if fmt in VIDEO_FORMATS:
+        return encode_video(img, fmt)
+    if img.animation and fmt == 'gif':
+        # store only what changes between frames
+        img.optimize_layers()
+    return img.make_blob(fmt)
+
+
 def image_to_buffer(img, fmt='JPEG', compress=False):
+    blob = encode_image(img, fmt)
+    if not compress:
+        # shares blob until something writes to it
+        return BytesIO(blob)
     buff = BytesIO()
-    img.format = fmt
-    if compress:
-        filename, mode, compresslevel, mtime = '', 'wb', 9, None
-        gz = gzip.GzipFile(filename, mode, compresslevel, buff, mtime)
-        img.save(file=gz)
-    else:
-        img.save(file=buff)
+    filename, mode, compresslevel, mtime = '', 'wb', 9, None
+    with gzip.GzipFile(filename, mode, compresslevel, buff, mtime) as gz:
+        gz.write(blob)
     return buff
 
 
 def image_to_binary(img, fmt='JPEG'):
-    return img.make_blob(fmt)
+    return encode_image(img, fmt)
+
+
+def render_image(img, pipeline, args, desired_format, cancellation=None):
+    """
+    Run an image through ``pipeline`` and encode it as ``desired_format``,
+    returning the encoded bytes, giving up part way if ``cancellation`` says
+    to.  Takes ownership of ``img``, which is closed once it's encoded.
+
+    """
+    img.compression_quality = args.get('q', DEFAULT_QUALITY)
+    if cancellation is not None:
+        cancellation.watch(img)
+    processed_image = process_image(img, pipeline)
+    try:
+        if cancellation is not None:
+            cancellation.check()
+            cancellation.start('encode')
+            cancellation.watch(processed_image)
+        return encode_image(processed_image, desired_format)
+    finally:
+        close_image(processed_image)
+
+
+def load_image_region(content, headers, path, rect, cancellation=None):
+    """
+    Decode just the ``(x, y, w, h)`` region of an image.
+
+    ImageMagick is asked to extract the region as it reads, which lets it
+    skip the tiles / scanlines outside it for the formats that allow that
+    (and crop before anything else happens for the rest).  Without that we
+    crop straight after decoding.
+
+    """
+    x, y, w, h = rect
+    geometry = f"{w}x{h}+{x}+{y}"
+    try:
+        set_extract = library.MagickSetExtract
+    except AttributeError:
+        img = stubbornly_load_image(content, headers, path)
+        try:
+            img.crop(x, y, width=w, height=h)
+        except BaseException:
+            img.close()
+            raise
+    else:
+        img = Image()
+        try:
+            if cancellation is not None:
+                cancellation.watch_read(img)
+            set_extract(img.wand, geometry.encode())
+            img.read(blob=content)
+        except BaseException:
+            img.close()
+            raise
+    img.reset_coords()
+    return track_image(img)
+
+
+def load_original(content, headers, path, args, cancellation=None):
+    """Decode an original (or just its ``rect``), which ``cancellation`` can abort part way"""
+    rect = args.get('rect')
+    if rect:
+        return load_image_region(content, headers, path, parse_rect(rect), cancellation)
+    if cancellation is None:
+        return stubbornly_load_image(content, headers, path)
+
+    img = Image()
+    try:
+        cancellation.watch_read(img)
+        img.read(blob=content)
+    except wand.exceptions.MissingDelegateError:
+        img.close()
+        return stubbornly_load_image(content, headers, path)
+    except BaseException:
+        img.close()
+        raise
+    return track_image(img)
+
 
 def stubbornly_load_image(content, headers, path):
     try:
-        return Image(blob=BytesIO(content))
+        return track_image(Image(blob=content))
     except wand.exceptions.MissingDelegateError as orig_e:
         try:
-            return Image(blob=BytesIO(content), format='ico')
+            return track_image(Image(blob=content, format='ico'))
         except wand.exceptions.MissingDelegateError:
             raise orig_e
 
 
-async def get_file_with_params_or_404(bucket, path, param_name, args, force):
-    """Get processed file or generate it"""
-    key = get_object_or_none(bucket, path)
-    if not key:
-        raise HTTPException(status_code=404, detail=f"404: original file '{path}' doesn't exist")
-    
+def host_memory():
+    """Physical memory on this host in bytes, or None if we can't tell"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def magick_limits(memory=None, cpus=None, workers=None, concurrency=None):
+    """
+    The ImageMagick resource limits for one worker: ``MAGICK_LIMITS`` where
+    they're set, and otherwise a share of the host's ``memory`` and ``cpus``
+    split between ``workers`` processes generating ``concurrency`` images
+    at a time.
+
+    """
+    memory = memory or host_memory()
+    cpus = cpus or os.cpu_count() or 1
+    workers = max(1, workers or WORKERS)
+    concurrency = max(1, concurrency or GENERATION_CONCURRENCY)
+
+    limits = {'thread': max(1, cpus // (workers * concurrency))}
+    if memory:
+        share = int(memory * MAGICK_MEMORY_FRACTION / workers)
+        limits.update(
+            memory=share,
+            map=share * 2,
+            disk=share * 4,
+            # the biggest pixel cache any one of our concurrent images can keep in memory
+            area=share // (concurrency * PIXEL_BYTES),
+        )
+    limits.update(MAGICK_LIMITS)
+    return limits
+
+
+# What ImageMagick's been asked to stay within, what we've had it work on and how
+# often it ran out of something
+MAGICK_STATS = {
+    'limits': {},
+    'images': 0,
+    'pixel_bytes': 0,
+    'max_pixel_bytes': 0,
+    'limit_hits': defaultdict(int),
+    'last_limit_hit': None,
+}
+
+
+def apply_magick_limits(limits):
+    for resource, value in limits.items():
+        wand.resource.limits[resource] = value
+    MAGICK_STATS['limits'] = dict(limits)
+
+
+def record_magick_usage(img):
+    """Account for the pixel cache one request's decoded image needs"""
+    pixel_bytes = img.width * img.height * PIXEL_BYTES * max(1, len(img.sequence))
+    MAGICK_STATS['images'] += 1
+    MAGICK_STATS['pixel_bytes'] += pixel_bytes
+    MAGICK_STATS['max_pixel_bytes'] = max(MAGICK_STATS['max_pixel_bytes'], pixel_bytes)
+
+
+def record_magick_limit_hit(stage):
+    MAGICK_STATS['limit_hits'][stage] += 1
+    MAGICK_STATS['last_limit_hit'] = formatdate(usegmt=True)
+
+
+def magick_metrics():
+    usage = {}
+    resource = getattr(wand.resource.limits, 'resource', None)
+    if resource is not None:
+        usage = {name: resource(name) for name in ('memory', 'map', 'disk', 'area')}
+    return dict(MAGICK_STATS, limit_hits=dict(MAGICK_STATS['limit_hits']), in_use=usage)
+
+
+class StageTimeout(Exception):
+    """A stage of generating a variant ran past its deadline"""
+
+
+# ImageMagick's MagickProgressMonitor: returning false aborts what it's doing
+try:
+    from wand.cdefs.magick_image import MagickProgressMonitor
+except ImportError:
+    MagickProgressMonitor = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.c_char_p, ctypes.c_longlong,
+                                             ctypes.c_ulonglong, ctypes.c_void_p)
+
+
+class Cancellation(object):
+    """
+    Lets us give up on generating a variant part way through, because the
+    client went away or a stage ran past its deadline (see
+    ``STAGE_TIMEOUTS``).  Images being worked on can be ``watch``ed so
+    ImageMagick stops too, instead of finishing work nobody will see.
+
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.detached = False
+        self.stage = None
+        self.deadline = None
+        self._monitor = MagickProgressMonitor(self._progress)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def start(self, stage):
+        timeout = STAGE_TIMEOUTS.get(stage)
+        self.stage = stage
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def expired(self):
+        if self.detached:
+            return False
+        return self.cancelled.is_set() or (self.deadline is not None and time.monotonic() > self.deadline)
+
+    def check(self):
+        if self.expired():
+            raise StageTimeout(self.stage)
+
+    def detach(self):
+        """Let anything already being watched run to completion"""
+        self.detached = True
+
+    def _progress(self, text, offset, span, client_data):
+        return not self.expired()
+
+    def watch(self, img):
+        """Have ImageMagick abort whatever it's doing to any frame of ``img`` once we've given up"""
+        try:
+            set_monitor = library.MagickSetImageProgressMonitor
+        except AttributeError:
+            return
+        # the monitor belongs to each image in the wand, not the wand itself
+        index = library.MagickGetIteratorIndex(img.wand)
+        try:
+            for frame in range(library.MagickGetNumberImages(img.wand)):
+                library.MagickSetIteratorIndex(img.wand, frame)
+                set_monitor(img.wand, self._monitor, None)
+        finally:
+            library.MagickSetIteratorIndex(img.wand, index)
+        # ImageMagick only has a pointer to the callback, keep it alive as long as the image
+        img.giraffe_progress_monitor = self._monitor
+
+    def watch_read(self, img):
+        """Have ImageMagick abort decoding into ``img``, a fresh ``Image()``, once we've given up"""
+        try:
+            library.MagickSetProgressMonitor(img.wand, self._monitor, None)
+        except (AttributeError, ctypes.ArgumentError):
+            return
+        img.giraffe_progress_monitor = self._monitor
+
+
+async def run_stage(stage, cancellation, func, *args, **kwargs):
+    """
+    Run ``func`` off the event loop as ``stage`` (or a tuple of stages it
+    moves through itself with ``cancellation.start``) of generating a
+    variant, raising a 504 if it runs past its deadline.  Fetching and
+    uploading use the default executor, everything else the generation
+    pool.
+
+    """
+    stages = (stage,) if isinstance(stage, str) else stage
+    timeouts = [STAGE_TIMEOUTS.get(name) for name in stages]
+    timeout = sum(timeouts) if all(timeouts) else None
+    executor = None if stages[0] in ('fetch', 'upload') else GENERATION_POOL
+
+    def run():
+        cancellation.start(stages[0])
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            # whatever ImageMagick made of being aborted, say why it was
+            cancellation.check()
+            raise
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(executor, context.run, run), timeout)
+    except (asyncio.TimeoutError, StageTimeout):
+        cancellation.cancel()
+        raise HTTPException(status_code=504, detail=f"Took too long to {cancellation.stage} the image")
+    except wand.exceptions.ResourceLimitError:
+        # out of memory / disk for pixel caches, which is down to how busy we are
+        record_magick_limit_hit(cancellation.stage)
+        raise too_busy()
+
+
+async def until_disconnected(request, awaitable, cancellation):
+    """
+    Await ``awaitable``, unless the client disconnects first, in which case
+    it's cancelled (along with any ImageMagick work ``cancellation`` is
+    watching) and we answer with a 499 nobody will read.
+
+    """
+    task = asyncio.ensure_future(awaitable)
+    if request is None:
+        return await task
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                cancellation.cancel()
+                task.cancel()
+                await asyncio.wait({task})
+                return Response(status_code=499)
+    except asyncio.CancelledError:
+        cancellation.cancel()
+        task.cancel()
+        raise
+
+
+class Saturated(Exception):
+    """There's no room to generate anything else right now"""
+
+
+class QuotaExceeded(Saturated):
+    """A bucket's generating more than its rate quota allows"""
+
+
+class TooBusy(HTTPException):
+    """The 503 for a request that couldn't get a generation slot"""
+
+
+def too_busy():
+    return TooBusy(status_code=503, detail="Too busy to generate that right now",
+                         headers={"Retry-After": str(GENERATION_RETRY_AFTER)})
+
+
+def over_quota():
+    return HTTPException(status_code=429, detail="Generating too much for this bucket right now",
+                         headers={"Retry-After": str(GENERATION_RETRY_AFTER)})
+
+
+class HostSlots(object):
+    """
+    Generation slots shared by every worker process on a host: ``count``
+    files in ``directory``, each held with ``flock`` while in use.
+
+    """
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+
+    def try_acquire(self):
+        """Returns the fd of the slot we got, or None if they're all taken"""
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(self.count):
+            fd = os.open(os.path.join(self.directory, f"slot-{i}"), os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+            else:
+                return fd
+        return None
+
+    def release(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class TokenBucket(object):
+    """Allows ``rate`` things a second, in bursts of up to ``burst``"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class GenerationGate(object):
+    """
+    Admission control for generating variants: at most ``limit`` at once in
+    this worker (and, with ``host_slots``, on this host), at most
+    ``max_queue`` waiting for a turn, and none waiting more than ``timeout``
+    seconds.  Anything that can't get in raises ``Saturated``.
+
+    Buckets take turns fairly (start-time fair queuing): each admission
+    moves a bucket's virtual clock on by ``1 / weight``, and the bucket that's
+    furthest behind goes next, so a bucket with weight 2 gets twice the turns
+    of one with weight 1 and no bucket can hog the slots.  Buckets can also
+    be capped at a number of concurrent generations and a rate (generations
+    a second, over which they get ``QuotaExceeded``).  Within a bucket
+    waiters go lowest ``priority`` first (see ``generation_priority``).
+
+    Only buckets with something queued or running are tracked, and stats are
+    kept for at most ``max_stats`` buckets that aren't configured, the rest
+    are counted under ``OTHER_BUCKETS``.
+
+    """
+
+    OTHER_BUCKETS = "(other)"
+
+    def __init__(self, limit, max_queue, timeout, host_slots=None, weights=None, concurrency=None, rates=None,
+                 max_stats=100):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.host_slots = host_slots
+        self.weights = weights or {}
+        self.concurrency = concurrency or {}
+        self.rates = {bucket: TokenBucket(rate) for bucket, rate in (rates or {}).items()}
+        self.max_stats = max_stats
+        self.active = 0
+        self.queued = 0
+        self.active_by_bucket = {}
+        self.stats = {}
+        self._queues = {}
+        self._finish = {}
+        self._vtime = 0.0
+        self._counter = itertools.count()
+
+    async def acquire(self, priority=0, bucket=None):
+        rate = self.rates.get(bucket)
+        if rate is not None and not rate.take():
+            raise QuotaExceeded()
+        if self.queued >= self.max_queue and not self._can_run(bucket):
+            raise Saturated()
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queues.setdefault(bucket, []), (priority, next(self._counter), waiter))
+        self.queued += 1
+        self._dispatch()
+        if waiter.done():
+            return
+        if self.queued > self.max_queue:
+            self._forget(bucket, waiter)
+            raise Saturated()
+
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # we were handed a slot just as we timed out, give it back
+                self.release(bucket)
+            else:
+                self._forget(bucket, waiter)
+            raise Saturated()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # we were handed a slot just as we were cancelled
+                self.release(bucket)
+            else:
+                self._forget(bucket, waiter)
+            raise
+
+    def release(self, bucket=None):
+        self.active -= 1
+        self.active_by_bucket[bucket] -= 1
+        if not self.active_by_bucket[bucket]:
+            del self.active_by_bucket[bucket]
+        self._dispatch()
+        self._tidy()
+
+    def _can_run(self, bucket):
+        limit = self.concurrency.get(bucket)
+        return self.active < self.limit and (limit is None or self.active_by_bucket.get(bucket, 0) < limit)
+
+    def _tidy(self):
+        """Forget buckets with nothing queued, and the finish times of idle buckets that don't matter any more"""
+        for bucket in [bucket for bucket, queue in self._queues.items() if not queue]:
+            del self._queues[bucket]
+        if not self.active and not self.queued and self._finish:
+            # nobody's waiting on anyone, so everyone can start level
+            self._vtime = max(self._vtime, max(self._finish.values()))
+        idle = sorted((finish, str(bucket), bucket) for bucket, finish in self._finish.items()
+                      if bucket not in self._queues and bucket not in self.active_by_bucket)
+        # an idle bucket that's fallen behind the clock would start on it anyway, and past
+        # max_stats of them we drop the ones closest to it, which moves their next start least
+        extra = max(0, len(idle) - self.max_stats)
+        for i, (finish, _, bucket) in enumerate(idle):
+            if finish <= self._vtime or i < extra:
+                del self._finish[bucket]
+
+    def _stats_for(self, bucket):
+        if bucket not in self.stats:
+            configured = bucket in self.weights or bucket in self.concurrency or bucket in self.rates
+            if not configured and len(self.stats) >= self.max_stats:
+                bucket = self.OTHER_BUCKETS
+            self.stats.setdefault(bucket, dict.fromkeys(
+                ('admitted', 'rejected', 'throttled', 'wait_seconds', 'busy_seconds'), 0))
+        return self.stats[bucket]
+
+    def _dispatch(self):
+        """Hand free slots to the buckets that are furthest behind"""
+        while self.active < self.limit:
+            ready = [bucket for bucket, queue in self._queues.items() if queue and self._can_run(bucket)]
+            if not ready:
+                return
+            bucket = min(ready, key=lambda b: (max(self._vtime, self._finish.get(b, 0.0)), self._queues[b][0][1]))
+            priority, count, waiter = heapq.heappop(self._queues[bucket])
+            self.queued -= 1
+            if waiter.done():
+                continue
+            start = max(self._vtime, self._finish.get(bucket, 0.0))
+            self._vtime = start
+            self._finish[bucket] = start + 1.0 / self.weights.get(bucket, 1.0)
+            self.active += 1
+            self.active_by_bucket[bucket] = self.active_by_bucket.get(bucket, 0) + 1
+            waiter.set_result(None)
+
+    def _forget(self, bucket, waiter):
+        queue = self._queues.get(bucket, [])
+        remaining = [entry for entry in queue if entry[2] is not waiter]
+        if len(remaining) < len(queue):
+            self.queued -= 1
+            heapq.heapify(remaining)
+            self._queues[bucket] = remaining
+        self._tidy()
+
+    async def acquire_host_slot(self, deadline):
+        while True:
+            fd = self.host_slots.try_acquire()
+            if fd is not None:
+                return fd
+            if time.monotonic() >= deadline:
+                raise Saturated()
+            await asyncio.sleep(0.05)
+
+    @asynccontextmanager
+    async def slot(self, priority=0, bucket=None):
+        """Hold a generation slot, or raise a 503 (429 over quota) if we can't get one in time"""
+        stats = self._stats_for(bucket)
+        queued_at = time.monotonic()
+        deadline = queued_at + self.timeout
+        try:
+            await self.acquire(priority, bucket)
+        except QuotaExceeded:
+            stats['throttled'] += 1
+            raise over_quota()
+        except Saturated:
+            stats['rejected'] += 1
+            raise too_busy()
+        fd = None
+        try:
+            if self.host_slots is not None:
+                try:
+                    fd = await self.acquire_host_slot(deadline)
+                except Saturated:
+                    stats['rejected'] += 1
+                    raise too_busy()
+            started = time.monotonic()
+            stats['admitted'] += 1
+            stats['wait_seconds'] += started - queued_at
+            try:
+                yield
+            finally:
+                stats['busy_seconds'] += time.monotonic() - started
+        finally:
+            if fd is not None:
+                self.host_slots.release(fd)
+            self.release(bucket)
+
+    def metrics(self):
+        buckets = set(self.stats) | set(self.active_by_bucket) | set(self._queues)
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'limit': self.limit,
+            'buckets': {
+                str(bucket): dict(
+                    self.stats.get(bucket, {}),
+                    active=self.active_by_bucket.get(bucket, 0),
+                    queued=len(self._queues.get(bucket, [])),
+                    weight=self.weights.get(bucket, 1.0),
+                    concurrency=self.concurrency.get(bucket),
+                )
+                for bucket in sorted(buckets, key=str)
+            },
+        }
+
+
+def generation_priority(args, count=1):
+    """
+    Where a generation request goes in the queue: roughly how many pixels
+    it'll produce, so thumbnails don't wait behind big renders.  Requests
+    we can't size up go last.
+
+    """
+    w, h = args.get('w'), args.get('h')
+    if w and h:
+        pixels = w * h
+    elif w or h:
+        pixels = (w or h) ** 2
+    else:
+        pixels = MAX_PIXELS
+    return pixels * count
+
+
+# Generation runs on its own threads, leaving the default threadpool to cache hits
+GENERATION_POOL = ThreadPoolExecutor(max_workers=GENERATION_CONCURRENCY, thread_name_prefix="giraffe-generate")
+
+
+async def run_in_generation_pool(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(GENERATION_POOL, functools.partial(context.run, func, *args, **kwargs))
+
+
+# Previews are made while every generation slot is taken, so they get a (small) pool of their own
+PREVIEW_POOL = ThreadPoolExecutor(max_workers=PREVIEW_CONCURRENCY, thread_name_prefix="giraffe-preview")
+PREVIEW_SLOTS = threading.BoundedSemaphore(PREVIEW_CONCURRENCY)
+
+
+GENERATION_GATE = GenerationGate(
+    GENERATION_CONCURRENCY, GENERATION_QUEUE_SIZE, GENERATION_QUEUE_TIMEOUT,
+    host_slots=HostSlots(GENERATION_HOST_SLOT_DIR, GENERATION_HOST_SLOTS) if GENERATION_HOST_SLOTS else None,
+    weights=BUCKET_WEIGHTS,
+    concurrency=BUCKET_CONCURRENCY,
+    rates=BUCKET_RATES,
+    max_stats=BUCKET_STATS_MAX,
+)
+
+
+def copy_forward(bucket, old_name, new_name):
+    """
+    Copy a variant found under an old cache key to its new one.  It's only
+    so the next lookup hits first time, so errors are just logged.
+
+    """
+    try:
+        s3.copy(old_name, bucket, new_name, bucket)
+    except Exception as e:
+        print(f"couldn't copy {old_name} to {new_name}: {e}")
+
+
+def find_variant(bucket, names):
+    """
+    Returns the first of ``names`` that exists, copying it forward to the
+    first name if it was found under an older key.
+
+    """
+    for name in names:
+        if head_object_or_none(bucket, name) is not None:
+            if name != names[0]:
+                copy_forward(bucket, name, names[0])
+            return name
+    return None
+
+
+def render_mockup(bucket, design, mockup, default_format):
+    """Composite an already resized design onto its overlay, then finish and upload it"""
+    args = mockup['args']
+    (overlay_op, *pipeline) = mockup['pipeline']
+    params = overlay_op.params
+    overlay_img, canvas = prepare_overlay(params['bucket'], params['path'], params['overlay'], params['bg'])
+    w, h, x, y = overlay_placement(params['w'], params['h'], params['x'], params['y'])
+    img = composite_overlay(design, overlay_img, canvas, x, y)
+
+    desired_format = args.get('fm', default_format)
+    content = render_image(img, pipeline, args, desired_format)
+    s3.upload(mockup['key'], BytesIO(content), bucket=bucket,
+              content_type=format_content_type(desired_format), public=True)
+
+
+async def get_file_with_params_or_404(bucket, path, param_name, args, force, fallback_names=(), version=None,
+                                      request=None, degrade=True):
+    """Get processed file or generate it, or with ``degrade`` a stand in for it if we're too busy"""
+    meta = await run_in_threadpool(get_object_metadata, bucket, path, force)
+    if not meta:
+        raise original_not_found(path)
+
+    cache_control = CACHE_CONTROL
+    unversioned_name = param_name
+    if VERSIONED_CACHE_KEYS:
+        current_version = object_version(meta.etag)
+        param_name, *fallback_names = versioned_cache_keys([param_name, *fallback_names], current_version)
+        if version and version == current_version:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+
     # Check for cached version unless force is True
     if not force:
-        custom_key = get_object_or_none(bucket, param_name)
-        if custom_key:
-            content_type = custom_key.headers.get('content-type', "image/jpeg")
-            return Response(
-                content=custom_key.content,
-                media_type=content_type,
-                headers={"Cache-Control": CACHE_CONTROL}
-            )
-    
+        for name in [param_name, *fallback_names]:
+            response = await run_in_threadpool(serve_object, bucket, name, request, cache_control)
+            if response is not None:
+                if name != param_name:
+                    # found under an old key; copy it forward so the next lookup hits first time
+                    response.background = BackgroundTask(copy_forward, bucket, name, param_name)
+                return response
+
+    # cache hits never get here, so only generation waits for a slot
+    cancellation = Cancellation()
+    try:
+        return await until_disconnected(
+            request, generate_in_slot(bucket, path, param_name, unversioned_name, args, meta, version,
+                                      cache_control, request, cancellation),
+            cancellation,
+        )
+    except TooBusy:
+        response = await degraded_response(bucket, path, args, meta, request) if degrade else None
+        if response is None:
+            raise
+        if (bucket, param_name) not in PENDING_VARIANTS:
+            PENDING_VARIANTS.add((bucket, param_name))
+            response.background = BackgroundTask(generate_later, bucket, path, param_name, unversioned_name,
+                                                 args, meta, version)
+        return response
+
+
+async def generate_in_slot(bucket, path, param_name, unversioned_name, args, meta, version, cache_control,
+                           request, cancellation):
+    async with GENERATION_GATE.slot(generation_priority(args), bucket):
+        return await generate_variant(bucket, path, param_name, unversioned_name, args, meta, version,
+                                      cache_control, request, cancellation)
+
+
+# Variants waiting to be generated in the background, so each is only scheduled once
+PENDING_VARIANTS = set()
+
+
+def nearest_variant_args(args):
+    """
+    The same variant at each of ``OVERLOAD_SIZES``, the smallest one bigger
+    than what was asked for first (browsers scale down better than up),
+    then smaller ones, biggest first.
+
+    """
+    w, h = args.get('w'), args.get('h')
+    wanted = w or h
+    if not wanted:
+        return
+    bigger = sorted(size for size in OVERLOAD_SIZES if size > wanted)
+    smaller = sorted((size for size in OVERLOAD_SIZES if size < wanted), reverse=True)
+    for size in bigger + smaller:
+        candidate = OrderedDict(args)
+        if w:
+            candidate['w'] = size
+            if h:
+                candidate['h'] = max(1, round(h * size / w))
+        else:
+            candidate['h'] = size
+        yield candidate
+
+
+def serve_nearest_variant(bucket, path, args, meta, request=None):
+    """Serve the closest size of this variant that's already cached, if there is one"""
+    dirname = os.path.dirname(path)
+    base, ext = os.path.basename(path).split(".")
+    for candidate in nearest_variant_args(args):
+        name = calculate_cache_keys(dirname, base, ext, canonicalize_args(candidate, ext))[0]
+        if VERSIONED_CACHE_KEYS:
+            name = versioned_cache_key(name, object_version(meta.etag))
+        response = serve_object(bucket, name, request, OVERLOAD_CACHE_CONTROL, ranges=False)
+        if response is not None:
+            return response
+    return None
+
+
+def render_preview(content, headers, path, args):
+    """
+    A quick and rough version of a variant: just the size and format,
+    point sampled and at low quality.  Returns None if the original's too
+    big or the variant's not something we can preview.
+
+    """
+    desired_format = args.get('fm', path_to_format(path))
+    if desired_format in VIDEO_FORMATS:
+        return None
+    width, height = get_image_size(content)
+    if args.get('rect'):
+        width, height = parse_rect(args['rect'])[2:]
+    if width * height > PREVIEW_MAX_PIXELS:
+        return None
+
+    w, h = args.get('w'), args.get('h')
+    if w and not h:
+        h = max(1, round(height * w / width))
+    elif h and not w:
+        w = max(1, round(width * h / height))
+    else:
+        w, h = w or width, h or height
+    if w * h > MAX_PIXELS:
+        return None
+
+    img = load_original(content, headers, path, args)
+    if img.animation:
+        # just the first frame
+        with img:
+            img = track_image(Image(image=img.sequence[0]))
+    with img:
+        img.sample(w, h)
+        img.compression_quality = PREVIEW_QUALITY
+        return encode_image(img, desired_format), format_content_type(desired_format)
+
+
+async def serve_preview(bucket, path, args):
+    """A preview of the variant, or None if there's nothing to preview or we're already making enough"""
+    if not PREVIEW_SLOTS.acquire(blocking=False):
+        return None
+    try:
+        key = await run_in_threadpool(get_object_or_none, bucket, path)
+        if not key:
+            return None
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        preview = await loop.run_in_executor(
+            PREVIEW_POOL, functools.partial(context.run, render_preview, key.content, key.headers, path, args))
+    finally:
+        PREVIEW_SLOTS.release()
+    if preview is None:
+        return None
+    content, content_type = preview
+    return Response(content=content, media_type=content_type,
+                    headers=validator_headers(content_etag(content), cache_control=OVERLOAD_CACHE_CONTROL))
+
+
+async def serve_overload_placeholder(path, args):
+    w, h = args.get('w'), args.get('h')
+    w, h = w or h or 640, h or w or 640
+    if w * h > MAX_PIXELS:
+        w, h = 640, 640
+    ext = 'png' if args.get('fm', path_to_format(path)) == 'png' else 'jpg'
+    response = await placeholder_it(f"{w}x{h}.{ext}", bg="eee", message=" ")
+    response.headers["Cache-Control"] = OVERLOAD_CACHE_CONTROL
+    return response
+
+
+async def degraded_response(bucket, path, args, meta, request=None):
+    """
+    Something to serve in place of a variant we're too busy to generate,
+    trying each of ``OVERLOAD_FALLBACKS`` in turn.  Returns None if none of
+    them work out.
+
+    """
+    for fallback in OVERLOAD_FALLBACKS:
+        if fallback == 'nearest':
+            response = await run_in_threadpool(serve_nearest_variant, bucket, path, args, meta, request)
+        elif fallback == 'preview':
+            response = await serve_preview(bucket, path, args)
+        elif fallback == 'placeholder':
+            response = await serve_overload_placeholder(path, args)
+        else:
+            continue
+        if response is not None:
+            response.headers["X-Giraffe-Degraded"] = fallback
+            return response
+    return None
+
+
+async def generate_later(bucket, path, param_name, unversioned_name, args, meta, version):
+    """Generate a variant we served a stand in for, once there's room"""
+    try:
+        for attempt in range(OVERLOAD_BACKGROUND_ATTEMPTS):
+            try:
+                async with GENERATION_GATE.slot(MAX_PIXELS, bucket):
+                    response = await generate_variant(bucket, path, param_name, unversioned_name, args, meta,
+                                                      version, CACHE_CONTROL)
+                    if response.background is not None:
+                        # e.g. storing a slow seam carve, there's no client to do it after
+                        await response.background()
+                    return
+            except TooBusy:
+                await asyncio.sleep(GENERATION_RETRY_AFTER)
+            except HTTPException:
+                return
+    finally:
+        PENDING_VARIANTS.discard((bucket, param_name))
+
+
+async def generate_variant(bucket, path, param_name, unversioned_name, args, meta, version, cache_control,
+                           request=None, cancellation=None):
+    """Download the original, then generate, store and return a variant of it"""
+    cancellation = cancellation or Cancellation()
+    # bad arguments are refused before there's an image to clean up
+    pipeline = build_pipeline(args)
+    key = await run_stage('fetch', cancellation, get_object_or_none, bucket, path)
+    if not key:
+        ORIGINAL_METADATA.pop((bucket, path))
+        remember_missing(bucket, path)
+        raise original_not_found(path)
+
+    if VERSIONED_CACHE_KEYS:
+        # the original may have been replaced since we last looked at it, make sure
+        # what we generate is stored under the version we actually downloaded
+        fresh_meta = object_metadata(key.headers)
+        if fresh_meta.etag != meta.etag:
+            ORIGINAL_METADATA.set((bucket, path), fresh_meta)
+            param_name = versioned_cache_key(unversioned_name, object_version(fresh_meta.etag))
+            if version != object_version(fresh_meta.etag):
+                cache_control = CACHE_CONTROL
+
     # Generate new image
     width, height = get_image_size(key.content)
+    if args.get('rect'):
+        # everything from here on only sees the region
+        x, y, w, h = parse_rect(args['rect'])
+        if x + w > width or y + h > height:
+            raise HTTPException(status_code=400, detail=f"rect {args['rect']} isn't inside the {width}x{height} original")
+        width, height = w, h
     
     # Check if original is too large
     if (width * height) > MAX_PIXELS:
         width = min(args.get('w', width), width)
         height = min(args.get('h', height), height)
-        return await placeholder_it(f"{width}x{height}.jpg", bg="fff", message="TOO BIG")
+        return await placeholder_it(f"{width}x{height}.jpg", bg="fff", message="TOO BIG", request=request)
     
     # Check if requested size is too large
     size = args.get('w', width), args.get('h', height)
     if (size[0] * size[1]) > MAX_PIXELS:
-        return await placeholder_it("640x640.jpg", bg="fff", message="TOO BIG")
+        return await placeholder_it("640x640.jpg", bg="fff", message="TOO BIG", request=request)
     
+    default_format = path_to_format(path)
+    desired_format = args.get('fm', default_format)
+
+    carving = None
+    if 'liquid' in [op.function for op in pipeline]:
+        if (bucket, param_name) in LIQUID_CARVES:
+            return await join_carve(LIQUID_CARVES[(bucket, param_name)], key, path, args, pipeline,
+                                    desired_format, cache_control)
+        carving = LIQUID_CARVES[(bucket, param_name)] = Future()
+
     # Process the image
-    img = stubbornly_load_image(key.content, key.headers, path)
+    try:
+        img = await run_stage('decode', cancellation, load_original, key.content, key.headers, path, args,
+                              cancellation)
+    except BaseException:
+        settle_carve(bucket, param_name, carving)
+        raise
+    record_magick_usage(img)
     fmt = img.format.lower()
-    default_format = path_to_format(path)
     
     content_type = f"image/{normalize_mimetype(fmt)}"
-    desired_format = args.get('fm', default_format)
-    
-    pipeline = build_pipeline(args)
     
     # Check if processing is needed
     if (size != (img.width, img.height) or 
         desired_format != fmt or 
         args.get('q') is not None or 
+        args.get('rect') or
         len(pipeline) > 0):
         
-        # Process image
-        img.compression_quality = args.get('q', DEFAULT_QUALITY)
-        processed_image = process_image(img, pipeline)
-        fmt = processed_image.format.lower()
-        content_type = f"image/{normalize_mimetype(desired_format)}"
-        
-        # Save to buffer
-        temp_handle = image_to_buffer(processed_image, fmt=desired_format, compress=False)
+        # Process and encode the image
+        try:
+            content = await run_stage(('transform', 'encode'), cancellation, render_image,
+                                      img, pipeline, args, desired_format, cancellation)
+        except LiquidTimeout as timeout:
+            # serve a crop for now, and store the real thing when it's done
+            cancellation.detach()
+            try:
+                img = await run_in_generation_pool(load_original, key.content, key.headers, path, args)
+                content = await run_in_generation_pool(render_image, img, liquid_fallback_pipeline(pipeline),
+                                                       args, desired_format)
+            except BaseException:
+                # nobody's going to finish the carve, let it go once it's done
+                timeout.future.add_done_callback(lambda future: close_image(timeout.img))
+                settle_carve(bucket, param_name, carving)
+                raise
+            response = liquid_crop_response(content, desired_format)
+            response.background = BackgroundTask(finish_liquid, timeout, pipeline, args, desired_format,
+                                                 bucket, param_name, carving)
+            return response
+        except LiquidCrop as crop:
+            # a crop's all we're going to get, serve it but don't store it as the carve
+            settle_carve(bucket, param_name, carving)
+            cancellation.detach()
+            content = await run_in_generation_pool(render_image, crop.img, after_liquid(pipeline),
+                                                   args, desired_format)
+            return liquid_crop_response(content, desired_format)
+        except BaseException:
+            settle_carve(bucket, param_name, carving)
+            raise
+        settle_carve(bucket, param_name, carving, content)
+        content_type = format_content_type(desired_format)
         
         # Upload to S3 cache
-        s3.upload(param_name, temp_handle, bucket=bucket, 
-                 content_type=content_type, rewind=True, public=True)
+        # BytesIO over bytes shares them rather than copying
+        await run_stage('upload', cancellation, s3.upload, param_name, BytesIO(content), bucket=bucket,
+                        content_type=content_type, public=True)
         
-        temp_handle.seek(0)
+        etag = content_etag(content)
+        last_modified = formatdate(usegmt=True)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified(etag, last_modified, cache_control)
         return Response(
-            content=temp_handle.read(),
+            content=content,
             media_type=content_type,
-            headers={"Cache-Control": CACHE_CONTROL}
+            headers=validator_headers(etag, last_modified, cache_control)
         )
     else:
         # Return original
+        close_image(img)
+        if is_not_modified(request, meta.etag, meta.last_modified):
+            return not_modified(meta.etag, meta.last_modified, cache_control)
         return Response(
             content=key.content,
             media_type=content_type,
-            headers={"Cache-Control": CACHE_CONTROL}
+            headers=validator_headers(meta.etag, meta.last_modified, cache_control)
         )
 
 
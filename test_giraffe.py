@@ -3,8 +3,15 @@ Tests for FastAPI version of Giraffe
 """
 
 from collections import OrderedDict
+from io import BytesIO
+import asyncio
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 import mock
 import pytest
@@ -14,8 +21,9 @@ from fastapi.testclient import TestClient
 from fastapi import HTTPException
 from wand.color import Color
 from wand.drawing import Drawing
-from wand.exceptions import MissingDelegateError
+from wand.exceptions import MissingDelegateError, ResourceLimitError
 from wand.image import Image
+import wand.exceptions
 import giraffe
 
 
@@ -30,6 +38,7 @@ class FastAPITestCase(unittest.TestCase):
             'GIRAFFE_CACHE_DIR': 'test_cache'
         })
         self.env_patcher.start()
+        giraffe.clear_caches()
         
         # Create test client
         self.client = TestClient(giraffe.app)
@@ -38,9 +47,31 @@ class FastAPITestCase(unittest.TestCase):
         self.env_patcher.stop()
 
 
+def make_ranged_get(content, etag='"abc"'):
+    """
+    Fake ``s3.get`` that answers ``Range`` requests the way S3 does
+    """
+    def get(path, bucket=None, headers=None):
+        obj = mock.Mock()
+        obj.headers = {'content-type': 'image/jpeg', 'etag': etag}
+        byte_range = giraffe.parse_range((headers or {}).get('Range'))
+        if byte_range is None:
+            obj.status_code = 200
+            obj.content = content
+            return obj
+        start, end = byte_range
+        end = len(content) - 1 if end is None else min(end, len(content) - 1)
+        obj.status_code = 206
+        obj.content = content[start:end + 1]
+        obj.headers['content-range'] = "bytes {}-{}/{}".format(start, end, len(content))
+        return obj
+    return get
+
+
 def make_httperror(code):
     response = mock.Mock()
     response.status_code = code
+    response.headers = {}
     e = requests.exceptions.HTTPError()
     e.response = response
     return e
@@ -195,6 +226,192 @@ class TestGetImageArgs(unittest.TestCase):
         self.assertEqual(giraffe.get_image_args({"fm": "png"}), {"fm": "png"})
 
 
+class TestCanonicalizeArgs(unittest.TestCase):
+    def test_order(self):
+        args = giraffe.canonicalize_args(OrderedDict([('h', 100), ('w', 100)]), "jpg")
+        self.assertEqual(list(args.items()), [('w', 100), ('h', 100)])
+
+    def test_default_quality_dropped(self):
+        self.assertEqual(
+            giraffe.canonicalize_args({'w': 100, 'q': 75}, "jpg"), {'w': 100}
+        )
+
+    def test_default_quality_alone_kept(self):
+        self.assertEqual(giraffe.canonicalize_args({'q': 75}, "jpg"), {'q': 75})
+
+    def test_flip_order(self):
+        self.assertEqual(giraffe.canonicalize_args({'flip': 'vh'}, "jpg"), {'flip': 'hv'})
+        self.assertEqual(giraffe.canonicalize_args({'flip': 'x'}, "jpg"), {})
+
+    def test_format_alias(self):
+        self.assertEqual(giraffe.canonicalize_args({'fm': 'jpeg'}, "png"), {'fm': 'jpg'})
+        self.assertEqual(
+            giraffe.canonicalize_args({'w': 10, 'fm': 'JPEG'}, "jpg"), {'w': 10}
+        )
+
+    def test_bad_format(self):
+        self.assertRaises(HTTPException, giraffe.canonicalize_args, {'fm': 'tiff'}, "jpg")
+
+    def test_zero_rotation_dropped(self):
+        self.assertEqual(giraffe.canonicalize_args({'rot': 0}, "jpg"), {})
+
+    def test_fit_needs_width_and_height(self):
+        self.assertEqual(
+            giraffe.canonicalize_args({'w': 100, 'fit': 'crop'}, "jpg"), {'w': 100}
+        )
+
+    def test_overlay_args_need_overlay(self):
+        self.assertEqual(
+            giraffe.canonicalize_args({'w': 100, 'bg': 'FFF', 'ox': 10}, "jpg"), {'w': 100}
+        )
+        self.assertEqual(
+            giraffe.canonicalize_args({'overlay': '/b/o.png', 'bg': 'FFF'}, "jpg"),
+            {'bg': 'fff', 'overlay': '/b/o.png'},
+        )
+
+
+class TestCacheKeys(unittest.TestCase):
+    def test_legacy_path(self):
+        self.assertEqual(
+            giraffe.calculate_new_path("foo", "bar", "jpg", {'w': 100, 'h': 100}),
+            "giraffe/foo/bar_w100_h100.jpg",
+        )
+
+    def test_hashed_path(self):
+        key = giraffe.calculate_hashed_path("foo", "bar", "jpg", {'w': 100, 'h': 100})
+        cache_dir, shard1, shard2, name = key.split("/")
+        digest, ext = name.split(".")
+        self.assertEqual(cache_dir, "giraffe")
+        self.assertEqual(len(digest), giraffe.CACHE_KEY_DIGEST_LENGTH)
+        self.assertEqual(shard1 + shard2, digest[:4])
+        self.assertEqual(ext, "jpg")
+
+    def test_hashed_path_format(self):
+        key = giraffe.calculate_hashed_path("foo", "bar", "jpg", {'fm': 'png'})
+        self.assertTrue(key.endswith(".png"))
+
+    def test_hashed_path_depends_on_args(self):
+        self.assertNotEqual(
+            giraffe.calculate_hashed_path("foo", "bar", "jpg", {'w': 100}),
+            giraffe.calculate_hashed_path("foo", "bar", "jpg", {'w': 101}),
+        )
+        self.assertNotEqual(
+            giraffe.calculate_hashed_path("foo", "bar", "jpg", {'w': 100}),
+            giraffe.calculate_hashed_path("foo", "bar", "png", {'w': 100}),
+        )
+
+    @mock.patch('giraffe.CACHE_KEY_SCHEME', 'migrate')
+    def test_migrate_keys(self):
+        args = {'w': 100}
+        self.assertEqual(
+            giraffe.calculate_cache_keys("foo", "bar", "jpg", args),
+            [giraffe.calculate_hashed_path("foo", "bar", "jpg", args),
+             giraffe.calculate_new_path("foo", "bar", "jpg", args)],
+        )
+
+
+class TestVersionedCacheKeys(unittest.TestCase):
+    def test_object_version(self):
+        self.assertEqual(
+            giraffe.object_version('"9b2cf535f27731c974343645a3985328"'), "9b2cf535f27731c9"
+        )
+        self.assertEqual(giraffe.object_version('"abc-2"'), "abc2")
+        self.assertIsNone(giraffe.object_version(None))
+
+    def test_versioned_cache_key(self):
+        self.assertEqual(
+            giraffe.versioned_cache_key("giraffe/foo/bar_w100.jpg", "abc"),
+            "giraffe/foo/bar_w100_vabc.jpg",
+        )
+
+    def test_unversioned_cache_key(self):
+        self.assertEqual(
+            giraffe.versioned_cache_key("giraffe/foo/bar_w100.jpg", None),
+            "giraffe/foo/bar_w100.jpg",
+        )
+
+
+class TestGetObjectMetadata(unittest.TestCase):
+    bucket = "test.giraffe.bucket"
+
+    def setUp(self):
+        giraffe.clear_caches()
+
+    @mock.patch('giraffe.s3')
+    def test_metadata_is_cached(self, s3):
+        s3.head_object.return_value.headers = {
+            'etag': '"abc"', 'content-type': 'image/jpeg', 'content-length': '10'
+        }
+        meta = giraffe.get_object_metadata(self.bucket, "redbull.jpg")
+        self.assertEqual(meta.etag, '"abc"')
+        self.assertEqual(meta.size, 10)
+        self.assertEqual(giraffe.get_object_metadata(self.bucket, "redbull.jpg"), meta)
+        self.assertEqual(s3.head_object.call_count, 1)
+
+        giraffe.get_object_metadata(self.bucket, "redbull.jpg", refresh=True)
+        self.assertEqual(s3.head_object.call_count, 2)
+
+    @mock.patch('giraffe.s3')
+    def test_missing_object(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
+        self.assertIsNone(giraffe.get_object_metadata(self.bucket, "redbull.jpg"))
+
+
+class TestParseRange(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(giraffe.parse_range("bytes=0-499"), (0, 499))
+        self.assertEqual(giraffe.parse_range("bytes=500-"), (500, None))
+        self.assertEqual(giraffe.parse_range("bytes=-500"), (-500, None))
+
+    def test_unsupported(self):
+        self.assertIsNone(giraffe.parse_range(None))
+        self.assertIsNone(giraffe.parse_range("bytes=0-1,5-6"))
+        self.assertIsNone(giraffe.parse_range("items=0-1"))
+        self.assertIsNone(giraffe.parse_range("bytes=10-5"))
+        self.assertIsNone(giraffe.parse_range("bytes=a-b"))
+        self.assertIsNone(giraffe.parse_range("bytes=-0"))
+
+    def test_content_range_length(self):
+        self.assertEqual(giraffe.content_range_length("bytes 0-9/95"), 95)
+        self.assertIsNone(giraffe.content_range_length("bytes 0-9/*"))
+        self.assertIsNone(giraffe.content_range_length(None))
+
+
+class TestIsNotModified(unittest.TestCase):
+    def request(self, **headers):
+        request = mock.Mock()
+        request.headers = {k.lower().replace("_", "-"): v for k, v in headers.items()}
+        return request
+
+    def test_no_validators(self):
+        self.assertFalse(giraffe.is_not_modified(self.request(), '"abc"'))
+        self.assertFalse(giraffe.is_not_modified(None, '"abc"'))
+
+    def test_if_none_match(self):
+        self.assertTrue(giraffe.is_not_modified(self.request(if_none_match='"abc"'), '"abc"'))
+        self.assertTrue(giraffe.is_not_modified(self.request(if_none_match='"x", W/"abc"'), '"abc"'))
+        self.assertTrue(giraffe.is_not_modified(self.request(if_none_match='*'), '"abc"'))
+        self.assertFalse(giraffe.is_not_modified(self.request(if_none_match='"x"'), '"abc"'))
+
+    def test_if_modified_since(self):
+        request = self.request(if_modified_since="Wed, 21 Oct 2015 07:28:00 GMT")
+        self.assertTrue(
+            giraffe.is_not_modified(request, None, "Wed, 21 Oct 2015 07:28:00 GMT")
+        )
+        self.assertFalse(
+            giraffe.is_not_modified(request, None, "Thu, 22 Oct 2015 07:28:00 GMT")
+        )
+        self.assertFalse(giraffe.is_not_modified(request, None, "garbage"))
+
+    def test_if_none_match_wins(self):
+        request = self.request(
+            if_none_match='"x"', if_modified_since="Wed, 21 Oct 2015 07:28:00 GMT"
+        )
+        self.assertFalse(
+            giraffe.is_not_modified(request, '"abc"', "Wed, 21 Oct 2015 07:28:00 GMT")
+        )
+
+
 class TestGetObjectOrNone(unittest.TestCase):
     """
     This function is used to retrieve an object from S3
@@ -215,8 +432,119 @@ class TestGetObjectOrNone(unittest.TestCase):
         self.assertEqual(giraffe.get_object_or_none(self.bucket, "redbull.jpg"), 'foo')
 
 
-class TestGetFileOr404(unittest.TestCase):
-    pass
+class TestGetFileOr404(FastAPITestCase):
+    bucket = "wtf"
+
+    @mock.patch('giraffe.s3')
+    def test_validators(self, s3):
+        obj = mock.Mock()
+        obj.status_code = 200
+        obj.content = b"not really a jpeg"
+        obj.headers = {
+            'content-type': 'image/jpeg',
+            'etag': '"abc"',
+            'last-modified': "Wed, 21 Oct 2015 07:28:00 GMT",
+        }
+        s3.get.return_value = obj
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["etag"], '"abc"')
+        self.assertEqual(r.headers["last-modified"], "Wed, 21 Oct 2015 07:28:00 GMT")
+
+    @mock.patch('giraffe.s3')
+    def test_not_modified(self, s3):
+        obj = mock.Mock()
+        obj.status_code = 304
+        obj.content = b""
+        obj.headers = {'etag': '"abc"'}
+        s3.get.return_value = obj
+        r = self.client.get(
+            "/{}/redbull.jpg".format(self.bucket), headers={"If-None-Match": '"abc"'}
+        )
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers["etag"], '"abc"')
+        # S3 did the comparison, so it needs to have been given the validator
+        args, kwargs = s3.get.call_args
+        self.assertEqual(kwargs['headers']['If-None-Match'], '"abc"')
+
+    @mock.patch('giraffe.STREAM_CHUNK_SIZE', 10)
+    @mock.patch('giraffe.s3')
+    def test_streamed_in_chunks(self, s3):
+        content = bytes(range(95))
+        s3.get.side_effect = make_ranged_get(content)
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, content)
+        self.assertEqual(r.headers["content-length"], "95")
+        self.assertEqual(r.headers["accept-ranges"], "bytes")
+        self.assertEqual(s3.get.call_count, 10)
+        # later chunks are pinned to the version we started streaming
+        args, kwargs = s3.get.call_args
+        self.assertEqual(kwargs['headers'], {'Range': 'bytes=90-94', 'If-Match': '"abc"'})
+
+    @mock.patch('giraffe.s3')
+    def test_small_object_in_one_chunk(self, s3):
+        s3.get.side_effect = make_ranged_get(b"tiny")
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b"tiny")
+        self.assertEqual(s3.get.call_count, 1)
+
+    @mock.patch('giraffe.STREAM_CHUNK_SIZE', 10)
+    @mock.patch('giraffe.s3')
+    def test_range(self, s3):
+        content = bytes(range(95))
+        s3.get.side_effect = make_ranged_get(content)
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket), headers={"Range": "bytes=5-24"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, content[5:25])
+        self.assertEqual(r.headers["content-range"], "bytes 5-24/95")
+
+    @mock.patch('giraffe.s3')
+    def test_open_ended_range(self, s3):
+        content = bytes(range(95))
+        s3.get.side_effect = make_ranged_get(content)
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket), headers={"Range": "bytes=90-"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, content[90:])
+        self.assertEqual(r.headers["content-range"], "bytes 90-94/95")
+
+    @mock.patch('giraffe.s3')
+    def test_suffix_range(self, s3):
+        content = bytes(range(95))
+        s3.head_object.return_value.headers = {'content-length': '95'}
+        s3.get.side_effect = make_ranged_get(content)
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket), headers={"Range": "bytes=-5"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, content[90:])
+
+    @mock.patch('giraffe.s3')
+    def test_suffix_range_of_a_missing_variant(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
+        self.assertIsNone(giraffe.serve_object(self.bucket, "giraffe/redbull_w100.jpg",
+                                               mock.Mock(headers={"range": "bytes=-5"})))
+        # which says nothing about the original
+        self.assertFalse(giraffe.known_missing(self.bucket, "giraffe/redbull_w100.jpg"))
+        self.assertIsNone(giraffe.ORIGINAL_METADATA.get((self.bucket, "giraffe/redbull_w100.jpg")))
+
+    @mock.patch('giraffe.s3')
+    def test_unsatisfiable_range(self, s3):
+        s3.get.side_effect = make_httperror(416)
+        s3.head_object.return_value.headers = {'content-length': '95'}
+        r = self.client.get("/{}/redbull.jpg".format(self.bucket), headers={"Range": "bytes=500-"})
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(r.headers["content-range"], "bytes */95")
+
+    @mock.patch('giraffe.s3')
+    def test_stale_if_range(self, s3):
+        content = bytes(range(95))
+        s3.get.side_effect = make_ranged_get(content)
+        r = self.client.get(
+            "/{}/redbull.jpg".format(self.bucket),
+            headers={"Range": "bytes=5-24", "If-Range": '"old"'},
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, content)
 
 
 class TestImageToBuffer(unittest.TestCase):
@@ -245,6 +573,11 @@ class TestImageToBuffer(unittest.TestCase):
         buffer = giraffe.image_to_buffer(self.image)
         self.assertEqual(buffer.getvalue(), giraffe.image_to_binary(self.image))
 
+    def test_encode_image(self):
+        blob = giraffe.encode_image(self.image, 'png')
+        self.assertIsInstance(blob, bytes)
+        self.assertEqual(Image(blob=blob).format, 'PNG')
+
 
 class TestImageResize(unittest.TestCase):
     def setUp(self):
@@ -328,6 +661,7 @@ class TestImageRoute(FastAPITestCase):
 
     @mock.patch('giraffe.s3')
     def test_image_resize_original_doesnt_exist(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
         s3.get.side_effect = make_httperror(404)
         r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
         self.assertEqual(r.status_code, 404)
@@ -360,7 +694,7 @@ class TestImageRoute(FastAPITestCase):
         obj.content = self.image.make_blob("jpeg")
         obj.headers = {'content-type': 'image/jpeg'}
 
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.jpg?fm=png".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
@@ -374,9 +708,9 @@ class TestImageRoute(FastAPITestCase):
     def test_image_exists_but_needs_to_be_resized(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("jpeg")
-        # we'll call s3.get twice, the first time we'll get the original file, the second time
-        # we'll be calling to check for the specific version of the object.
-        s3.get.side_effect = [obj, make_httperror(404)]
+        # we'll call s3.get twice, the first time we'll be calling to check for the specific
+        # version of the object, the second time we'll get the original file.
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (100, 100))
@@ -385,9 +719,9 @@ class TestImageRoute(FastAPITestCase):
     def test_image_exists_but_user_wants_unnecessary_resize(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("jpeg")
-        # we'll call s3.get twice, the first time we'll get the original file, the second time
-        # we'll be calling to check for the specific version of the object.
-        s3.get.side_effect = [obj, make_httperror(404)]
+        # we'll call s3.get twice, the first time we'll be calling to check for the specific
+        # version of the object, the second time we'll get the original file.
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.jpg?w=1920&h=1080".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (1920, 1080))
@@ -402,9 +736,9 @@ class TestImageRoute(FastAPITestCase):
             img.resize(100, 100)
             obj2.content = img.make_blob("jpeg")
         obj2.headers = {'content-type': 'image/jpeg'}
-        # we'll call s3.get twice, the first time we'll get the original file, the second time
-        # we'll be calling to check for the specific version of the object.
-        s3.get.side_effect = [obj, obj2]
+        # we'll only call s3.get once, to find the specific version of the object, the original
+        # file doesn't need to be downloaded.
+        s3.get.side_effect = [obj2]
         r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (100, 100))
@@ -426,7 +760,7 @@ class TestImageRoute(FastAPITestCase):
     def test_png_exists_but_needs_format_as_jpg(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.png?fm=jpg".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
@@ -441,7 +775,7 @@ class TestImageRoute(FastAPITestCase):
         # yep, if someone uses "fm=jpeg" instead of "fm=jpg" it should still work
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.png?fm=jpeg".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
@@ -452,9 +786,9 @@ class TestImageRoute(FastAPITestCase):
     def test_png_exists_but_needs_to_be_resized(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        # we'll call s3.get twice, the first time we'll get the original file, the second time
-        # we'll be calling to check for the specific version of the object.
-        s3.get.side_effect = [obj, make_httperror(404)]
+        # we'll call s3.get twice, the first time we'll be calling to check for the specific
+        # version of the object, the second time we'll get the original file.
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.png?w=100&h=100".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (100, 100))
@@ -463,9 +797,9 @@ class TestImageRoute(FastAPITestCase):
     def test_png_exists_but_user_wants_unnecessary_resize(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        # we'll call s3.get twice, the first time we'll get the original file, the second time
-        # we'll be calling to check for the specific version of the object.
-        s3.get.side_effect = [obj, make_httperror(404)]
+        # we'll call s3.get twice, the first time we'll be calling to check for the specific
+        # version of the object, the second time we'll get the original file.
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/redbull.png?w=1920&h=1080".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (1920, 1080))
@@ -480,9 +814,9 @@ class TestImageRoute(FastAPITestCase):
             img.resize(100, 100)
             obj2.content = img.make_blob("png")
         obj2.headers = {'content-type': 'image/png'}
-        # we'll call s3.get twice, the first time we'll get the original file, the second time
-        # we'll be calling to check for the specific version of the object.
-        s3.get.side_effect = [obj, obj2]
+        # we'll only call s3.get once, to find the specific version of the object, the original
+        # file doesn't need to be downloaded.
+        s3.get.side_effect = [obj2]
         r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (100, 100))
@@ -512,7 +846,7 @@ class TestImageRoute(FastAPITestCase):
         self.image = Image(width=160, height=120)
         obj.content = self.image.make_blob("gif")
         obj.headers = {'content-type': 'image/jpeg'}
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/masquerading_gif.jpg?w=120&h=120".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
@@ -526,7 +860,7 @@ class TestImageRoute(FastAPITestCase):
         self.image = Image(width=12402, height=8770)
         obj.content = self.image.make_blob("jpg")
         obj.headers = {'content-type': 'image/jpeg'}
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/giant.jpg?w=120&h=120".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
@@ -539,7 +873,7 @@ class TestImageRoute(FastAPITestCase):
         image = Image(width=16, height=16)
         obj.content = image.make_blob('ico')
         obj.headers = {'content-type': 'image/jpeg'}  # this is what S3 tells us =(
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/giant.jpg?w=64&h=64".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
@@ -552,13 +886,162 @@ class TestImageRoute(FastAPITestCase):
         image = Image(width=16, height=16)
         obj.content = image.make_blob('ico')
         obj.headers = {'content-type': 'image/jpeg'}  # this is what S3 tells us =(
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         r = self.client.get("/{}/giant.jpg?w=400&h=400".format(self.bucket))
         self.assertEqual(r.status_code, 200)
         content_type = r.headers.get("content-type")
         self.assertEqual(content_type, "image/jpeg")
         self.assertEqual(Image(blob=r.content, format='jpeg').size, (400, 400))
 
+    @mock.patch('giraffe.CACHE_KEY_SCHEME', 'migrate')
+    @mock.patch('giraffe.s3')
+    def test_legacy_key_found_while_migrating(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("jpeg")
+        obj2 = mock.Mock()
+        with self.image.clone() as img:
+            img.resize(100, 100)
+            obj2.content = img.make_blob("jpeg")
+        obj2.headers = {'content-type': 'image/jpeg'}
+        # 1. hashed key, 2. legacy key
+        s3.get.side_effect = [make_httperror(404), obj2]
+        r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Image(blob=r.content).size, (100, 100))
+        args, kwargs = s3.copy.call_args
+        self.assertEqual(args[0], "giraffe/redbull_w100_h100.jpg")
+        self.assertEqual(args[2], s3.get.call_args_list[0][0][0])
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.CACHE_KEY_SCHEME', 'migrate')
+    @mock.patch('giraffe.s3')
+    def test_legacy_key_served_when_copying_fails(self, s3):
+        obj = mock.Mock()
+        with self.image.clone() as img:
+            img.resize(100, 100)
+            obj.content = img.make_blob("jpeg")
+        obj.headers = {'content-type': 'image/jpeg'}
+        s3.get.side_effect = [make_httperror(404), obj]
+        s3.copy.side_effect = make_httperror(500)
+        r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Image(blob=r.content).size, (100, 100))
+        self.assertTrue(s3.copy.called)
+
+    @mock.patch('giraffe.VERSIONED_CACHE_KEYS', True)
+    @mock.patch('giraffe.s3')
+    def test_versioned_cache_key(self, s3):
+        headers = {'content-type': 'image/jpeg', 'etag': '"9b2cf535f27731c974343645a3985328"'}
+        s3.head_object.return_value.headers = headers
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("jpeg")
+        obj.headers = headers
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["cache-control"], giraffe.CACHE_CONTROL)
+        self.assertEqual(
+            s3.get.call_args_list[0][0][0], "giraffe/redbull_w100_h100_v9b2cf535f27731c9.jpg"
+        )
+        args, kwargs = s3.upload.call_args
+        self.assertEqual(args[0], "giraffe/redbull_w100_h100_v9b2cf535f27731c9.jpg")
+
+    @mock.patch('giraffe.VERSIONED_CACHE_KEYS', True)
+    @mock.patch('giraffe.CACHE_KEY_SCHEME', 'migrate')
+    @mock.patch('giraffe.s3')
+    def test_unversioned_legacy_key_found_while_migrating(self, s3):
+        s3.head_object.return_value.headers = {'etag': '"9b2cf535f27731c974343645a3985328"'}
+        obj2 = mock.Mock()
+        with self.image.clone() as img:
+            img.resize(100, 100)
+            obj2.content = img.make_blob("jpeg")
+        obj2.headers = {'content-type': 'image/jpeg'}
+        # 1. versioned hashed key, 2. versioned legacy key, 3. legacy key from before versioning
+        s3.get.side_effect = [make_httperror(404), make_httperror(404), obj2]
+        r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Image(blob=r.content).size, (100, 100))
+        names = [call[0][0] for call in s3.get.call_args_list]
+        self.assertEqual(names[1], "giraffe/redbull_w100_h100_v9b2cf535f27731c9.jpg")
+        self.assertEqual(names[2], "giraffe/redbull_w100_h100.jpg")
+        args, kwargs = s3.copy.call_args
+        self.assertEqual(args[0], "giraffe/redbull_w100_h100.jpg")
+        self.assertEqual(args[2], names[0])
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.VERSIONED_CACHE_KEYS', True)
+    @mock.patch('giraffe.s3')
+    def test_versioned_url_is_immutable(self, s3):
+        s3.head_object.return_value.headers = {'etag': '"9b2cf535f27731c974343645a3985328"'}
+        obj2 = mock.Mock()
+        with self.image.clone() as img:
+            img.resize(100, 100)
+            obj2.content = img.make_blob("jpeg")
+        obj2.headers = {'content-type': 'image/jpeg'}
+        s3.get.side_effect = [obj2]
+        r = self.client.get(
+            "/{}/redbull.jpg?w=100&h=100&v=9b2cf535f27731c9".format(self.bucket)
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["cache-control"], giraffe.IMMUTABLE_CACHE_CONTROL)
+
+    @mock.patch('giraffe.VERSIONED_CACHE_KEYS', True)
+    @mock.patch('giraffe.s3')
+    def test_stale_version_url_is_not_immutable(self, s3):
+        s3.head_object.return_value.headers = {'etag': '"9b2cf535f27731c974343645a3985328"'}
+        obj2 = mock.Mock()
+        obj2.content = self.image.make_blob("jpeg")
+        obj2.headers = {'content-type': 'image/jpeg'}
+        s3.get.side_effect = [obj2]
+        r = self.client.get("/{}/redbull.jpg?w=100&h=100&v=0000".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["cache-control"], giraffe.CACHE_CONTROL)
+
+    @mock.patch('giraffe.s3')
+    def test_generated_image_etag(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("jpeg")
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get("/{}/redbull.jpg?w=100&h=100".format(self.bucket))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["etag"], giraffe.content_etag(r.content))
+        self.assertIn("last-modified", r.headers)
+
+    @mock.patch('giraffe.s3')
+    def test_resized_image_not_modified(self, s3):
+        obj2 = mock.Mock()
+        obj2.status_code = 304
+        obj2.headers = {'etag': '"abc"'}
+        s3.get.side_effect = [obj2]
+        r = self.client.get(
+            "/{}/redbull.jpg?w=100&h=100".format(self.bucket),
+            headers={"If-None-Match": '"abc"'},
+        )
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b"")
+
+    @mock.patch('giraffe.CANONICAL_REDIRECT', True)
+    def test_non_canonical_url_redirects(self):
+        r = self.client.get(
+            "/{}/redbull.jpg?h=100&w=100&q=75&flip=vh".format(self.bucket),
+            follow_redirects=False,
+        )
+        self.assertEqual(r.status_code, 301)
+        self.assertEqual(
+            r.headers["location"], "/{}/redbull.jpg?w=100&h=100&flip=hv".format(self.bucket)
+        )
+
+    @mock.patch('giraffe.CANONICAL_REDIRECT', True)
+    @mock.patch('giraffe.s3')
+    def test_canonical_url_does_not_redirect(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("jpeg")
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get(
+            "/{}/redbull.jpg?w=100&h=100".format(self.bucket), follow_redirects=False
+        )
+        self.assertEqual(r.status_code, 200)
+
 
 class TestOverlayRoutes(FastAPITestCase):
     bucket = "wtf"
@@ -572,8 +1055,8 @@ class TestOverlayRoutes(FastAPITestCase):
     def test_image_overlay_relative_url(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        # s3 requests for 1. original image, 2. generated image with overlay, 3. overlay
-        s3.get.side_effect = [obj, make_httperror(404), obj]
+        # s3 requests for 1. generated image with overlay, 2. original image, 3. overlay
+        s3.get.side_effect = [make_httperror(404), obj, obj]
         r = self.client.get(
             "/{b}/art.png?overlay=/{b}/tshirts/overlay.png&bg=451D74".format(
                 b=self.bucket
@@ -588,8 +1071,8 @@ class TestOverlayRoutes(FastAPITestCase):
         # then you don't need the background color
         obj = mock.Mock()
         obj.content = self.image.make_blob("jpg")
-        # s3 requests for 1. original image, 2. generated image with overlay, 3. overlay
-        s3.get.side_effect = [obj, make_httperror(404), obj]
+        # s3 requests for 1. generated image with overlay, 2. original image, 3. overlay
+        s3.get.side_effect = [make_httperror(404), obj, obj]
         r = self.client.get(
             "/{b}/art.jpg?overlay=/{b}/tshirts/overlay.png".format(b=self.bucket)
         )
@@ -601,7 +1084,7 @@ class TestOverlayRoutes(FastAPITestCase):
     def test_image_overlay_absolute_url(self, s3, requests):
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        s3.get.side_effect = [obj, make_httperror(404)]
+        s3.get.side_effect = [make_httperror(404), obj]
         requests.get.side_effect = [obj]
 
         r = self.client.get(
@@ -616,7 +1099,7 @@ class TestOverlayRoutes(FastAPITestCase):
     def test_image_overlay_resize(self, s3):
         obj = mock.Mock()
         obj.content = self.image.make_blob("png")
-        s3.get.side_effect = [obj, make_httperror(404), obj]
+        s3.get.side_effect = [make_httperror(404), obj, obj]
         r = self.client.get(
             "/{b}/art.png?overlay=/{b}/tshirts/overlay.png&bg=451D74&w=100&h=100".format(
                 b=self.bucket
@@ -625,6 +1108,1545 @@ class TestOverlayRoutes(FastAPITestCase):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Image(blob=r.content).size, (100, 100))
 
+    @mock.patch('giraffe.s3')
+    def test_overlay_is_cached(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("png")
+        # the second design only needs 1. its generated image and 2. its original
+        s3.get.side_effect = [make_httperror(404), obj, obj, make_httperror(404), obj]
+        for name in ("art.png", "other-art.png"):
+            r = self.client.get(
+                "/{b}/{n}?overlay=/{b}/tshirts/overlay.png&bg=451D74".format(b=self.bucket, n=name)
+            )
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(s3.get.call_count, 5)
+
+    @mock.patch('giraffe.s3')
+    def test_overlay_cache_follows_etag(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("png")
+        s3.get.side_effect = [obj, obj]
+        s3.head_object.return_value.headers = {'etag': '"v1"'}
+        giraffe.prepare_overlay(self.bucket, "/tshirts/overlay.png", "/b/tshirts/overlay.png", "fff")
+        giraffe.prepare_overlay(self.bucket, "/tshirts/overlay.png", "/b/tshirts/overlay.png", "fff")
+        self.assertEqual(s3.get.call_count, 1)
+        # the overlay is replaced, and we notice once its HEAD expires
+        s3.head_object.return_value.headers = {'etag': '"v2"'}
+        giraffe.ORIGINAL_METADATA.clear()
+        giraffe.prepare_overlay(self.bucket, "/tshirts/overlay.png", "/b/tshirts/overlay.png", "fff")
+        self.assertEqual(s3.get.call_count, 2)
+        self.assertIn(("/b/tshirts/overlay.png", '"v2"', "fff"), giraffe.PREPARED_OVERLAYS._data)
+
+    @mock.patch('giraffe.s3')
+    def test_each_request_gets_its_own_overlay(self, s3):
+        s3.get.return_value = mock.Mock(content=self.image.make_blob("png"))
+        s3.head_object.return_value.headers = {'etag': '"v1"'}
+        first = giraffe.prepare_overlay(self.bucket, "/tshirts/overlay.png", "/b/tshirts/overlay.png", "fff")
+        second = giraffe.prepare_overlay(self.bucket, "/tshirts/overlay.png", "/b/tshirts/overlay.png", "fff")
+        self.assertEqual(s3.get.call_count, 1)
+        for mine, theirs in zip(first, second):
+            self.assertIsNot(mine, theirs)
+        cached = [shared.img for expires, shared, weight in giraffe.PREPARED_OVERLAYS._data.values()]
+        self.assertFalse(set(map(id, cached)) & set(map(id, first + second)))
+        # and they're closed once they're let go
+        giraffe.PREPARED_OVERLAYS.clear()
+        self.assertTrue(all(giraffe.image_closed(img) for img in cached))
+
+
+class TestMockupsRoute(FastAPITestCase):
+    bucket = "bucket"
+
+    def setUp(self):
+        super().setUp()
+        with Color('red') as bg:
+            with Image(width=1000, height=1000, background=bg) as overlay:
+                self.overlay = mock.Mock(content=overlay.make_blob("png"), headers={})
+        with Color('blue') as bg:
+            with Image(width=400, height=400, background=bg) as design:
+                self.design = mock.Mock(content=design.make_blob("png"), headers={})
+
+    def s3(self, s3, cached=()):
+        def head_object(key, bucket=None):
+            if key.startswith(giraffe.CACHE_DIR) and key not in cached:
+                raise make_httperror(404)
+            return mock.Mock(headers={'etag': '"{}"'.format(key)})
+
+        def get(key, bucket=None, headers=None):
+            return self.design if key == "art.png" else self.overlay
+
+        s3.head_object.side_effect = head_object
+        s3.get.side_effect = get
+
+    def post(self, *overlays, **kwargs):
+        return self.client.post("/mockups/{}/art.png".format(self.bucket),
+                                json=dict(kwargs, overlays=list(overlays)))
+
+    @mock.patch('giraffe.s3')
+    def test_mockups(self, s3):
+        self.s3(s3)
+        r = self.post(
+            {'overlay': '/bucket/tshirts/red.png', 'bg': '451D74'},
+            {'overlay': '/bucket/tshirts/blue.png', 'bg': '451D74'},
+            {'overlay': '/bucket/tshirts/red.png', 'ox': 10, 'oy': 10, 'ow': 100, 'oh': 100},
+        )
+        self.assertEqual(r.status_code, 200)
+        mockups = r.json()['mockups']
+        self.assertEqual([m['status'] for m in mockups], ['generated'] * 3)
+        self.assertEqual(mockups[0]['url'], "/bucket/art.png?bg=451d74&overlay=/bucket/tshirts/red.png")
+        self.assertEqual(
+            mockups[0]['key'],
+            giraffe.calculate_cache_keys("", "art", "png", giraffe.canonicalize_args(
+                {'overlay': '/bucket/tshirts/red.png', 'bg': '451D74'}, "png"))[0]
+        )
+        # the design is only downloaded once
+        keys = [args[0] for args, kwargs in s3.get.call_args_list]
+        self.assertEqual(keys.count("art.png"), 1)
+        uploaded = {args[0]: args[1] for args, kwargs in s3.upload.call_args_list}
+        self.assertEqual(set(uploaded), {m['key'] for m in mockups})
+        self.assertEqual(Image(blob=uploaded[mockups[0]['key']].getvalue()).size, (1000, 1000))
+
+    @mock.patch('giraffe.s3')
+    def test_mockups_render_one_at_a_time(self, s3):
+        self.s3(s3)
+        rendering = []
+        most = []
+
+        def render_mockup(bucket, design, mockup, default_format):
+            rendering.append(mockup['key'])
+            most.append(len(rendering))
+            time.sleep(0.01)
+            rendering.remove(mockup['key'])
+
+        with mock.patch('giraffe.render_mockup', side_effect=render_mockup):
+            r = self.post(*({'overlay': f'/bucket/tshirts/{i}.png'} for i in range(6)))
+        self.assertEqual([m['status'] for m in r.json()['mockups']], ['generated'] * 6)
+        self.assertEqual(max(most), 1)
+
+    @mock.patch('giraffe.s3')
+    def test_cached_mockups_are_not_regenerated(self, s3):
+        key = giraffe.calculate_cache_keys("", "art", "png", OrderedDict(overlay='/bucket/tshirts/red.png'))[0]
+        self.s3(s3, cached=(key,))
+        r = self.post({'overlay': '/bucket/tshirts/red.png'})
+        self.assertEqual(r.json()['mockups'][0]['status'], 'cached')
+        self.assertFalse(s3.get.called)
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.s3')
+    def test_bad_overlay(self, s3):
+        self.s3(s3)
+        s3.get.side_effect = lambda key, bucket=None, headers=None: (
+            self.design if key == "art.png" else mock.Mock(content=b"", headers={}))
+        r = self.post({'overlay': '/bucket/tshirts/missing.png'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['mockups'][0]['status'], 'error')
+
+    @mock.patch('giraffe.s3')
+    def test_missing_original(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
+        r = self.post({'overlay': '/bucket/tshirts/red.png'})
+        self.assertEqual(r.status_code, 404)
+
+    @mock.patch('giraffe.MOCKUP_MAX_OVERLAYS', 1)
+    def test_too_many_overlays(self):
+        r = self.post({'overlay': '/bucket/a.png'}, {'overlay': '/bucket/b.png'})
+        self.assertEqual(r.status_code, 400)
+
+
+class TestSpriteRoute(FastAPITestCase):
+    bucket = "bucket"
+
+    def setUp(self):
+        super().setUp()
+        with Color('red') as bg:
+            with Image(width=200, height=100, background=bg) as image:
+                self.obj = mock.Mock(content=image.make_blob("png"), headers={})
+
+    def sprite_s3(self, s3, missing=()):
+        def get(key, bucket=None, headers=None):
+            if key.startswith(giraffe.CACHE_DIR) or key in missing:
+                raise make_httperror(404)
+            return self.obj
+        s3.get.side_effect = get
+
+    @mock.patch('giraffe.s3')
+    def test_sprite(self, s3):
+        self.sprite_s3(s3)
+        r = self.client.get("/sprites/bucket.png?paths=a.png&paths=b.png&paths=c.png&w=32&h=32")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "image/png")
+        # 3 images make a 2x2 grid
+        self.assertEqual(Image(blob=r.content).size, (64, 64))
+        uploaded = {args[0]: args[1].getvalue() for args, kwargs in s3.upload.call_args_list}
+        key = giraffe.sprite_cache_key("bucket", ["a.png", "b.png", "c.png"], 32, 32, 2)
+        self.assertEqual(set(uploaded), {key + ".png", key + ".json"})
+        self.assertEqual(json.loads(uploaded[key + ".json"])['images']['c.png'],
+                         {'x': 0, 'y': 32, 'w': 32, 'h': 32})
+
+    @mock.patch('giraffe.s3')
+    def test_sprite_map(self, s3):
+        self.sprite_s3(s3, missing=("b.png",))
+        r = self.client.get("/sprites/bucket.json?paths=a.png&paths=b.png&w=10&h=20&cols=1")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), {
+            'width': 10,
+            'height': 40,
+            'images': {'a.png': {'x': 0, 'y': 0, 'w': 10, 'h': 20}, 'b.png': None},
+        })
+        # until b.png turns up, the sheet isn't kept
+        self.assertEqual(r.headers["cache-control"], giraffe.SPRITE_INCOMPLETE_CACHE_CONTROL)
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.s3')
+    def test_undecodable_image_is_a_blank_cell(self, s3):
+        self.sprite_s3(s3)
+        real_thumbnail = giraffe.sprite_thumbnail
+
+        def sprite_thumbnail(obj, path, w, h):
+            if path == "b.png":
+                raise MissingDelegateError("no decode delegate for this image format")
+            return real_thumbnail(obj, path, w, h)
+
+        with mock.patch('giraffe.sprite_thumbnail', side_effect=sprite_thumbnail):
+            r = self.client.get("/sprites/bucket.json?paths=a.png&paths=b.png&w=10&h=20&cols=1")
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.json()['images']['b.png'])
+        self.assertIsNotNone(r.json()['images']['a.png'])
+
+    def test_cells_need_a_size(self):
+        for size in ("w=0", "h=-8", "w=-8&h=-8"):
+            r = self.client.get("/sprites/bucket.png?paths=a.png&" + size)
+            self.assertEqual(r.status_code, 400)
+
+    @mock.patch('giraffe.s3')
+    def test_thumbnails_decode_one_at_a_time(self, s3):
+        self.sprite_s3(s3)
+        decoding = []
+        most = []
+
+        def sprite_thumbnail(obj, path, w, h):
+            decoding.append(path)
+            most.append(len(decoding))
+            time.sleep(0.01)
+            decoding.remove(path)
+            return None
+
+        with mock.patch('giraffe.sprite_thumbnail', side_effect=sprite_thumbnail):
+            r = self.client.get("/sprites/bucket.json?" + "&".join(f"paths={i}.png" for i in range(8)))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(max(most), 1)
+
+    def test_columns_must_be_positive(self):
+        for cols in ("0", "-1"):
+            r = self.client.get("/sprites/bucket.png?paths=a.png&paths=b.png&cols=" + cols)
+            self.assertEqual(r.status_code, 400)
+
+    @mock.patch('giraffe.s3')
+    def test_cached_sprite(self, s3):
+        s3.get.side_effect = make_ranged_get(b"sprite", '"abc"')
+        r = self.client.get("/sprites/bucket.png?paths=a.png")
+        self.assertEqual(r.content, b"sprite")
+        key = giraffe.sprite_cache_key("bucket", ["a.png"], 64, 64, 1)
+        self.assertEqual(s3.get.call_args[0][0], key + ".png")
+        self.assertFalse(s3.upload.called)
+
+    def test_unknown_format(self):
+        r = self.client.get("/sprites/bucket.gif?paths=a.png")
+        self.assertEqual(r.status_code, 404)
+
+    @mock.patch('giraffe.SPRITE_MAX_IMAGES', 1)
+    def test_too_many_images(self):
+        r = self.client.get("/sprites/bucket.png?paths=a.png&paths=b.png")
+        self.assertEqual(r.status_code, 400)
+
+    def test_too_big(self):
+        r = self.client.get("/sprites/bucket.png?paths=a.png&w={}&h=2".format(giraffe.MAX_PIXELS))
+        self.assertEqual(r.status_code, 400)
+
+
+class TestBulkRoute(FastAPITestCase):
+    def setUp(self):
+        super().setUp()
+        with Color('red') as bg:
+            with Image(width=200, height=100, background=bg) as image:
+                self.png = image.make_blob("png")
+
+    def bulk_s3(self, s3):
+        originals = {"a.png": self.png, "b.png": self.png}
+
+        def get(key, bucket=None, headers=None):
+            if key not in originals:
+                raise make_httperror(404)
+            return mock.Mock(content=originals[key], status_code=200,
+                             headers={'content-type': 'image/png', 'etag': '"abc"'})
+
+        def head_object(key, bucket=None):
+            if key not in originals:
+                raise make_httperror(404)
+            return mock.Mock(headers={'etag': '"abc"'})
+
+        s3.get.side_effect = get
+        s3.head_object.side_effect = head_object
+
+    def items(self):
+        return [
+            {'bucket': 'bucket', 'path': 'a.png', 'params': {'w': 50}},
+            {'bucket': 'bucket', 'path': 'b.png'},
+            {'bucket': 'bucket', 'path': 'missing.png', 'params': {'w': 50}},
+        ]
+
+    @mock.patch('giraffe.s3')
+    def test_multipart(self, s3):
+        self.bulk_s3(s3)
+        r = self.client.post("/bulk", json={'items': self.items()})
+        self.assertEqual(r.status_code, 200)
+        content_type = r.headers["content-type"]
+        self.assertTrue(content_type.startswith("multipart/mixed; boundary="))
+        boundary = content_type.split("boundary=")[1]
+        parts = r.content.split(("--" + boundary).encode())
+        self.assertEqual(parts[-1], b"--\r\n")
+        parts = {}
+        for part in r.content.split(("--" + boundary).encode())[1:-1]:
+            head, body = part.split(b"\r\n\r\n", 1)
+            headers = dict(line.split(": ", 1) for line in head.decode().strip().split("\r\n"))
+            parts[int(headers["X-Giraffe-Index"])] = (headers, body[:-2])
+        self.assertEqual(set(parts), {0, 1, 2})
+        self.assertEqual(parts[0][0]["Content-Location"], "/bucket/a.png?w=50")
+        self.assertEqual(Image(blob=parts[0][1]).size, (50, 25))
+        self.assertEqual(parts[1][1], self.png)
+        self.assertEqual(parts[2][0]["X-Giraffe-Status"], "404")
+
+    @mock.patch('giraffe.s3')
+    def test_zip(self, s3):
+        self.bulk_s3(s3)
+        r = self.client.post("/bulk", json={'items': self.items(), 'format': 'zip'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "application/zip")
+        with zipfile.ZipFile(BytesIO(r.content)) as archive:
+            manifest = json.loads(archive.read("manifest.json"))
+            self.assertEqual([entry['status'] for entry in manifest], [200, 200, 404])
+            self.assertEqual(archive.read(manifest[1]['name']), self.png)
+            self.assertEqual(Image(blob=archive.read(manifest[0]['name'])).size, (50, 25))
+
+    @mock.patch('giraffe.BULK_MAX_ITEMS', 2)
+    def test_too_many_items(self):
+        r = self.client.post("/bulk", json={'items': self.items()})
+        self.assertEqual(r.status_code, 400)
+
+    def test_unknown_format(self):
+        r = self.client.post("/bulk", json={'items': self.items(), 'format': 'tar'})
+        self.assertEqual(r.status_code, 422)
+
+
+class TestAnimations(unittest.TestCase):
+    def animation(self, frames=10, delay=2, size=(200, 100)):
+        img = mock.MagicMock()
+        img.animation = True
+        img.size = size
+        img.sequence = [mock.MagicMock(delay=delay) for _ in range(frames)]
+        return img
+
+    def test_subsample_frames(self):
+        self.assertEqual(giraffe.subsample_frames([10, 10, 10]), [(0, 10), (1, 10), (2, 10)])
+        # 50fps down to 10fps keeps every 5th frame
+        self.assertEqual(giraffe.subsample_frames([2] * 10, fps=10), [(0, 10), (5, 10)])
+
+    def test_subsample_frames_uneven_delays(self):
+        self.assertEqual(giraffe.subsample_frames([5, 20, 5, 5, 5], fps=10), [(0, 25), (2, 10), (4, 5)])
+
+    def test_subsample_max_frames(self):
+        self.assertEqual(giraffe.subsample_frames([10] * 6, max_frames=3), [(0, 20), (2, 20), (4, 20)])
+
+    def test_prepare_animation(self):
+        img = self.animation()
+        self.assertIs(giraffe.prepare_animation(img), img)
+        self.assertTrue(img.coalesce.called)
+
+    @mock.patch('giraffe.Image')
+    def test_prepare_animation_drops_frames_before_coalescing(self, Image):
+        img = self.animation()
+        result, canvas = mock.MagicMock(), mock.MagicMock()
+        Image.side_effect = [result, canvas]
+        self.assertIs(giraffe.prepare_animation(img, fps=10), result)
+        self.assertFalse(img.coalesce.called)
+        # every frame's drawn onto the one canvas, but only the kept ones are copied out
+        self.assertEqual(canvas.composite.call_count, 10)
+        self.assertEqual(result.sequence.append.call_args_list, [mock.call(canvas), mock.call(canvas)])
+        self.assertTrue(canvas.close.called)
+
+    def test_resize_animation_keeps_aspect(self):
+        img = self.animation(frames=2)
+        giraffe.process_image(img, giraffe.build_pipeline({'w': 50}))
+        for frame in img.sequence:
+            frame.resize.assert_called_once_with(50, 25)
+            self.assertFalse(frame.crop.called)
+
+    def test_resize_animation_fills_and_crops(self):
+        img = self.animation(frames=2)
+        giraffe.process_image(img, giraffe.build_pipeline({'w': 50, 'h': 50}))
+        for frame in img.sequence:
+            frame.resize.assert_called_once_with(100, 50)
+            frame.crop.assert_called_once_with(width=50, height=50, gravity='center')
+
+    def test_fps_op(self):
+        self.assertIn(giraffe.ImageOp('fps', {'fps': 10}), giraffe.build_pipeline({'fps': 10}))
+
+    def test_animated_formats(self):
+        self.assertEqual(giraffe.canonicalize_args({'w': 10, 'fm': 'WEBP'}, "gif"), {'w': 10, 'fm': 'webp'})
+        self.assertEqual(giraffe.canonicalize_args({'w': 10, 'fm': 'gif'}, "gif"), {'w': 10})
+
+    @mock.patch('giraffe.FFMPEG', None)
+    def test_video_needs_ffmpeg(self):
+        with self.assertRaises(HTTPException) as e:
+            giraffe.canonicalize_args({'fm': 'mp4'}, "gif")
+        self.assertEqual(e.exception.status_code, 400)
+
+    @mock.patch('giraffe.FFMPEG', "/usr/bin/ffmpeg")
+    @mock.patch('giraffe.subprocess')
+    def test_encode_video(self, subprocess):
+        def run(args, **kwargs):
+            with open(args[-1], "wb") as f:
+                f.write(b"video")
+        subprocess.run.side_effect = run
+        img = mock.MagicMock()
+        buff = giraffe.image_to_buffer(img, fmt='mp4')
+        self.assertEqual(buff.getvalue(), b"video")
+        self.assertEqual(img.format, 'gif')
+        args, kwargs = subprocess.run.call_args
+        self.assertEqual(args[0][0], "/usr/bin/ffmpeg")
+        self.assertIn('libx264', args[0])
+        self.assertEqual(giraffe.format_content_type('mp4'), 'video/mp4')
+        # ImageMagick never gets asked for an mp4
+        self.assertNotIn('format', [op.function for op in giraffe.build_pipeline({'fm': 'mp4'})])
+
+
+class TestLiquidRescale(FastAPITestCase):
+    def setUp(self):
+        super().setUp()
+        with Color('red') as bg:
+            self.image = Image(width=400, height=200, background=bg)
+
+    def test_carves_a_scaled_down_copy(self):
+        sizes = []
+        with mock.patch.object(self.image, 'liquid_rescale',
+                               side_effect=lambda w, h: sizes.append(self.image.size)) as carve:
+            giraffe.liquid_rescale(self.image, 100, 100)
+        carve.assert_called_once_with(100, 100)
+        # scaled down to just fill 100x100, so only 100 seams need carving
+        self.assertEqual(sizes, [(200, 100)])
+
+    @mock.patch('giraffe.LIQUID_MAX_COST', 1)
+    def test_over_budget_crops(self):
+        with mock.patch.object(self.image, 'liquid_rescale') as carve:
+            with self.assertRaises(giraffe.LiquidCrop) as e:
+                giraffe.liquid_rescale(self.image, 100, 100)
+        self.assertFalse(carve.called)
+        self.assertEqual(e.exception.img.size, (100, 100))
+
+    @mock.patch('giraffe.LIQUID_SLOTS', threading.BoundedSemaphore(1))
+    def test_too_many_carves_crops(self):
+        giraffe.LIQUID_SLOTS.acquire()
+        with mock.patch.object(self.image, 'liquid_rescale') as carve:
+            with self.assertRaises(giraffe.LiquidCrop):
+                giraffe.liquid_rescale(self.image, 100, 100)
+        self.assertFalse(carve.called)
+
+    @mock.patch('giraffe.LIQUID_MAX_COST', 1)
+    @mock.patch('giraffe.s3')
+    def test_over_budget_crop_is_not_stored(self, s3):
+        obj = mock.Mock(content=self.image.make_blob("png"), headers={})
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get("/bucket/art.png?w=100&h=100&fit=liquid")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["cache-control"], giraffe.LIQUID_FALLBACK_CACHE_CONTROL)
+        self.assertEqual(Image(blob=r.content).size, (100, 100))
+        self.assertFalse(s3.upload.called)
+        self.assertEqual(giraffe.LIQUID_CARVES, {})
+
+    @mock.patch('giraffe.s3')
+    def test_carve_under_way_is_joined(self, s3):
+        obj = mock.Mock(content=self.image.make_blob("png"), headers={})
+        s3.get.side_effect = [make_httperror(404), obj]
+        name = giraffe.calculate_cache_keys(
+            "", "art", "png", OrderedDict([('w', 100), ('h', 100), ('fit', 'liquid')]))[0]
+        carving = giraffe.Future()
+        carving.set_result(b"carved")
+        with mock.patch.dict('giraffe.LIQUID_CARVES', {('bucket', name): carving}):
+            with mock.patch('giraffe.liquid_rescale') as liquid_rescale:
+                r = self.client.get("/bucket/art.png?w=100&h=100&fit=liquid")
+        self.assertEqual(r.content, b"carved")
+        self.assertFalse(liquid_rescale.called)
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.LIQUID_TIMEOUT', 0.01)
+    def test_timeout(self):
+        with mock.patch.object(self.image, 'liquid_rescale', side_effect=lambda w, h: time.sleep(0.2)):
+            with self.assertRaises(giraffe.LiquidTimeout) as e:
+                giraffe.liquid_rescale(self.image, 100, 100)
+            e.exception.future.result()
+        self.assertIs(e.exception.img, self.image)
+
+    @mock.patch('giraffe.s3')
+    def test_slow_carve_serves_crop_then_stores_carve(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("png")
+        s3.get.side_effect = [make_httperror(404), obj]
+
+        def slow_carve(img, width=None, height=None):
+            future = giraffe.LIQUID_POOL.submit(img.liquid_rescale, width, height)
+            raise giraffe.LiquidTimeout(img, future)
+
+        with mock.patch('giraffe.liquid_rescale', side_effect=slow_carve):
+            r = self.client.get("/bucket/art.png?w=100&h=100&fit=liquid")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["cache-control"], giraffe.LIQUID_FALLBACK_CACHE_CONTROL)
+        self.assertEqual(Image(blob=r.content).size, (100, 100))
+        # only the finished carve is stored
+        s3.upload.assert_called_once()
+        self.assertEqual(giraffe.LIQUID_CARVES, {})
+        args, kwargs = s3.upload.call_args
+        self.assertEqual(args[0], giraffe.calculate_cache_keys(
+            "", "art", "png", OrderedDict([('w', 100), ('h', 100), ('fit', 'liquid')]))[0])
+
+
+class TestRect(FastAPITestCase):
+    def setUp(self):
+        super().setUp()
+        with Color('red') as bg:
+            self.image = Image(width=400, height=200, background=bg)
+
+    def test_canonical_rect(self):
+        self.assertEqual(giraffe.canonicalize_args({'rect': '10, 20,30,40', 'w': 10}, "png"),
+                         OrderedDict([('rect', '10,20,30,40'), ('w', 10)]))
+
+    def test_bad_rect(self):
+        for rect in ('1,2,3', 'a,b,c,d', '0,0,0,10', '-1,0,10,10'):
+            with self.assertRaises(HTTPException) as e:
+                giraffe.parse_rect(rect)
+            self.assertEqual(e.exception.status_code, 400)
+
+    def test_load_region_extracts_while_reading(self):
+        with mock.patch('giraffe.library') as library, mock.patch('giraffe.Image') as image:
+            img = giraffe.load_image_region(b"image", None, None, (1, 2, 30, 40))
+        library.MagickSetExtract.assert_called_once_with(image.return_value.wand, b"30x40+1+2")
+        image.return_value.read.assert_called_once_with(blob=b"image")
+        self.assertIs(img, image.return_value)
+
+    def test_load_region_without_extract(self):
+        with mock.patch('giraffe.library', object()):
+            img = giraffe.load_image_region(self.image.make_blob("png"), None, None, (10, 10, 30, 40))
+        self.assertEqual(img.size, (30, 40))
+
+    @mock.patch('giraffe.s3')
+    def test_rect(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("png")
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get("/bucket/art.png?rect=100,50,100,100")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Image(blob=r.content).size, (100, 100))
+
+    @mock.patch('giraffe.s3')
+    def test_rect_then_resize(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("png")
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get("/bucket/art.png?rect=0,0,100,50&w=50")
+        self.assertEqual(Image(blob=r.content).size, (50, 25))
+
+    @mock.patch('giraffe.s3')
+    def test_rect_outside_original(self, s3):
+        obj = mock.Mock()
+        obj.content = self.image.make_blob("png")
+        s3.get.side_effect = [make_httperror(404), obj]
+        r = self.client.get("/bucket/art.png?rect=350,0,100,100")
+        self.assertEqual(r.status_code, 400)
+
+
+class TestGenerationGate(unittest.TestCase):
+    def test_limit_and_queue(self):
+        gate = giraffe.GenerationGate(1, 1, 1)
+
+        async def run():
+            await gate.acquire()
+            waiting = asyncio.ensure_future(gate.acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(gate.queued, 1)
+            # the queue's full, so no waiting around
+            with self.assertRaises(giraffe.Saturated):
+                await gate.acquire()
+            gate.release()
+            await waiting
+            self.assertEqual((gate.active, gate.queued), (1, 0))
+            gate.release()
+            self.assertEqual(gate.active, 0)
+
+        asyncio.run(run())
+
+    def test_queue_timeout(self):
+        gate = giraffe.GenerationGate(1, 10, 0.01)
+
+        async def run():
+            await gate.acquire()
+            with self.assertRaises(giraffe.Saturated):
+                await gate.acquire()
+            self.assertEqual(gate.queued, 0)
+
+        asyncio.run(run())
+
+    def test_slot_granted_as_the_wait_times_out(self):
+        gate = giraffe.GenerationGate(1, 10, 1)
+
+        async def granted_then_timed_out(waiter, timeout):
+            # the slot's handed over in the same loop iteration the timeout fires
+            gate.release()
+            self.assertTrue(waiter.done())
+            raise asyncio.TimeoutError()
+
+        async def run():
+            await gate.acquire()
+            with mock.patch('asyncio.wait_for', granted_then_timed_out):
+                with self.assertRaises(giraffe.Saturated):
+                    await gate.acquire()
+            self.assertEqual((gate.active, gate.queued), (0, 0))
+
+        asyncio.run(run())
+
+    def test_smallest_first(self):
+        gate = giraffe.GenerationGate(1, 10, 1)
+        order = []
+
+        async def wait(name, priority):
+            await gate.acquire(priority)
+            order.append(name)
+            gate.release()
+
+        async def run():
+            await gate.acquire()
+            waiting = [asyncio.ensure_future(wait(name, priority))
+                       for name, priority in (('big', 1000), ('small', 10), ('also small', 10))]
+            await asyncio.sleep(0)
+            gate.release()
+            await asyncio.gather(*waiting)
+
+        asyncio.run(run())
+        self.assertEqual(order, ['small', 'also small', 'big'])
+
+    def test_generation_priority(self):
+        self.assertEqual(giraffe.generation_priority({'w': 10, 'h': 20}), 200)
+        self.assertEqual(giraffe.generation_priority({'w': 10}), 100)
+        self.assertEqual(giraffe.generation_priority({'fm': 'png'}), giraffe.MAX_PIXELS)
+        self.assertEqual(giraffe.generation_priority({'w': 10, 'h': 10}, 3), 300)
+
+    def test_slot_is_a_503(self):
+        gate = giraffe.GenerationGate(0, 0, 0)
+
+        async def run():
+            async with gate.slot():
+                pass
+
+        with self.assertRaises(HTTPException) as e:
+            asyncio.run(run())
+        self.assertEqual(e.exception.status_code, 503)
+        self.assertEqual(e.exception.headers["Retry-After"], str(giraffe.GENERATION_RETRY_AFTER))
+
+    def test_host_slots(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            slots = giraffe.HostSlots(tmp, 1)
+            fd = slots.try_acquire()
+            self.assertIsNotNone(fd)
+            # flock is per open file, so a second open of the slot can't have it either
+            self.assertIsNone(slots.try_acquire())
+            slots.release(fd)
+            slots.release(slots.try_acquire())
+
+    def test_buckets_take_turns_by_weight(self):
+        gate = giraffe.GenerationGate(1, 20, 1, weights={'heavy': 2})
+        order = []
+
+        async def wait(bucket):
+            await gate.acquire(0, bucket)
+            order.append(bucket)
+            gate.release(bucket)
+
+        async def run():
+            await gate.acquire()
+            # a bucket that's queued lots can't starve the others
+            waiting = [asyncio.ensure_future(wait(bucket))
+                       for bucket in ['busy'] * 4 + ['heavy'] * 4 + ['quiet']]
+            await asyncio.sleep(0)
+            gate.release()
+            await asyncio.gather(*waiting)
+
+        asyncio.run(run())
+        self.assertEqual(order[:3], ['busy', 'heavy', 'quiet'])
+        # and heavy gets twice busy's turns while they're both waiting
+        self.assertEqual(order[3:7], ['heavy', 'busy', 'heavy', 'heavy'])
+
+    def test_bucket_concurrency(self):
+        gate = giraffe.GenerationGate(2, 10, 1, concurrency={'busy': 1})
+
+        async def run():
+            await gate.acquire(0, 'busy')
+            waiting = asyncio.ensure_future(gate.acquire(0, 'busy'))
+            await asyncio.sleep(0)
+            # there's a free slot but it's not for busy
+            self.assertEqual((gate.active, gate.queued), (1, 1))
+            await gate.acquire(0, 'quiet')
+            self.assertEqual(gate.active, 2)
+            gate.release('busy')
+            await waiting
+            self.assertEqual(gate.active_by_bucket['busy'], 1)
+
+        asyncio.run(run())
+
+    def test_bucket_rate_is_a_429(self):
+        gate = giraffe.GenerationGate(10, 10, 1, rates={'busy': 1})
+
+        async def run():
+            async with gate.slot(0, 'busy'):
+                pass
+            async with gate.slot(0, 'busy'):
+                pass
+
+        with self.assertRaises(HTTPException) as e:
+            asyncio.run(run())
+        self.assertEqual(e.exception.status_code, 429)
+        self.assertIn("Retry-After", e.exception.headers)
+        stats = gate.metrics()['buckets']['busy']
+        self.assertEqual((stats['admitted'], stats['throttled']), (1, 1))
+
+    def test_arbitrary_buckets_are_not_all_remembered(self):
+        gate = giraffe.GenerationGate(1, 10, 1, weights={'catalog': 2}, max_stats=2)
+
+        async def run():
+            for bucket in ['a', 'b', 'c', 'd', 'catalog']:
+                async with gate.slot(0, bucket):
+                    pass
+
+        asyncio.run(run())
+        self.assertEqual(set(gate.stats), {'a', 'b', gate.OTHER_BUCKETS, 'catalog'})
+        self.assertEqual(gate.stats[gate.OTHER_BUCKETS]['admitted'], 2)
+        self.assertEqual((gate.active_by_bucket, gate._queues), ({}, {}))
+        self.assertEqual(gate._finish, {})
+
+    def test_parse_bucket_settings(self):
+        self.assertEqual(giraffe.parse_bucket_settings("a=2, b=0.5", float), {'a': 2.0, 'b': 0.5})
+        self.assertEqual(giraffe.parse_bucket_settings(None, int), {})
+
+
+
+class TestGenerationAdmission(FastAPITestCase):
+    @mock.patch('giraffe.GENERATION_GATE', giraffe.GenerationGate(0, 0, 0))
+    @mock.patch('giraffe.s3')
+    def test_saturated(self, s3):
+        s3.get.side_effect = [make_httperror(404)]
+        r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.headers["retry-after"], str(giraffe.GENERATION_RETRY_AFTER))
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.s3')
+    def test_generation_runs_in_its_own_pool(self, s3):
+        with Color('red') as bg:
+            with Image(width=200, height=100, background=bg) as image:
+                obj = mock.Mock(content=image.make_blob("png"), headers={})
+        s3.get.side_effect = [make_httperror(404), obj]
+        threads = []
+
+        def render_image(*args):
+            threads.append(threading.current_thread().name)
+            return b"rendered"
+
+        with mock.patch('giraffe.render_image', side_effect=render_image):
+            r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.content, b"rendered")
+        self.assertTrue(threads[0].startswith("giraffe-generate"))
+
+    @mock.patch('giraffe.GENERATION_GATE', giraffe.GenerationGate(0, 0, 0))
+    @mock.patch('giraffe.s3')
+    def test_cache_hits_skip_the_queue(self, s3):
+        s3.get.side_effect = make_ranged_get(b"variant")
+        r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b"variant")
+
+    @mock.patch('giraffe.GENERATION_GATE', giraffe.GenerationGate(0, 0, 0))
+    @mock.patch('giraffe.s3')
+    def test_metrics(self, s3):
+        s3.get.side_effect = [make_httperror(404)]
+        self.client.get("/bucket/art.png?w=100")
+        r = self.client.get("/_giraffe/metrics/" + giraffe.metrics_hmac())
+        self.assertEqual(r.status_code, 200)
+        metrics = r.json()
+        self.assertEqual((metrics['active'], metrics['queued']), (0, 0))
+        self.assertEqual(metrics['buckets']['bucket']['rejected'], 1)
+
+    def test_metrics_need_the_key(self):
+        for url in ("/_giraffe/metrics", "/_giraffe/metrics/nope"):
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 404)
+            self.assertNotIn(b"buckets", r.content)
+
+
+
+class TestCancellation(FastAPITestCase):
+    def test_stage_deadline(self):
+        cancellation = giraffe.Cancellation()
+        with mock.patch.dict('giraffe.STAGE_TIMEOUTS', {'decode': 0.01}):
+            cancellation.start('decode')
+        self.assertFalse(cancellation.expired())
+        time.sleep(0.02)
+        self.assertTrue(cancellation.expired())
+        with self.assertRaises(giraffe.StageTimeout):
+            cancellation.check()
+        cancellation.detach()
+        self.assertFalse(cancellation.expired())
+
+    def test_render_stops_before_encoding(self):
+        cancellation = giraffe.Cancellation()
+        cancellation.cancel()
+        img = Image(width=10, height=10)
+        with mock.patch('giraffe.encode_image') as encode_image:
+            with self.assertRaises(giraffe.StageTimeout):
+                giraffe.render_image(img, [], {}, 'png', cancellation)
+        self.assertFalse(encode_image.called)
+        self.assertTrue(giraffe.image_closed(img))
+
+    @unittest.skipUnless(hasattr(giraffe.library, 'MagickSetImageProgressMonitor'),
+                         "needs ImageMagick's progress monitors")
+    def test_cancelled_operation_aborts(self):
+        cancellation = giraffe.Cancellation()
+        cancellation.cancel()
+        with Image(width=2000, height=2000, background=Color('red')) as img:
+            cancellation.watch(img)
+            try:
+                img.resize(6000, 6000, filter='lanczos')
+            except wand.exceptions.WandException:
+                pass
+            self.assertNotEqual(img.size, (6000, 6000))
+
+    @unittest.skipUnless(hasattr(giraffe.library, 'MagickSetProgressMonitor'),
+                         "needs ImageMagick's progress monitors")
+    def test_cancelled_decode_aborts(self):
+        with Image(width=2000, height=2000, background=Color('red')) as img:
+            content = img.make_blob('png')
+        cancellation = giraffe.Cancellation()
+        cancellation.cancel()
+        with self.assertRaises(wand.exceptions.WandException):
+            giraffe.load_original(content, {}, 'big.png', {}, cancellation)
+
+    def test_client_disconnects(self):
+        request = mock.Mock()
+        request.is_disconnected = mock.AsyncMock(return_value=True)
+        cancellation = giraffe.Cancellation()
+
+        async def run():
+            generating = asyncio.ensure_future(asyncio.sleep(10))
+            response = await giraffe.until_disconnected(request, generating, cancellation)
+            return response, generating
+
+        response, generating = asyncio.run(run())
+        self.assertEqual(response.status_code, 499)
+        self.assertTrue(generating.cancelled())
+        self.assertTrue(cancellation.cancelled.is_set())
+
+    def test_client_stays(self):
+        request = mock.Mock()
+        request.is_disconnected = mock.AsyncMock(return_value=False)
+
+        async def generate():
+            await asyncio.sleep(0.05)
+            return "variant"
+
+        result = asyncio.run(giraffe.until_disconnected(request, generate(), giraffe.Cancellation()))
+        self.assertEqual(result, "variant")
+
+    @mock.patch.dict('giraffe.STAGE_TIMEOUTS', {'decode': 0.05})
+    @mock.patch('giraffe.s3')
+    def test_slow_decode_is_a_504(self, s3):
+        obj = mock.Mock(content=b"not really an image", headers={})
+        s3.get.side_effect = [make_httperror(404), obj]
+
+        def load_original(*args):
+            time.sleep(0.2)
+
+        with mock.patch('giraffe.get_image_size', return_value=(10, 10)):
+            with mock.patch('giraffe.load_original', side_effect=load_original):
+                r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.status_code, 504)
+        self.assertFalse(s3.upload.called)
+
+
+
+class TestMagickLimits(FastAPITestCase):
+    def test_limits_from_the_host(self):
+        gib = 1024 ** 3
+        with mock.patch.dict('giraffe.MAGICK_LIMITS', clear=True):
+            limits = giraffe.magick_limits(memory=16 * gib, cpus=16, workers=4, concurrency=2)
+        self.assertEqual(limits['memory'], 2 * gib)
+        self.assertEqual(limits['map'], 4 * gib)
+        self.assertEqual(limits['disk'], 8 * gib)
+        self.assertEqual(limits['area'], gib // giraffe.PIXEL_BYTES)
+        self.assertEqual(limits['thread'], 2)
+
+    def test_configured_limits_win(self):
+        with mock.patch.dict('giraffe.MAGICK_LIMITS', {'memory': 1000, 'thread': 1}, clear=True):
+            limits = giraffe.magick_limits(memory=10 ** 9, cpus=64, workers=1, concurrency=1)
+        self.assertEqual((limits['memory'], limits['thread'], limits['map']), (1000, 1, 10 ** 9))
+
+    def test_apply(self):
+        applied = {}
+        with mock.patch('wand.resource.limits', applied):
+            giraffe.apply_magick_limits({'memory': 1000, 'thread': 2})
+        self.assertEqual(applied, {'memory': 1000, 'thread': 2})
+        self.assertEqual(giraffe.MAGICK_STATS['limits'], applied)
+
+    @mock.patch('giraffe.s3')
+    def test_limit_hit_is_a_503(self, s3):
+        obj = mock.Mock(content=b"huge", headers={})
+        s3.get.side_effect = [make_httperror(404), obj]
+        hits = giraffe.MAGICK_STATS['limit_hits']['decode']
+        with mock.patch('giraffe.get_image_size', return_value=(10, 10)):
+            with mock.patch('giraffe.load_original', side_effect=ResourceLimitError("cache resources exhausted")):
+                r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(giraffe.MAGICK_STATS['limit_hits']['decode'], hits + 1)
+        metrics = self.client.get("/_giraffe/metrics/" + giraffe.metrics_hmac()).json()
+        self.assertEqual(metrics['magick']['limit_hits']['decode'], hits + 1)
+
+
+
+class TestImageLifetimes(FastAPITestCase):
+    def test_leaks_are_reported(self):
+        leaked, closed = Image(width=10, height=10), Image(width=10, height=10)
+        closed.close()
+        stats = dict(giraffe.IMAGE_STATS)
+        tracker = [(leaked, 800), (closed, 800)]
+        self.assertEqual(giraffe.report_image_leaks("/bucket/art.png", tracker), [(leaked, 800)])
+        self.assertEqual(giraffe.IMAGE_STATS['leaked'], stats['leaked'] + 1)
+        self.assertEqual(giraffe.IMAGE_STATS['leaked_bytes'], stats['leaked_bytes'] + 800)
+
+    def test_replaced_images_are_closed(self):
+        img, replacement = Image(width=10, height=10), Image(width=10, height=10)
+        op = giraffe.ImageOp(lambda img: replacement, {})
+        self.assertIs(giraffe.process_image(img, [op]), replacement)
+        self.assertTrue(giraffe.image_closed(img))
+        self.assertFalse(giraffe.image_closed(replacement))
+
+    def test_failures_close_the_image(self):
+        img = Image(width=10, height=10)
+        with self.assertRaises(ValueError):
+            giraffe.process_image(img, [giraffe.ImageOp(mock.Mock(side_effect=ValueError), {})])
+        self.assertTrue(giraffe.image_closed(img))
+
+    @mock.patch('giraffe.s3')
+    def test_bad_arguments_are_refused_before_fetching(self, s3):
+        s3.get.side_effect = make_httperror(404)
+        r = self.client.get("/bucket/art.png?rot=400")
+        self.assertEqual(r.status_code, 400)
+        self.assertNotIn("art.png", [call[0][0] for call in s3.get.call_args_list])
+
+    @mock.patch('giraffe.sprite_thumbnail')
+    @mock.patch('giraffe.s3')
+    def test_sprite_thumbnails_are_closed_when_one_fails(self, s3, sprite_thumbnail):
+        def get(key, bucket=None, headers=None):
+            if key.startswith(giraffe.CACHE_DIR):
+                raise make_httperror(404)
+            return mock.Mock(content=b"original", headers={})
+
+        s3.get.side_effect = get
+        thumbnails = []
+
+        def thumbnail(obj, path, w, h):
+            if path == "b.png":
+                raise ValueError("corrupt")
+            thumbnails.append(Image(width=w, height=h))
+            return thumbnails[-1]
+
+        sprite_thumbnail.side_effect = thumbnail
+        self.client.get("/sprites/bucket.png?paths=a.png&paths=b.png&paths=c.png&w=8&h=8")
+        self.assertEqual(len(thumbnails), 2)
+        self.assertTrue(all(giraffe.image_closed(img) for img in thumbnails))
+
+    @mock.patch('giraffe.TRACK_IMAGES', True)
+    @mock.patch('giraffe.s3')
+    def test_soak(self, s3):
+        with Color('red') as bg:
+            with Image(width=200, height=100, background=bg) as image:
+                s3.get.return_value = mock.Mock(content=image.make_blob("png"), headers={})
+        stats = dict(giraffe.IMAGE_STATS)
+        queries = ["w={}", "w={}&h=40", "w={}&fm=jpg", "rect=10,10,50,50&w={}", "w={}&h=50&flip=h"]
+        for i in range(100):
+            r = self.client.get("/bucket/art.png?force=true&" + queries[i % len(queries)].format(20 + i))
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(giraffe.IMAGE_STATS['requests'], stats['requests'] + 100)
+        self.assertGreaterEqual(giraffe.IMAGE_STATS['opened'], stats['opened'] + 100)
+        self.assertEqual(giraffe.IMAGE_STATS['leaked'], stats['leaked'])
+
+
+
+@mock.patch('giraffe.GENERATION_GATE', giraffe.GenerationGate(0, 0, 0))
+@mock.patch('giraffe.generate_later')
+class TestDegradedMode(FastAPITestCase):
+    def setUp(self):
+        super().setUp()
+        giraffe.PENDING_VARIANTS.clear()
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['nearest'])
+    @mock.patch('giraffe.s3')
+    def test_nearest_cached_size(self, s3, generate_later):
+        cached = make_ranged_get(b"w320")
+
+        def get(path, bucket=None, headers=None):
+            if "w320" in path:
+                return cached(path, bucket, headers)
+            raise make_httperror(404)
+
+        s3.get.side_effect = get
+        r = self.client.get("/bucket/art.png?w=200")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b"w320")
+        self.assertEqual(r.headers["x-giraffe-degraded"], "nearest")
+        self.assertEqual(r.headers["cache-control"], giraffe.OVERLOAD_CACHE_CONTROL)
+        # and the real thing's on its way
+        self.assertTrue(generate_later.called)
+        self.assertIn("w200", generate_later.call_args[0][2])
+
+    def test_nearest_sizes_keep_the_aspect_ratio(self, generate_later):
+        sizes = [(c['w'], c['h']) for c in giraffe.nearest_variant_args({'w': 200, 'h': 100})]
+        self.assertEqual(sizes, [(320, 160), (640, 320), (1280, 640), (1920, 960), (160, 80)])
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['nearest', 'preview'])
+    @mock.patch('giraffe.s3')
+    def test_preview(self, s3, generate_later):
+        with Color('red') as bg:
+            with Image(width=400, height=200, background=bg) as image:
+                original = mock.Mock(content=image.make_blob("png"), headers={})
+
+        def get(path, bucket=None, headers=None):
+            if path == "art.png":
+                return original
+            raise make_httperror(404)
+
+        s3.get.side_effect = get
+        r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["x-giraffe-degraded"], "preview")
+        self.assertEqual(r.headers["cache-control"], giraffe.OVERLOAD_CACHE_CONTROL)
+        with Image(blob=r.content) as preview:
+            self.assertEqual(preview.size, (100, 50))
+        self.assertFalse(s3.upload.called)
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['placeholder'])
+    @mock.patch('giraffe.s3')
+    def test_placeholder(self, s3, generate_later):
+        s3.get.side_effect = [make_httperror(404)]
+        r = self.client.get("/bucket/art.jpg?w=100&h=80")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["x-giraffe-degraded"], "placeholder")
+        with Image(blob=r.content) as placeholder:
+            self.assertEqual(placeholder.size, (100, 80))
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['nearest'])
+    @mock.patch('giraffe.s3')
+    def test_nothing_to_fall_back_on(self, s3, generate_later):
+        s3.get.side_effect = make_httperror(404)
+        r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.status_code, 503)
+        self.assertFalse(generate_later.called)
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['placeholder'])
+    @mock.patch('giraffe.s3')
+    def test_background_generation_is_scheduled_once(self, s3, generate_later):
+        s3.get.side_effect = make_httperror(404)
+        self.client.get("/bucket/art.png?w=100")
+        self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(generate_later.call_count, 1)
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['preview', 'placeholder'])
+    @mock.patch('giraffe.PREVIEW_SLOTS', threading.BoundedSemaphore(1))
+    @mock.patch('giraffe.s3')
+    def test_previews_are_bounded(self, s3, generate_later):
+        s3.get.side_effect = make_httperror(404)
+        giraffe.PREVIEW_SLOTS.acquire()
+        r = self.client.get("/bucket/art.png?w=100")
+        self.assertEqual(r.headers["x-giraffe-degraded"], "placeholder")
+        self.assertNotIn("art.png", [call[0][0] for call in s3.get.call_args_list])
+
+    @mock.patch('giraffe.OVERLOAD_FALLBACKS', ['placeholder'])
+    @mock.patch('giraffe.s3')
+    def test_bulk_gets_no_stand_ins(self, s3, generate_later):
+        s3.get.side_effect = make_httperror(404)
+        r = self.client.post("/bulk", json={'items': [{'bucket': 'bucket', 'path': 'art.png', 'params': {'w': 100}}],
+                                            'format': 'zip'})
+        with zipfile.ZipFile(BytesIO(r.content)) as archive:
+            manifest = json.loads(archive.read("manifest.json"))
+        self.assertEqual([entry['status'] for entry in manifest], [503])
+        self.assertFalse(generate_later.called)
+
+
+class TestGenerateLater(unittest.TestCase):
+    @mock.patch('giraffe.generate_variant')
+    def test_finishes_background_work(self, generate_variant):
+        background = mock.AsyncMock()
+        generate_variant.return_value = mock.Mock(background=background)
+        giraffe.PENDING_VARIANTS.add(('bucket', 'cache/art_w100.png'))
+        asyncio.run(giraffe.generate_later('bucket', 'art.png', 'cache/art_w100.png', 'cache/art_w100.png',
+                                           {'w': 100}, mock.Mock(), None))
+        self.assertTrue(background.called)
+        self.assertNotIn(('bucket', 'cache/art_w100.png'), giraffe.PENDING_VARIANTS)
+
+
+class TestNegativeCache(FastAPITestCase):
+    @mock.patch('giraffe.s3')
+    def test_missing_original(self, s3):
+        s3.get.side_effect = make_httperror(404)
+        for _ in range(3):
+            r = self.client.get("/bucket/gone.jpg")
+            self.assertEqual(r.status_code, 404)
+            self.assertEqual(r.headers["cache-control"], giraffe.NOT_FOUND_CACHE_CONTROL)
+        self.assertEqual(s3.get.call_count, 1)
+
+    @mock.patch('giraffe.s3')
+    def test_variant_of_missing_original(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
+        for _ in range(3):
+            r = self.client.get("/bucket/gone.jpg?w=100")
+            self.assertEqual(r.status_code, 404)
+            self.assertEqual(r.headers["cache-control"], giraffe.NOT_FOUND_CACHE_CONTROL)
+        self.assertEqual(s3.head_object.call_count, 1)
+        self.assertFalse(s3.get.called)
+
+    @mock.patch('giraffe.s3')
+    def test_only_confirmed_misses_are_missing(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
+        for i in range(100):
+            giraffe.get_object_metadata("bucket", f"gone{i}.jpg")
+        giraffe.MISSING_ORIGINALS.clear()
+        # once the cache has forgotten, S3 gets asked again
+        s3.head_object.side_effect = None
+        self.assertIsNotNone(giraffe.get_object_metadata("bucket", "gone0.jpg"))
+
+    @mock.patch('giraffe.s3')
+    def test_force_looks_again_for_originals(self, s3):
+        s3.get.side_effect = make_httperror(404)
+        self.assertEqual(self.client.get("/bucket/new.jpg").status_code, 404)
+        s3.get.side_effect = make_ranged_get(b"uploaded since")
+        self.assertEqual(self.client.get("/bucket/new.jpg").status_code, 404)
+        r = self.client.get("/bucket/new.jpg?force=true")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b"uploaded since")
+        self.assertEqual(self.client.get("/bucket/new.jpg").status_code, 200)
+
+    @mock.patch('giraffe.s3')
+    def test_force_looks_again(self, s3):
+        s3.head_object.side_effect = make_httperror(404)
+        self.assertIsNone(giraffe.get_object_metadata("bucket", "art.jpg"))
+        s3.head_object.side_effect = None
+        self.assertIsNotNone(giraffe.get_object_metadata("bucket", "art.jpg", refresh=True))
+        self.assertIsNone(giraffe.MISSING_ORIGINALS.get(("bucket", "art.jpg")))
+
+    def test_shared_tier(self):
+        with mock.patch('giraffe.memcached') as memcached:
+            giraffe.remember_missing("bucket", "gone.jpg")
+            key = giraffe.missing_key("bucket", "gone.jpg")
+            memcached.set.assert_called_once_with(key, b"1", expire=giraffe.NEGATIVE_CACHE_TTL, noreply=True)
+
+            # another worker's miss
+            memcached.get.side_effect = lambda k: b"1" if k == giraffe.missing_key("bucket", "elsewhere.jpg") else None
+            self.assertTrue(giraffe.known_missing("bucket", "elsewhere.jpg"))
+            self.assertFalse(giraffe.known_missing("bucket", "here.jpg"))
+
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru(self):
+        cache = giraffe.TTLCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_ttl(self):
+        cache = giraffe.TTLCache(2, ttl=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_weight(self):
+        cache = giraffe.TTLCache(10, maxweight=10, weigh=len)
+        cache.set('a', "x" * 6)
+        cache.set('b', "x" * 4)
+        self.assertEqual(cache.weight, 10)
+        cache.set('c', "x")
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.weight, 5)
+        cache.pop('b')
+        self.assertEqual(cache.weight, 1)
+
+    def test_too_heavy_is_not_cached(self):
+        cache = giraffe.TTLCache(10, maxweight=10, weigh=len)
+        cache.set('a', "x")
+        cache.set('b', "x" * 11)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), "x")
+
+    def test_dispose(self):
+        disposed = []
+        cache = giraffe.TTLCache(1, dispose=disposed.append)
+        cache.set('a', "a")
+        cache.set('a', "a")
+        cache.set('a', "b")
+        cache.set('c', "c")
+        self.assertEqual(disposed, ["a", "b"])
+        self.assertEqual(cache.pop('c'), "c")
+        cache.set('d', "d")
+        cache.clear()
+        self.assertEqual(disposed, ["a", "b", "d"])
+
+
+class TestPlaceholderRoute(FastAPITestCase):
+    def test_placeholder(self):
+        r = self.client.get("/placeholders/300x200.jpg")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "image/jpeg")
+        self.assertEqual(Image(blob=r.content).size, (300, 200))
+        self.assertIn("etag", r.headers)
+
+    def test_placeholder_not_modified(self):
+        etag = self.client.get("/placeholders/300x200.png").headers["etag"]
+        with mock.patch('giraffe.Image') as image:
+            r = self.client.get("/placeholders/300x200.png", headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertFalse(image.called)
+
+    def test_placeholder_etag_depends_on_message(self):
+        r1 = self.client.get("/placeholders/300x200.png")
+        r2 = self.client.get("/placeholders/300x200.png?message=hello")
+        self.assertNotEqual(r1.headers["etag"], r2.headers["etag"])
+
+    def test_placeholder_is_memoized(self):
+        r1 = self.client.get("/placeholders/300x200.png")
+        with mock.patch('giraffe.Image') as image:
+            r2 = self.client.get("/placeholders/300x200.png")
+        self.assertFalse(image.called)
+        self.assertEqual(r1.content, r2.content)
+
+    def test_placeholder_cache_is_bounded_by_bytes(self):
+        self.assertEqual(giraffe.PLACEHOLDERS.maxweight, giraffe.PLACEHOLDER_CACHE_BYTES)
+        with mock.patch.object(giraffe.PLACEHOLDERS, 'maxweight', 1):
+            self.client.get("/placeholders/301x200.png")
+        self.assertIsNone(giraffe.PLACEHOLDERS.get((301, 200, 'png', '#fff', '301x200')))
+
+    def test_svg_placeholder(self):
+        with mock.patch('giraffe.Image') as image:
+            r = self.client.get("/placeholders/300x200.svg?bg=abc&message=<b>hi</b>")
+        self.assertFalse(image.called)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "image/svg+xml")
+        self.assertIn(b'width="300" height="200"', r.content)
+        self.assertIn(b'fill="#abc"', r.content)
+        self.assertIn(b'&lt;b&gt;hi&lt;/b&gt;', r.content)
+
+    def test_unknown_format(self):
+        r = self.client.get("/placeholders/300x200.gif")
+        self.assertEqual(r.status_code, 404)
+
+
+class TestProxyRoute(FastAPITestCase):
+    url = "http://example.com/image.jpg"
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+    def proxy_url(self):
+        return "/proxy/{}?url={}".format(giraffe.generate_hmac(self.url), self.url)
+
+    def upstream(self, *chunks, **headers):
+        resp = mock.Mock()
+        resp.status_code = headers.pop('status_code', 200)
+        resp.url = self.url
+        resp.headers = headers
+        resp.iter_content.return_value = iter(chunks)
+        return resp
+
+    def test_bad_hmac(self):
+        r = self.client.get("/proxy/nope?url={}".format(self.url))
+        self.assertEqual(r.status_code, 404)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_proxy(self, session):
+        resp = self.upstream(self.png[:50], self.png[50:], etag='"abc"')
+        session.get.return_value = resp
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.png)
+        self.assertEqual(r.headers["etag"], '"abc"')
+        self.assertEqual(r.headers["content-type"], "image/png")
+        self.assertTrue(resp.close.called)
+        args, kwargs = session.get.call_args
+        self.assertTrue(kwargs['stream'])
+        self.assertEqual(
+            kwargs['timeout'], (giraffe.PROXY_CONNECT_TIMEOUT, giraffe.PROXY_READ_TIMEOUT)
+        )
+
+    @mock.patch('giraffe.proxy_session')
+    def test_content_type_is_sniffed(self, session):
+        # whatever the upstream claims, this is a png
+        session.get.return_value = self.upstream(self.png, **{'content-type': 'text/html'})
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "image/png")
+
+    @mock.patch('giraffe.proxy_session')
+    def test_not_an_image(self, session):
+        resp = self.upstream(b"<html><script>alert(1)</script></html>")
+        session.get.return_value = resp
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 400)
+        self.assertTrue(resp.close.called)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_too_big(self, session):
+        length = str(giraffe.PROXY_MAX_BYTES + 1)
+        session.get.return_value = self.upstream(self.png, **{'content-length': length})
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 400)
+
+    @mock.patch('giraffe.PROXY_MAX_BYTES', 150)
+    def test_too_big_while_streaming(self):
+        # no content-length, so the limit has to be enforced as the body arrives
+        upstream = giraffe.UpstreamImage(
+            self.upstream(), self.png, "image/png", iter([b"\x00" * 100])
+        )
+        body = giraffe.iter_upstream(upstream)
+        self.assertEqual(next(body), self.png)
+        self.assertRaises(ValueError, next, body)
+        self.assertTrue(upstream.response.close.called)
+
+    def test_keeping_stops_at_the_limit(self):
+        kept = []
+        body = list(giraffe.iter_and_keep(iter([b"a" * 100, b"b" * 100, b"c"]), kept, limit=150))
+        self.assertEqual(body, [b"a" * 100, b"b" * 100, b"c"])
+        self.assertEqual(kept, [])
+
+        kept = []
+        list(giraffe.iter_and_keep(iter([b"a" * 100, b"b" * 50]), kept, limit=150))
+        self.assertEqual(kept, [b"a" * 100, b"b" * 50, None])
+
+    @mock.patch('giraffe.PROXY_CACHE_BUCKET', None)
+    @mock.patch('giraffe.iter_and_keep')
+    @mock.patch('giraffe.proxy_session')
+    def test_too_big_to_keep_is_only_streamed(self, session, iter_and_keep):
+        length = str(giraffe.PROXY_MEMORY_MAX_ITEM_BYTES + 1)
+        session.get.return_value = self.upstream(self.png, **{'content-length': length})
+        self.client.get(self.proxy_url())
+        self.assertFalse(iter_and_keep.called)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_proxy_not_modified_upstream(self, session):
+        session.get.return_value = self.upstream(status_code=304, etag='"abc"')
+        r = self.client.get(self.proxy_url(), headers={"If-None-Match": '"abc"'})
+        self.assertEqual(r.status_code, 304)
+        args, kwargs = session.get.call_args
+        self.assertEqual(kwargs['headers'], {'If-None-Match': '"abc"'})
+
+
+    @mock.patch('giraffe.proxy_session')
+    def test_proxied_image_is_cached(self, session):
+        session.get.return_value = self.upstream(self.png, etag='"abc"')
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.png)
+        self.assertEqual(r.headers["etag"], '"abc"')
+        self.assertEqual(session.get.call_count, 1)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_no_store_is_not_cached(self, session):
+        session.get.side_effect = [
+            self.upstream(self.png, **{'cache-control': 'no-store'}),
+            self.upstream(self.png, **{'cache-control': 'no-store'}),
+        ]
+        self.client.get(self.proxy_url())
+        self.client.get(self.proxy_url())
+        self.assertEqual(session.get.call_count, 2)
+
+    def cache_stale_copy(self):
+        giraffe.PROXY_CACHE.set(giraffe.generate_hmac(self.url), giraffe.ProxyEntry(
+            content=self.png, content_type="image/png", etag='"abc"',
+            last_modified=None, expires=0,
+        ))
+
+    @mock.patch('giraffe.proxy_session')
+    def test_stale_copy_is_revalidated(self, session):
+        self.cache_stale_copy()
+        session.get.return_value = self.upstream(status_code=304, **{'cache-control': 'max-age=60'})
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.png)
+        args, kwargs = session.get.call_args
+        self.assertEqual(kwargs['headers'], {'If-None-Match': '"abc"'})
+        # and it's fresh again
+        self.client.get(self.proxy_url())
+        self.assertEqual(session.get.call_count, 1)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_stale_copy_served_when_upstream_is_down(self, session):
+        self.cache_stale_copy()
+        session.get.side_effect = requests.exceptions.ConnectionError()
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.png)
+        self.assertEqual(r.headers["cache-control"], giraffe.PROXY_STALE_CACHE_CONTROL)
+
+    @mock.patch('giraffe.PROXY_CACHE_BUCKET', "proxy.bucket")
+    @mock.patch('giraffe.s3')
+    @mock.patch('giraffe.proxy_session')
+    def test_proxied_image_stored_in_s3(self, session, s3):
+        s3.get.side_effect = make_httperror(404)
+        session.get.return_value = self.upstream(self.png, etag='"abc"')
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        args, kwargs = s3.upload.call_args
+        self.assertEqual(args[0], giraffe.proxy_cache_key(giraffe.generate_hmac(self.url)))
+        self.assertEqual(args[1].getvalue(), self.png)
+        self.assertEqual(kwargs['bucket'], "proxy.bucket")
+        self.assertEqual(kwargs['headers']['x-amz-meta-giraffe-etag'], '"abc"')
+
+    @mock.patch('giraffe.PROXY_CACHE_BUCKET', "proxy.bucket")
+    @mock.patch('giraffe.s3')
+    @mock.patch('giraffe.proxy_session')
+    def test_proxied_image_found_in_s3(self, session, s3):
+        obj = mock.Mock()
+        obj.content = self.png
+        obj.headers = {
+            'content-type': 'image/png',
+            'x-amz-meta-giraffe-etag': '"abc"',
+            'x-amz-meta-giraffe-expires': str(int(giraffe.time.time() + 60)),
+        }
+        s3.get.return_value = obj
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.png)
+        self.assertFalse(session.get.called)
+
+
+class TestProxyTransform(FastAPITestCase):
+    url = "http://example.com/image.png"
+
+    def setUp(self):
+        super().setUp()
+        with Color('red') as bg:
+            with Image(width=200, height=100, background=bg) as image:
+                self.png = image.make_blob("png")
+
+    def proxy_url(self, query="w=50&h=25", hmac_args=None):
+        args = OrderedDict([('w', 50), ('h', 25)]) if hmac_args is None else hmac_args
+        key = giraffe.generate_hmac(giraffe.proxy_hmac_message(self.url, args))
+        return "/proxy/{}?url={}&{}".format(key, self.url, query)
+
+    def upstream(self, content, **headers):
+        resp = mock.Mock()
+        resp.status_code = 200
+        resp.url = self.url
+        resp.headers = headers
+        resp.iter_content.return_value = iter([content])
+        return resp
+
+    def test_hmac_without_args_is_unchanged(self):
+        self.assertEqual(giraffe.proxy_hmac_message(self.url), self.url)
+        self.assertEqual(giraffe.proxy_hmac_message(self.url, OrderedDict()), self.url)
+
+    def test_hmac_must_cover_args(self):
+        # a key for the bare url doesn't let you ask for other sizes
+        r = self.client.get(self.proxy_url(hmac_args=OrderedDict()))
+        self.assertEqual(r.status_code, 404)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_resize(self, session):
+        session.get.return_value = self.upstream(self.png, etag='"abc"')
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "image/png")
+        self.assertEqual(r.headers["etag"], giraffe.content_etag(r.content))
+        self.assertEqual(Image(blob=r.content).size, (50, 25))
+
+    @mock.patch('giraffe.proxy_session')
+    def test_reformat(self, session):
+        session.get.return_value = self.upstream(self.png)
+        args = OrderedDict([('w', 50), ('fm', 'jpg')])
+        r = self.client.get(self.proxy_url("fm=jpeg&w=50", hmac_args=args))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["content-type"], "image/jpeg")
+        self.assertEqual(Image(blob=r.content).format, "JPEG")
+
+    @mock.patch('giraffe.proxy_session')
+    def test_transformed_image_is_cached(self, session):
+        session.get.return_value = self.upstream(self.png, etag='"abc"', **{'cache-control': 'max-age=60'})
+        first = self.client.get(self.proxy_url())
+        second = self.client.get(self.proxy_url())
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(session.get.call_count, 1)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_stale_transform_revalidates_with_upstream_etag(self, session):
+        session.get.return_value = self.upstream(self.png, etag='"abc"', **{'cache-control': 'max-age=0'})
+        self.client.get(self.proxy_url())
+        session.get.return_value = self.upstream(self.png, etag='"abc"')
+        self.client.get(self.proxy_url())
+        args, kwargs = session.get.call_args
+        self.assertEqual(kwargs['headers']['If-None-Match'], '"abc"')
+
+    @mock.patch('giraffe.GENERATION_GATE', giraffe.GenerationGate(0, 0, 0))
+    @mock.patch('giraffe.transform_proxied')
+    @mock.patch('giraffe.proxy_session')
+    def test_transforms_wait_for_a_slot(self, session, transform_proxied):
+        session.get.return_value = self.upstream(self.png)
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 503)
+        self.assertFalse(transform_proxied.called)
+
+    def test_too_many_pixels(self):
+        args = OrderedDict([('w', giraffe.MAX_PIXELS), ('h', 2)])
+        r = self.client.get(self.proxy_url("w={}&h=2".format(giraffe.MAX_PIXELS), hmac_args=args))
+        self.assertEqual(r.status_code, 400)
+
+    @mock.patch('giraffe.proxy_session')
+    def test_not_decodable(self, session):
+        session.get.return_value = self.upstream(b"\x89PNG\r\n\x1a\n" + b"\x00" * 100)
+        r = self.client.get(self.proxy_url())
+        self.assertEqual(r.status_code, 400)
+
+
+class TestUpstreamTTL(unittest.TestCase):
+    def test_max_age(self):
+        self.assertEqual(giraffe.upstream_ttl({'cache-control': 'public, max-age=600'}), 600)
+        self.assertEqual(
+            giraffe.upstream_ttl({'cache-control': 'max-age=600, s-maxage=60'}), 60
+        )
+
+    def test_uncacheable(self):
+        self.assertIsNone(giraffe.upstream_ttl({'cache-control': 'no-store'}))
+        self.assertIsNone(giraffe.upstream_ttl({'cache-control': 'private, max-age=60'}))
+        self.assertEqual(giraffe.upstream_ttl({'cache-control': 'no-cache'}), 0)
+
+    def test_expires(self):
+        self.assertEqual(giraffe.upstream_ttl({'expires': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 0)
+        self.assertEqual(giraffe.upstream_ttl({'expires': 'garbage'}), 0)
+
+    def test_default(self):
+        self.assertEqual(giraffe.upstream_ttl({}), giraffe.PROXY_DEFAULT_TTL)
+
+
+class TestSniffImageType(unittest.TestCase):
+    def test_sniff(self):
+        self.assertEqual(giraffe.sniff_image_type(b"\xff\xd8\xff\xe0..."), "image/jpeg")
+        self.assertEqual(giraffe.sniff_image_type(b"GIF89a..."), "image/gif")
+        self.assertEqual(giraffe.sniff_image_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp")
+        self.assertIsNone(giraffe.sniff_image_type(b"<svg></svg>"))
+        self.assertIsNone(giraffe.sniff_image_type(b""))
+
 
 class TestSanitizeExtension(unittest.TestCase):
     """Test cases for the sanitize_extension function"""